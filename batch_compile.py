@@ -0,0 +1,104 @@
+'''Batch compiler
+Compiles many Scheme source files in parallel. Every worker process keeps its
+own warm compiler Driver. The assembly of each file is written next to it.
+
+    python batch_compile.py tests
+    python batch_compile.py -j 4 tests/r1_1.rkt tests/r1_2.rkt
+'''
+from __future__ import print_function
+
+import argparse
+import fnmatch
+import multiprocessing as mp
+import os
+import sys
+import time
+
+from compile_server import AddCacheArguments, MakeDriver, WriteAssembly
+import gentables
+
+OKGREEN = '\033[92m'
+FAIL = '\033[91m'
+ENDC = '\033[0m'
+
+# the Driver of the current worker process
+_driver = None
+
+
+def _InitWorker(args):
+    global _driver
+    _driver = MakeDriver(args)
+
+
+def CollectSourceFiles(paths, pattern):
+    result = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                file_path = os.path.join(path, name)
+                if os.path.isfile(file_path) and fnmatch.fnmatch(name, pattern):
+                    result.append(file_path)
+        else:
+            result.append(path)
+    return result
+
+
+def AsmPath(src_path):
+    return os.path.splitext(src_path)[0] + '.s'
+
+
+def _CompileFile(src_path):
+    '''
+    Returns a tuple of (src_path, error, elapsed seconds). |error| is None
+    on success.
+    '''
+    begin = time.time()
+    error = None
+    try:
+        with open(src_path, 'r') as rf:
+            source = rf.read()
+        WriteAssembly(AsmPath(src_path), _driver.Compile(source))
+    except Exception as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    return src_path, error, time.time() - begin
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('paths', nargs='+',
+                            help='source files or directories')
+    arg_parser.add_argument('-j', '--jobs', type=int,
+                            default=mp.cpu_count())
+    arg_parser.add_argument('--pattern', default='*.rkt',
+                            help='the source files to pick in a directory')
+    AddCacheArguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    src_paths = CollectSourceFiles(args.paths, args.pattern)
+    # generate the PLY tables once, rather than racing in every worker
+    gentables.main()
+
+    begin = time.time()
+    pool = mp.Pool(args.jobs, _InitWorker, (args,))
+    num_failed = 0
+    try:
+        for src_path, error, elapsed in pool.imap(_CompileFile, src_paths):
+            if error is None:
+                status = '{}OK{}'.format(OKGREEN, ENDC)
+            else:
+                status = '{}Failed{}'.format(FAIL, ENDC)
+                num_failed += 1
+            print('{} {} ({:.3f}s)'.format(src_path, status, elapsed))
+            if error is not None:
+                print('    {}'.format(error))
+    finally:
+        pool.close()
+        pool.join()
+
+    print('Compiled {} files, {} failed, in {:.3f}s with {} jobs'.format(
+        len(src_paths), num_failed, time.time() - begin, args.jobs))
+    return 1 if num_failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+'''Compiler benchmark
+Generates synthetic Scheme programs of growing sizes and measures how long
+the compiler takes on them, in total and per pass, and its peak memory. The
+results are written as JSON for regression tracking.
+
+    python benchmark.py
+    python benchmark.py --programs nested_let live_vars --sizes 100 200 -o out.json
+
+Each (program, size) is compiled in a fresh process, so that the peak RSS
+(as reported by getrusage, KB on Linux) belongs to that compilation only.
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing as mp
+import resource
+import sys
+import time
+
+from compiler.cache import CompilerVersion
+from compiler.driver import Driver
+from compiler.pass_manager import PassManager, PassStatsHook
+
+DEFAULT_SIZES = [50, 100, 200, 400]
+# the passes are deeply recursive on the generated programs
+RECURSION_LIMIT = 20000
+# see ComputeVectorTag()
+MAX_VECTOR_LEN = 50
+
+'''Program generators
+Each generator returns the source code of a program parameterized by |n|.
+'''
+
+
+def GenNestedLet(n):
+    # (let ([x0 1]) (let ([x1 (+ x0 1)]) ... x{n-1}))
+    src = ['(let ([x0 1])']
+    for i in xrange(1, n):
+        src.append('(let ([x{} (+ x{} 1)])'.format(i, i - 1))
+    src.append('x{}'.format(n - 1))
+    src.append(')' * n)
+    return '\n'.join(src)
+
+
+def GenWideVector(n):
+    # |n| elements, split into vectors of at most MAX_VECTOR_LEN elements,
+    # then the first element of every vector is summed up.
+    num_vecs = (n + MAX_VECTOR_LEN - 1) / MAX_VECTOR_LEN
+    src = []
+    for v in xrange(num_vecs):
+        vec_len = min(MAX_VECTOR_LEN, n - v * MAX_VECTOR_LEN)
+        elems = ' '.join(['(+ {} 1)'.format(i) for i in xrange(vec_len)])
+        src.append('(let ([v{} (vector {})])'.format(v, elems))
+    sum_expr = '0'
+    for v in xrange(num_vecs):
+        sum_expr = '(+ (vector-ref v{} 0) {})'.format(v, sum_expr)
+    src.append(sum_expr)
+    src.append(')' * num_vecs)
+    return '\n'.join(src)
+
+
+def GenIfChain(n):
+    # (let ([x (read)]) (if (eq? x 0) 0 (if (eq? x 1) 1 ... n)))
+    src = ['(let ([x (read)])']
+    for i in xrange(n):
+        src.append('(if (eq? x {0}) {0}'.format(i))
+    src.append(str(n))
+    src.append(')' * (n + 1))
+    return '\n'.join(src)
+
+
+def GenLiveVars(n):
+    # (let ([x0 (read)]) ... (let ([x{n-1} (read)]) (+ x0 (+ x1 ... 0))))
+    src = []
+    for i in xrange(n):
+        src.append('(let ([x{} (read)])'.format(i))
+    sum_expr = '0'
+    for i in reversed(xrange(n)):
+        sum_expr = '(+ x{} {})'.format(i, sum_expr)
+    src.append(sum_expr)
+    src.append(')' * n)
+    return '\n'.join(src)
+
+
+PROGRAMS = {
+    'nested_let': GenNestedLet,
+    'wide_vector': GenWideVector,
+    'if_chain': GenIfChain,
+    'live_vars': GenLiveVars,
+}
+
+'''Measurement
+'''
+
+
+def _PassStats(driver, source):
+    '''
+    Returns the PassStatsHook stats of each pass, in the order of the
+    pipeline.
+    '''
+    stats_hook = PassStatsHook()
+    driver.Compile(source, PassManager([stats_hook]))
+    return stats_hook.stats
+
+
+def _Measure(program, size, repeat):
+    # runs in a fresh process
+    sys.setrecursionlimit(RECURSION_LIMIT)
+    source = PROGRAMS[program](size)
+    driver = Driver()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    best, best_wall = None, None
+    for _ in xrange(repeat):
+        begin = time.time()
+        stats = _PassStats(driver, source)
+        wall = time.time() - begin
+        if best is None or wall < best_wall:
+            best, best_wall = stats, wall
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        'program': program,
+        'size': size,
+        'source_bytes': len(source),
+        'wall': best_wall,
+        'peak_rss': rss_after,
+        'peak_rss_delta': rss_after - rss_before,
+        'passes': best,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('--programs', nargs='+', choices=sorted(PROGRAMS.keys()),
+                            default=sorted(PROGRAMS.keys()))
+    arg_parser.add_argument('--sizes', nargs='+', type=int,
+                            default=DEFAULT_SIZES)
+    arg_parser.add_argument('--repeat', type=int, default=3,
+                            help='keep the fastest of this many runs')
+    arg_parser.add_argument('-o', '--output', default=None,
+                            help='write the JSON results to this file '
+                            'instead of stdout')
+    args = arg_parser.parse_args()
+
+    results = []
+    for program in args.programs:
+        for size in args.sizes:
+            pool = mp.Pool(1)
+            try:
+                result = pool.apply(_Measure, (program, size, args.repeat))
+            finally:
+                pool.close()
+                pool.join()
+            results.append(result)
+            print('{: <12} n={: <6} {:.3f}s  peak_rss={}'.format(
+                program, size, result['wall'], result['peak_rss']),
+                file=sys.stderr)
+
+    report = json.dumps({
+        'compiler_version': CompilerVersion(),
+        'results': results,
+    }, indent=2, sort_keys=True)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, 'w') as wf:
+            wf.write(report)
+            wf.write('\n')
+
+
+if __name__ == '__main__':
+    main()
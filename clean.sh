@@ -2,7 +2,7 @@
 
 find_cmd="-print"
 function find_files {
-    find -E . -type f -regex "(.*\.(pyc|s|out))|(.*/parsetab\.py)|(.*/parser\.out)" $find_cmd
+    find -E . -type f -regex "(.*\.(pyc|s|out))|(.*/parsetab(_[0-9a-f]+)?\.py)|(.*/lextab(_[0-9a-f]+)?\.py)|(.*/parser\.out)" $find_cmd
 }
 
 echo "Remove the following files:"
@@ -0,0 +1,163 @@
+'''Compile server
+Keeps a warm compiler Driver and serves compile requests, so that compiling
+a file does not pay for the interpreter startup, the imports and the
+lexer/parser construction.
+
+The protocol is JSON lines, one request/response per line, either over
+stdin/stdout (default) or over a Unix domain socket (--socket PATH).
+
+request:  {"id": 1, "path": "tests/r1_1.rkt", "output": "tests/r1_1.s"}
+          {"id": 2, "source": "(+ 1 2)"}
+response: {"id": 1, "ok": true, "asm": "...", "error": null}
+          {"id": 2, "ok": false, "asm": null, "error": "ParsingError: ..."}
+
+"output" is optional. When present the assembly is also written to it.
+
+Compiled programs are cached on disk (see compiler/cache.py) unless
+--no-cache is given.
+'''
+import argparse
+import json
+import os
+import SocketServer
+import subprocess as sp
+import sys
+
+from compiler.cache import CompileCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+from compiler.driver import Driver
+
+
+def _ReadSource(path):
+    with open(path, 'r') as rf:
+        return rf.read()
+
+
+def WriteAssembly(path, asm):
+    with open(path, 'w') as wf:
+        wf.write(asm)
+        wf.write('\n')
+
+
+class CompileService(object):
+
+    def __init__(self, driver):
+        self._driver = driver
+
+    def Handle(self, request):
+        response = {'id': request.get('id'), 'ok': False,
+                    'asm': None, 'error': None}
+        try:
+            if 'source' in request:
+                source = str(request['source'])
+            else:
+                source = _ReadSource(request['path'])
+            asm = self._driver.Compile(source)
+            if request.get('output') is not None:
+                WriteAssembly(request['output'], asm)
+            response['ok'] = True
+            response['asm'] = asm
+        except Exception as e:
+            response['error'] = '{}: {}'.format(type(e).__name__, e)
+        return response
+
+    def Serve(self, rf, wf):
+        for line in iter(rf.readline, ''):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                response = self.Handle(json.loads(line))
+            except ValueError as e:
+                response = {'id': None, 'ok': False, 'asm': None,
+                            'error': 'Bad request: {}'.format(e)}
+            wf.write(json.dumps(response))
+            wf.write('\n')
+            wf.flush()
+
+
+def _ServeUnixSocket(service, path):
+    class Handler(SocketServer.StreamRequestHandler):
+
+        def handle(self):
+            service.Serve(self.rfile, self.wfile)
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = SocketServer.UnixStreamServer(path, Handler)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+class CompileClient(object):
+    '''Spawns a compile server as a child process and talks to it through
+    its stdin/stdout.
+    '''
+
+    def __init__(self, server_args=()):
+        '''
+        server_args: the command line arguments of the server
+        '''
+        server_path = os.path.abspath(__file__)
+        self._proc = sp.Popen([sys.executable, server_path] + list(server_args),
+                              stdin=sp.PIPE, stdout=sp.PIPE)
+        self._next_id = 0
+
+    def _Request(self, request):
+        request['id'] = self._next_id
+        self._next_id += 1
+        self._proc.stdin.write(json.dumps(request))
+        self._proc.stdin.write('\n')
+        self._proc.stdin.flush()
+        response = json.loads(self._proc.stdout.readline())
+        assert response['id'] == request['id']
+        return response
+
+    def CompileFile(self, path, output=None):
+        return self._Request({'path': path, 'output': output})
+
+    def CompileSource(self, source):
+        return self._Request({'source': source})
+
+    def Close(self):
+        self._proc.stdin.close()
+        self._proc.wait()
+
+
+def AddCacheArguments(arg_parser):
+    arg_parser.add_argument('--no-cache', action='store_true',
+                            help='always compile from scratch')
+    arg_parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    arg_parser.add_argument('--cache-size', type=int,
+                            default=DEFAULT_MAX_BYTES / (1024 * 1024),
+                            help='the maximum size of the cache in MB')
+    arg_parser.add_argument('--cache-dumps', action='store_true',
+                            help='also cache the IR and X86 dumps')
+
+
+def MakeDriver(args):
+    cache = None
+    if not args.no_cache:
+        cache = CompileCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    return Driver(cache=cache, keep_dumps=args.cache_dumps)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('--socket', default=None,
+                            help='serve on this Unix domain socket path '
+                            'instead of stdin/stdout')
+    AddCacheArguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    service = CompileService(MakeDriver(args))
+    if args.socket is None:
+        service.Serve(sys.stdin, sys.stdout)
+    else:
+        _ServeUnixSocket(service, args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -246,8 +246,6 @@ if __name__ == '__main__':
         (if #t (+ foo bar) (vector-ref (vector-ref x 3) 0))
     )
     '''
-    test_data = lexer.LexPreprocess(test_data)
-
     lexer = lexer.SchemeLexer()
     parser = SchemeParser()
     ast = parser.parse(test_data, lexer=lexer)
@@ -1,16 +1,8 @@
-from collections import namedtuple
-
-_NODE_STRUCTURE_INDEX = 0
-_NODE_DATA_INDEX = 1
-
-_NSTRUCT_TYPE_CHAIN_INDEX = 0
-_NSTRUCT_LANG_INDEX = 1
-
-AstNode = namedtuple('AstNode', ['structure', 'data'])
-_NodeStructure = namedtuple('_NodeStructure', ['type_chain', 'lang'])
+from copy import deepcopy
 
 
 class TypeChain(object):
+    __slots__ = ('_type', '_parent')
 
     def __init__(self, type, parent):
         assert parent is None or isinstance(parent, TypeChain)
@@ -26,13 +18,152 @@ class TypeChain(object):
         return self._parent
 
 
+# (type, parent TypeChain) => TypeChain
+_type_chains = {}
+
+
+def MakeTypeChain(type, parent):
+    '''
+    Returns the TypeChain of |type| and |parent|. TypeChains are interned, so
+    two of them are equal if and only if they are the same object.
+    '''
+    key = (type, parent)
+    type_chain = _type_chains.get(key)
+    if type_chain is None:
+        type_chain = TypeChain(type, parent)
+        _type_chains[key] = type_chain
+    return type_chain
+
+
+class _NodeStructure(object):
+    '''The structure shared by all the nodes of the same type and language
+
+    Besides the type chain and the language, it holds the layout of the
+    properties of these nodes, i.e. the index of each property name into
+    AstNode.values. A property gets its index the first time it is set on a
+    node of this structure.
+    '''
+    __slots__ = ('type_chain', 'lang', 'prop_index')
+
+    def __init__(self, type_chain, lang):
+        self.type_chain = type_chain
+        self.lang = lang
+        self.prop_index = {}
+
+    def IndexOf(self, p):
+        index = self.prop_index.get(p)
+        if index is None:
+            index = len(self.prop_index)
+            self.prop_index[p] = index
+        return index
+
+
+# placeholder of the properties that are not set on a node
+_UNSET = object()
+
+
+class AstNode(object):
+    '''
+    structure: a _NodeStructure, shared by all the nodes of the same type
+    values: a list of the property values, laid out by |structure|
+    '''
+    __slots__ = ('structure', 'values')
+
+    def __init__(self, structure):
+        self.structure = structure
+        self.values = []
+
+    def __deepcopy__(self, memo):
+        # the structure is shared, only the property values are copied
+        node = AstNode(self.structure)
+        memo[id(self)] = node
+        memo[id(_UNSET)] = _UNSET
+        node.values = deepcopy(self.values, memo)
+        return node
+
+    def __repr__(self):
+        props = ', '.join('{}={!r}'.format(p, self.values[i])
+                          for p, i in sorted(self.structure.prop_index.items(),
+                                             key=lambda pi: pi[1])
+                          if i < len(self.values) and
+                          self.values[i] is not _UNSET)
+        return 'AstNode({}:{}, {})'.format(self.structure.lang,
+                                           self.structure.type_chain.type,
+                                           props)
+
+
+# (type, lang) => _NodeStructure
+_node_structures = {}
+
+
 def MakeAstNodeStructure(type, parent_tc, lang):
     '''
     type: a string of the symbol type of the node
     parent_tc: a TypeChain, if |type| has a parent type. Otherwise it is None
     lang: a string of the language of the node
+
+    Returns the _NodeStructure shared by all the nodes with the same |type|
+    and |lang|. Structures are interned, so a node is of a given type if and
+    only if its structure is the structure of that type.
+    '''
+    key = (type, lang)
+    structure = _node_structures.get(key)
+    if structure is None:
+        structure = _NodeStructure(MakeTypeChain(type, parent_tc), lang)
+        _node_structures[key] = structure
+    assert structure.type_chain.parent is parent_tc, \
+        '{} of {} has a different parent type'.format(type, lang)
+    return structure
+
+
+# the number of AST nodes created while counting, only used for statistics
+_num_nodes_created = 0
+
+
+class _CountedAstNode(AstNode):
+    '''An AstNode counting its own creation
+    '''
+    __slots__ = ()
+
+    def __init__(self, structure):
+        global _num_nodes_created
+        _num_nodes_created += 1
+        AstNode.__init__(self, structure)
+
+
+# the class of the nodes created by NewAstNode()
+_ast_node_class = AstNode
+
+
+def SetNodeCounting(enabled):
+    '''
+    Counting costs every node creation, so it is off until the statistics
+    need it. Swapping the class keeps NewAstNode() free of it when disabled.
     '''
-    return _NodeStructure(TypeChain(type, parent_tc), lang)
+    global _ast_node_class
+    _ast_node_class = _CountedAstNode if enabled else AstNode
+
+
+def NumNodesCreated():
+    return _num_nodes_created
+
+
+def NewAstNode(structure):
+    '''
+    structure: a _NodeStructure returned by MakeAstNodeStructure()
+    '''
+    return _ast_node_class(structure)
+
+
+def CloneAstNode(node):
+    '''
+    Returns a new node of the same structure and property values as |node|.
+    The property values themselves are shared, so this is meant for the leaf
+    nodes, i.e. a Var node that a later pass renames independently.
+    '''
+    clone = NewAstNode(node.structure)
+    clone.values = node.values[:]
+    return clone
 
 
 def MakeAstNode(type, parent_tc, lang):
@@ -41,47 +172,78 @@ def MakeAstNode(type, parent_tc, lang):
     parent_tc: a TypeChain, if |type| has a parent type. Otherwise it is None
     lang: a string of the language of the node
     '''
-    structure = MakeAstNodeStructure(type, parent_tc, lang)
-    data = {}
-    return AstNode(structure, data)
+    return NewAstNode(MakeAstNodeStructure(type, parent_tc, lang))
 
 
 def MakeAstNodeBase(type, lang):
     return MakeAstNode(type, None, lang)
 
 
+# when enabled, the AST visitors check every visited node before dispatching
+_ast_visitor_debug = False
+
+
+def SetAstVisitorDebug(debug):
+    global _ast_visitor_debug
+    _ast_visitor_debug = debug
+
+
+def IsAstVisitorDebug():
+    return _ast_visitor_debug
+
+
+class AstVisitorMeta(type):
+    '''Builds the dispatch table of an AST visitor class once, when the class
+    is created.
+
+    The visitor class lists the name of the visit method of each node structure
+    in |_VISIT_METHODS|. |_visit_table| maps each structure to the visit
+    function resolved on the class, so that the overrides of a subclass are
+    picked up and dispatching a node is a single dict lookup.
+    '''
+
+    def __init__(cls, name, bases, attrs):
+        super(AstVisitorMeta, cls).__init__(name, bases, attrs)
+        cls._visit_table = {structure: getattr(cls, method).im_func
+                            for structure, method in cls._VISIT_METHODS}
+
+
 def StructureOf(node):
-    return node[_NODE_STRUCTURE_INDEX]
+    return node.structure
 
 
 def TypeChainOf(node):
-    return StructureOf(node)[_NSTRUCT_TYPE_CHAIN_INDEX]
+    return node.structure.type_chain
 
 
 def TypeOf(node):
-    return TypeChainOf(node).type
+    return node.structure.type_chain.type
 
 
 def ParentOf(node):
     ''' Returns the parent type chain.
     '''
-    return TypeChainOf(node).parent
+    return node.structure.type_chain.parent
 
 
 def LangOf(node):
-    return StructureOf(node)[_NSTRUCT_LANG_INDEX]
-
-
-def DataOf(node):
-    return node[_NODE_DATA_INDEX]
+    return node.structure.lang
 
 
 def HasProperty(node, p):
-    return p in DataOf(node)
+    index = node.structure.prop_index.get(p)
+    return (index is not None and index < len(node.values) and
+            node.values[index] is not _UNSET)
 
 
 def GetProperty(node, p):
-    return DataOf(node)[p]
+    try:
+        val = node.values[node.structure.prop_index[p]]
+    except IndexError:
+        val = _UNSET
+    if val is _UNSET:
+        raise KeyError(p)
+    return val
 
 
 def GetProperties(node, ps):
@@ -89,7 +251,13 @@ def GetProperties(node, ps):
 
 
 def SetProperty(node, p, val):
-    DataOf(node)[p] = val
+    index = node.structure.IndexOf(p)
+    values = node.values
+    if index < len(values):
+        values[index] = val
+    else:
+        values.extend([_UNSET] * (index - len(values)))
+        values.append(val)
 
 
 def SetProperties(node, pvs):
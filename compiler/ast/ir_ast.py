@@ -16,101 +16,114 @@ _IR_P_OP = 'op'
 _IR_BINOP_P_LHS = 'lhs'
 _IR_BINOP_P_RHS = 'rhs'
 
-_NODE_TC = TypeChain(NODE_T, None)
-_STMT_TC = TypeChain(STMT_NODE_T, _NODE_TC)
-_EXPR_TC = TypeChain(EXPR_NODE_T, _NODE_TC)
-_ARG_TC = TypeChain(ARG_NODE_T, _EXPR_TC)
+_NODE_TC = MakeTypeChain(NODE_T, None)
+_STMT_TC = MakeTypeChain(STMT_NODE_T, _NODE_TC)
+_EXPR_TC = MakeTypeChain(EXPR_NODE_T, _NODE_TC)
+_ARG_TC = MakeTypeChain(ARG_NODE_T, _EXPR_TC)
 
 
-def _MakeIrNode(type, parent_tc):
-    return MakeAstNode(type, parent_tc, IR_LANG)
+def _IrStructure(type, parent_tc):
+    return MakeAstNodeStructure(type, parent_tc, IR_LANG)
 
 
-def _MakeIrStmtNode(type):
-    return _MakeIrNode(type, _STMT_TC)
-
-
-def _MakeIrExprNode(type):
-    return _MakeIrNode(type, _EXPR_TC)
-
-
-def _MakeIrArgNode(type):
-    return _MakeIrNode(type, _ARG_TC)
+_IR_PROGRAM_STRUCT = _IrStructure(PROGRAM_NODE_T, _NODE_TC)
+_IR_ASSIGN_STRUCT = _IrStructure(IR_ASSIGN_NODE_T, _STMT_TC)
+_IR_RETURN_STRUCT = _IrStructure(IR_RETURN_NODE_T, _STMT_TC)
+_IR_COLLECT_STRUCT = _IrStructure(INTERNAL_COLLECT_NODE_T, _STMT_TC)
+_IR_APPLY_STRUCT = _IrStructure(APPLY_NODE_T, _EXPR_TC)
+_IR_CMP_STRUCT = _IrStructure(IR_CMP_NODE_T, _EXPR_TC)
+_IR_IF_STRUCT = _IrStructure(IF_NODE_T, _STMT_TC)
+_IR_INT_STRUCT = _IrStructure(INT_NODE_T, _ARG_TC)
+_IR_VAR_STRUCT = _IrStructure(VAR_NODE_T, _ARG_TC)
+_IR_BOOL_STRUCT = _IrStructure(BOOL_NODE_T, _ARG_TC)
+_IR_VOID_STRUCT = _IrStructure(VOID_NODE_T, _ARG_TC)
+_IR_VECTOR_REF_STRUCT = _IrStructure(VECTOR_REF_NODE_T, _EXPR_TC)
+_IR_VECTOR_SET_STRUCT = _IrStructure(VECTOR_SET_NODE_T, _EXPR_TC)
+_IR_ALLOCATE_STRUCT = _IrStructure(INTERNAL_ALLOCATE_NODE_T, _EXPR_TC)
+_IR_GLOBAL_VALUE_STRUCT = _IrStructure(INTERNAL_GLOBAL_VALUE_NODE_T, _EXPR_TC)
 
 
 def MakeIrProgramNode(var_list, stmt_list):
-    node = _MakeIrNode(PROGRAM_NODE_T, _NODE_TC)
+    node = NewAstNode(_IR_PROGRAM_STRUCT)
     SetProperty(node, P_VAR_LIST, var_list)
     SetProperty(node, P_STMT_LIST, stmt_list)
     return node
 
 
 def IsIrProgramNode(node):
-    return LangOf(node) == IR_LANG and TypeOf(node) == PROGRAM_NODE_T
+    return StructureOf(node) is _IR_PROGRAM_STRUCT
 
 
 def MakeIrAssignNode(var, expr):
     assert LangOf(var) == IR_LANG and TypeOf(var) == VAR_NODE_T
     assert LangOf(expr) == IR_LANG
-    node = _MakeIrStmtNode(IR_ASSIGN_NODE_T)
+    node = NewAstNode(_IR_ASSIGN_STRUCT)
     SetProperties(node, {NODE_P_VAR: var, _IR_ASSIGN_P_EXPR: expr})
     return node
 
 
+def IsIrAssignNode(node):
+    return StructureOf(node) is _IR_ASSIGN_STRUCT
+
+
 def GetIrAssignExpr(node):
-    assert LangOf(node) == IR_LANG and TypeOf(node) == IR_ASSIGN_NODE_T
+    assert StructureOf(node) is _IR_ASSIGN_STRUCT
     return GetProperty(node, _IR_ASSIGN_P_EXPR)
 
 
 def SetIrAssignExpr(node, expr):
-    assert LangOf(node) == IR_LANG and TypeOf(node) == IR_ASSIGN_NODE_T
+    assert StructureOf(node) is _IR_ASSIGN_STRUCT
     assert LangOf(expr) == IR_LANG
     SetProperty(node, _IR_ASSIGN_P_EXPR, expr)
 
 
 def MakeIrReturnNode(arg):
     assert LangOf(arg) == IR_LANG and IsIrArgNode(arg)
-    node = _MakeIrStmtNode(IR_RETURN_NODE_T)
+    node = NewAstNode(_IR_RETURN_STRUCT)
     SetProperty(node, _IR_RETURN_P_ARG, arg)
     return node
 
 
+def IsIrReturnNode(node):
+    return StructureOf(node) is _IR_RETURN_STRUCT
+
+
 def GetIrReturnArg(node):
-    assert LangOf(node) == IR_LANG and TypeOf(node) == IR_RETURN_NODE_T
+    assert StructureOf(node) is _IR_RETURN_STRUCT
     return GetProperty(node, _IR_RETURN_P_ARG)
 
 
 def SetIrReturnArg(node, arg):
-    assert LangOf(node) == IR_LANG and TypeOf(node) == IR_RETURN_NODE_T
+    assert StructureOf(node) is _IR_RETURN_STRUCT
     assert LangOf(arg) == IR_LANG and IsIrArgNode(arg)
     SetProperty(node, _IR_RETURN_P_ARG, arg)
 
 
 def MakeIrCollectNode(bytes):
     assert isinstance(bytes, int)
-    node = _MakeIrStmtNode(INTERNAL_COLLECT_NODE_T)
+    node = NewAstNode(_IR_COLLECT_STRUCT)
     SetProperty(node, COLLECT_P_BYTES, bytes)
     SetNodeStaticType(node, StaticTypes.VOID)
     return node
 
 
 def IsIrCollectNode(node):
-    return LangOf(node) == IR_LANG and TypeOf(node) == INTERNAL_COLLECT_NODE_T
+    return StructureOf(node) is _IR_COLLECT_STRUCT
 
 
 def MakeIrApplyNode(method, arg_list):
-    node = _MakeIrExprNode(APPLY_NODE_T)
+    node = NewAstNode(_IR_APPLY_STRUCT)
     SetProperties(node, {P_METHOD: method, P_ARG_LIST: arg_list})
     return node
 
 
 def IsIrApplyNode(node):
-    return LangOf(node) == IR_LANG and TypeOf(node) == APPLY_NODE_T
+    return StructureOf(node) is _IR_APPLY_STRUCT
 
 
 def MakeIrCmpNode(op, lhs, rhs):
     assert IsIrArgNode(lhs) and IsIrArgNode(rhs)
-    node = _MakeIrExprNode(IR_CMP_NODE_T)
+    node = NewAstNode(_IR_CMP_STRUCT)
     SetProperty(node, _IR_P_OP, op)
     SetProperty(node, _IR_BINOP_P_LHS, lhs)
     SetProperty(node, _IR_BINOP_P_RHS, rhs)
@@ -118,7 +131,7 @@ def MakeIrCmpNode(op, lhs, rhs):
 
 
 def IsIrCmpNode(node):
-    return LangOf(node) == IR_LANG and TypeOf(node) == IR_CMP_NODE_T
+    return StructureOf(node) is _IR_CMP_STRUCT
 
 
 def GetIrCmpOp(node):
@@ -159,7 +172,7 @@ def MakeIrIfNode(cond, then, els):
     except TypeError:
         # not iterable
         raise RuntimeError('|then| or |els| not iterable')
-    node = _MakeIrStmtNode(IF_NODE_T)
+    node = NewAstNode(_IR_IF_STRUCT)
     SetProperty(node, IF_P_COND, cond)
     SetProperty(node, IF_P_THEN, then)
     SetProperty(node, IF_P_ELSE, els)
@@ -167,62 +180,56 @@ def MakeIrIfNode(cond, then, els):
 
 
 def IsIrIfNode(node):
-    return LangOf(node) == IR_LANG and TypeOf(node) == IF_NODE_T
+    return StructureOf(node) is _IR_IF_STRUCT
 
 
 def IsIrArgNode(node):
-    if LangOf(node) != IR_LANG:
-        return False
-    try:
-        # parent could be None
-        return ParentOf(node).type == ARG_NODE_T
-    except:
-        return False
+    # type chains are interned, the one of the X86 arg nodes differs
+    return LangOf(node) == IR_LANG and ParentOf(node) is _ARG_TC
 
 
 def MakeIrIntNode(x):
-    node = _MakeIrArgNode(INT_NODE_T)
+    node = NewAstNode(_IR_INT_STRUCT)
     SetProperty(node, INT_P_X, x)
     return node
 
 
 def MakeIrVarNode(var):
-    node = _MakeIrArgNode(VAR_NODE_T)
+    node = NewAstNode(_IR_VAR_STRUCT)
     SetProperty(node, NODE_P_VAR, var)
     return node
 
 
 def IsIrVarNode(node):
-    return LangOf(node) == IR_LANG and TypeOf(node) == VAR_NODE_T
+    return StructureOf(node) is _IR_VAR_STRUCT
 
 
 def MakeIrBoolNode(b):
-    node = _MakeIrArgNode(BOOL_NODE_T)
+    node = NewAstNode(_IR_BOOL_STRUCT)
     SetProperty(node, NODE_P_BOOL, b)
     return node
 
 
 def MakeIrVoidNode():
-    # node = _MakeIrExprNode(VOID_NODE_T)
-    node = _MakeIrArgNode(VOID_NODE_T)
+    node = NewAstNode(_IR_VOID_STRUCT)
     return node
 
 
 def MakeIrVectorRefNode(vec, idx):
     assert isinstance(idx, int)
-    node = _MakeIrExprNode(VECTOR_REF_NODE_T)
+    node = NewAstNode(_IR_VECTOR_REF_STRUCT)
     SetProperty(node, VECTOR_P_VEC, vec)
     SetProperty(node, VECTOR_P_INDEX, idx)
     return node
 
 
 def IsIrVectorRefNode(node):
-    return LangOf(node) == IR_LANG and TypeOf(node) == VECTOR_REF_NODE_T
+    return StructureOf(node) is _IR_VECTOR_REF_STRUCT
 
 
 def MakeIrVectorSetNode(vec, idx, val):
     assert isinstance(idx, int)
-    node = _MakeIrExprNode(VECTOR_SET_NODE_T)
+    node = NewAstNode(_IR_VECTOR_SET_STRUCT)
     SetProperty(node, VECTOR_P_VEC, vec)
     SetProperty(node, VECTOR_P_INDEX, idx)
     SetProperty(node, VECTOR_SET_P_VAL, val)
@@ -230,36 +237,55 @@ def MakeIrVectorSetNode(vec, idx, val):
 
 
 def IsIrVectorSetNode(node):
-    return LangOf(node) == IR_LANG and TypeOf(node) == VECTOR_SET_NODE_T
+    return StructureOf(node) is _IR_VECTOR_SET_STRUCT
 
 
 def MakeIrAllocateNode(len, static_type):
     assert isinstance(len, int)
-    node = _MakeIrExprNode(INTERNAL_ALLOCATE_NODE_T)
+    node = NewAstNode(_IR_ALLOCATE_STRUCT)
     SetProperty(node, ALLOCATE_P_LEN, len)
     SetNodeStaticType(node, static_type)
     return node
 
 
 def IsIrAllocateNode(node):
-    return LangOf(node) == IR_LANG and TypeOf(node) == INTERNAL_ALLOCATE_NODE_T
+    return StructureOf(node) is _IR_ALLOCATE_STRUCT
 
 
 def MakeIrGlobalValueNode(name):
-    node = _MakeIrExprNode(INTERNAL_GLOBAL_VALUE_NODE_T)
+    node = NewAstNode(_IR_GLOBAL_VALUE_STRUCT)
     SetProperty(node, GLOBAL_VALUE_P_NAME, name)
     SetNodeStaticType(node, StaticTypes.INT)
     return node
 
 
 def IsIrGlobalValueNode(node):
-    return LangOf(node) == IR_LANG and TypeOf(node) == INTERNAL_GLOBAL_VALUE_NODE_T
+    return StructureOf(node) is _IR_GLOBAL_VALUE_STRUCT
 
 ''' IR Ast Node Visitor
 '''
 
 
 class IrAstVisitorBase(object):
+    __metaclass__ = AstVisitorMeta
+
+    _VISIT_METHODS = (
+        (_IR_PROGRAM_STRUCT, 'VisitProgram'),
+        (_IR_ASSIGN_STRUCT, 'VisitAssign'),
+        (_IR_RETURN_STRUCT, 'VisitReturn'),
+        (_IR_COLLECT_STRUCT, 'VisitCollect'),
+        (_IR_APPLY_STRUCT, 'VisitApply'),
+        (_IR_CMP_STRUCT, 'VisitCmp'),
+        (_IR_IF_STRUCT, 'VisitIf'),
+        (_IR_INT_STRUCT, 'VisitInt'),
+        (_IR_VAR_STRUCT, 'VisitVar'),
+        (_IR_BOOL_STRUCT, 'VisitBool'),
+        (_IR_VOID_STRUCT, 'VisitVoid'),
+        (_IR_VECTOR_REF_STRUCT, 'VisitVectorRef'),
+        (_IR_VECTOR_SET_STRUCT, 'VisitVectorSet'),
+        (_IR_ALLOCATE_STRUCT, 'VisitAllocate'),
+        (_IR_GLOBAL_VALUE_STRUCT, 'VisitGlobalValue'),
+    )
 
     def Visit(self, node):
         self._BeginVisit()
@@ -279,47 +305,15 @@ class IrAstVisitorBase(object):
         pass
 
     def _Visit(self, node):
-        try:
-            assert LangOf(node) == IR_LANG
-        except AssertionError:
-            import pdb
-            pdb.set_trace()
-
-        ndtype = TypeOf(node)
-        result = None
+        if IsAstVisitorDebug():
+            assert LangOf(node) == IR_LANG, \
+                'lang={}, type={}, node={}'.format(
+                    LangOf(node), TypeOf(node), str(node))
+        visit_fn = self._visit_table.get(StructureOf(node))
+        if visit_fn is None:
+            raise RuntimeError("Unknown IR node type={}".format(TypeOf(node)))
         self._PreVisitNode(node)
-        if ndtype == PROGRAM_NODE_T:
-            result = self.VisitProgram(node)
-        elif ndtype == IR_ASSIGN_NODE_T:
-            result = self.VisitAssign(node)
-        elif ndtype == IR_RETURN_NODE_T:
-            result = self.VisitReturn(node)
-        elif ndtype == INTERNAL_COLLECT_NODE_T:
-            result = self.VisitCollect(node)
-        elif ndtype == APPLY_NODE_T:
-            result = self.VisitApply(node)
-        elif ndtype == IR_CMP_NODE_T:
-            result = self.VisitCmp(node)
-        elif ndtype == IF_NODE_T:
-            result = self.VisitIf(node)
-        elif ndtype == INT_NODE_T:
-            result = self.VisitInt(node)
-        elif ndtype == VAR_NODE_T:
-            result = self.VisitVar(node)
-        elif ndtype == BOOL_NODE_T:
-            result = self.VisitBool(node)
-        elif ndtype == VOID_NODE_T:
-            result = self.VisitVoid(node)
-        elif ndtype == VECTOR_REF_NODE_T:
-            result = self.VisitVectorRef(node)
-        elif ndtype == VECTOR_SET_NODE_T:
-            result = self.VisitVectorSet(node)
-        elif ndtype == INTERNAL_ALLOCATE_NODE_T:
-            result = self.VisitAllocate(node)
-        elif ndtype == INTERNAL_GLOBAL_VALUE_NODE_T:
-            result = self.VisitGlobalValue(node)
-        else:
-            raise RuntimeError("Unknown IR node type={}".format(ndtype))
+        result = visit_fn(self, node)
         self._PostVisitNode(node, result)
         return result
 
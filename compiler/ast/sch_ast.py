@@ -17,28 +17,42 @@ _SCH_FUNC_P_NAME = 'func_name'
 _SCH_FUNC_P_PARAMS = 'func_params'
 _SCH_FUNC_P_BODY = 'func_body'
 
-_NODE_TC = TypeChain(NODE_T, None)
-_EXPR_TC = TypeChain(EXPR_NODE_T, _NODE_TC)
+_NODE_TC = MakeTypeChain(NODE_T, None)
+_EXPR_TC = MakeTypeChain(EXPR_NODE_T, _NODE_TC)
 
 
-def _MakeSchNode(type, parent_tc):
-  return MakeAstNode(type, parent_tc, SCH_LANG)
+def _SchStructure(type, parent_tc):
+  return MakeAstNodeStructure(type, parent_tc, SCH_LANG)
 
 
-def _MakeSchExprNode(type):
-  return _MakeSchNode(type, _EXPR_TC)
+_SCH_LAMBDA_STRUCT = _SchStructure(SCH_LAMBDA_NODE_T, _EXPR_TC)
+_SCH_FUNC_DEFINE_STRUCT = _SchStructure(SCH_FUNC_DEFINE_NODE_T, _NODE_TC)
+_SCH_INT_STRUCT = _SchStructure(INT_NODE_T, _EXPR_TC)
+_SCH_VAR_STRUCT = _SchStructure(VAR_NODE_T, _EXPR_TC)
+_SCH_BOOL_STRUCT = _SchStructure(BOOL_NODE_T, _EXPR_TC)
+_SCH_VOID_STRUCT = _SchStructure(VOID_NODE_T, _EXPR_TC)
+_SCH_APPLY_STRUCT = _SchStructure(APPLY_NODE_T, _EXPR_TC)
+_SCH_LET_STRUCT = _SchStructure(SCH_LET_NODE_T, _EXPR_TC)
+_SCH_PROGRAM_STRUCT = _SchStructure(PROGRAM_NODE_T, _NODE_TC)
+_SCH_IF_STRUCT = _SchStructure(IF_NODE_T, _EXPR_TC)
+_SCH_VECTOR_INIT_STRUCT = _SchStructure(VECTOR_INIT_NODE_T, _EXPR_TC)
+_SCH_VECTOR_REF_STRUCT = _SchStructure(VECTOR_REF_NODE_T, _EXPR_TC)
+_SCH_VECTOR_SET_STRUCT = _SchStructure(VECTOR_SET_NODE_T, _EXPR_TC)
+_SCH_COLLECT_STRUCT = _SchStructure(INTERNAL_COLLECT_NODE_T, _EXPR_TC)
+_SCH_ALLOCATE_STRUCT = _SchStructure(INTERNAL_ALLOCATE_NODE_T, _EXPR_TC)
+_SCH_GLOBAL_VALUE_STRUCT = _SchStructure(INTERNAL_GLOBAL_VALUE_NODE_T, _EXPR_TC)
 
 
 def MakeSchLambdaNode(params, body):
   assert isinstance(params, list)
-  node = _MakeSchExprNode(SCH_LAMBDA_NODE_T)
+  node = NewAstNode(_SCH_LAMBDA_STRUCT)
   SetProperty(node, _SCH_FUNC_P_PARAMS, params)
   SetProperty(node, _SCH_FUNC_P_BODY, body)
   return node
 
 
 def IsSchLambdaNode(node):
-  return LangOf(node) == SCH_LANG and TypeOf(node) == SCH_LAMBDA_NODE_T
+  return StructureOf(node) is _SCH_LAMBDA_STRUCT
 
 
 def GetSchLambdaParams(node):
@@ -64,7 +78,7 @@ def SetSchLambdaBody(node, body):
 def MakeSchFuncDefineNode(name, params, body):
   assert IsSchVarNode(name)
   assert isinstance(params, list), params
-  node = _MakeSchNode(SCH_FUNC_DEFINE_NODE_T, _NODE_TC)
+  node = NewAstNode(_SCH_FUNC_DEFINE_STRUCT)
   SetProperty(node, _SCH_FUNC_P_NAME, name)
   SetProperty(node, _SCH_FUNC_P_PARAMS, params)
   SetProperty(node, _SCH_FUNC_P_BODY, body)
@@ -72,7 +86,7 @@ def MakeSchFuncDefineNode(name, params, body):
 
 
 def IsSchFuncDefineNode(node):
-  return LangOf(node) == SCH_LANG and TypeOf(node) == SCH_FUNC_DEFINE_NODE_T
+  return StructureOf(node) is _SCH_FUNC_DEFINE_STRUCT
 
 
 def GetSchFuncDefineName(node):
@@ -106,33 +120,37 @@ def SetSchFuncDefineBody(node, body):
 
 
 def MakeSchIntNode(x):
-  node = _MakeSchExprNode(INT_NODE_T)
+  node = NewAstNode(_SCH_INT_STRUCT)
   SetProperty(node, INT_P_X, x)
   return node
 
 
 def IsSchIntNode(node):
-  return LangOf(node) == SCH_LANG and TypeOf(node) == INT_NODE_T
+  return StructureOf(node) is _SCH_INT_STRUCT
 
 
 def MakeSchVarNode(var):
-  node = _MakeSchExprNode(VAR_NODE_T)
+  node = NewAstNode(_SCH_VAR_STRUCT)
   SetProperty(node, NODE_P_VAR, var)
   return node
 
 
 def IsSchVarNode(node):
-  return LangOf(node) == SCH_LANG and TypeOf(node) == VAR_NODE_T
+  return StructureOf(node) is _SCH_VAR_STRUCT
 
 
 def MakeSchBoolNode(b):
-  node = _MakeSchExprNode(BOOL_NODE_T)
+  node = NewAstNode(_SCH_BOOL_STRUCT)
   SetProperty(node, NODE_P_BOOL, b)
   return node
 
 
+def IsSchBoolNode(node):
+  return StructureOf(node) is _SCH_BOOL_STRUCT
+
+
 def MakeSchVoidNode():
-  node = _MakeSchExprNode(VOID_NODE_T)
+  node = NewAstNode(_SCH_VOID_STRUCT)
   return node
 
 
@@ -141,18 +159,18 @@ def IsBinLogicalOp(op):
 
 
 def MakeSchApplyNode(method, expr_list):
-  node = _MakeSchExprNode(APPLY_NODE_T)
+  node = NewAstNode(_SCH_APPLY_STRUCT)
   SetProperties(node, {P_METHOD: method, _SCH_APPLY_P_EXPR_LIST: expr_list})
   return node
 
 
 def GetSchApplyExprList(node):
-  assert LangOf(node) == SCH_LANG and TypeOf(node) == APPLY_NODE_T
+  assert StructureOf(node) is _SCH_APPLY_STRUCT
   return GetProperty(node, _SCH_APPLY_P_EXPR_LIST)
 
 
 def SetSchApplyExprList(node, expr_list):
-  assert LangOf(node) == SCH_LANG and TypeOf(node) == APPLY_NODE_T
+  assert StructureOf(node) is _SCH_APPLY_STRUCT
   SetProperty(node, _SCH_APPLY_P_EXPR_LIST, expr_list)
 
 
@@ -174,19 +192,19 @@ def IsSchRtmFn(method):
 
 
 def MakeSchLetNode(var_list, let_body):
-  node = _MakeSchExprNode(SCH_LET_NODE_T)
+  node = NewAstNode(_SCH_LET_STRUCT)
   SetProperty(node, P_VAR_LIST, var_list)
   SetProperty(node, _SCH_LET_P_LET_BODY, let_body)
   return node
 
 
 def GetSchLetBody(node):
-  assert LangOf(node) == SCH_LANG and TypeOf(node) == SCH_LET_NODE_T
+  assert StructureOf(node) is _SCH_LET_STRUCT
   return GetProperty(node, _SCH_LET_P_LET_BODY)
 
 
 def SetSchLetBody(node, let_body):
-  assert LangOf(node) == SCH_LANG and TypeOf(node) == SCH_LET_NODE_T
+  assert StructureOf(node) is _SCH_LET_STRUCT
   SetProperty(node, _SCH_LET_P_LET_BODY, let_body)
 
 
@@ -194,14 +212,14 @@ def MakeSchProgramNode(func_def_list, body):
   assert isinstance(func_def_list, list)
   assert LangOf(body) == SCH_LANG and \
       ParentOf(body).type == EXPR_NODE_T, ParentOf(body).type
-  node = _MakeSchNode(PROGRAM_NODE_T, _NODE_TC)
+  node = NewAstNode(_SCH_PROGRAM_STRUCT)
   SetProperty(node, _SCH_PROGRAM_P_FUNC_DEF_LIST, func_def_list)
   SetProperty(node, _SCH_PROGRAM_P_BODY, body)
   return node
 
 
 def IsSchProgramNode(node):
-  return LangOf(node) == SCH_LANG and TypeOf(node) == PROGRAM_NODE_T
+  return StructureOf(node) is _SCH_PROGRAM_STRUCT
 
 
 def GetSchProgramFuncDefList(node):
@@ -229,7 +247,7 @@ def SetSchProgram(node, body):
 
 
 def MakeSchIfNode(cond, then, els):
-  node = _MakeSchExprNode(IF_NODE_T)
+  node = NewAstNode(_SCH_IF_STRUCT)
   SetProperty(node, IF_P_COND, cond)
   SetProperty(node, IF_P_THEN, then)
   SetProperty(node, IF_P_ELSE, els)
@@ -237,17 +255,17 @@ def MakeSchIfNode(cond, then, els):
 
 
 def IsSchIfNode(node):
-  return LangOf(node) == SCH_LANG and TypeOf(node) == IF_NODE_T
+  return StructureOf(node) is _SCH_IF_STRUCT
 
 
 def MakeSchVectorInitNode(arg_list):
-  node = _MakeSchExprNode(VECTOR_INIT_NODE_T)
+  node = NewAstNode(_SCH_VECTOR_INIT_STRUCT)
   SetProperty(node, P_ARG_LIST, arg_list)
   return node
 
 
 def IsSchVectorInitNode(node):
-  return LangOf(node) == SCH_LANG and TypeOf(node) == VECTOR_INIT_NODE_T
+  return StructureOf(node) is _SCH_VECTOR_INIT_STRUCT
 
 
 def GetSchVectorInitNodeLen(node):
@@ -262,19 +280,19 @@ def GetSchVectorInitNodeBytes(node):
 
 def MakeSchVectorRefNode(vec, idx):
   assert isinstance(idx, int)
-  node = _MakeSchExprNode(VECTOR_REF_NODE_T)
+  node = NewAstNode(_SCH_VECTOR_REF_STRUCT)
   SetProperty(node, VECTOR_P_VEC, vec)
   SetProperty(node, VECTOR_P_INDEX, idx)
   return node
 
 
 def IsSchVectorRefNode(node):
-  return LangOf(node) == SCH_LANG and TypeOf(node) == VECTOR_REF_NODE_T
+  return StructureOf(node) is _SCH_VECTOR_REF_STRUCT
 
 
 def MakeSchVectorSetNode(vec, idx, val):
   assert isinstance(idx, int)
-  node = _MakeSchExprNode(VECTOR_SET_NODE_T)
+  node = NewAstNode(_SCH_VECTOR_SET_STRUCT)
   SetProperty(node, VECTOR_P_VEC, vec)
   SetProperty(node, VECTOR_P_INDEX, idx)
   SetProperty(node, VECTOR_SET_P_VAL, val)
@@ -282,43 +300,42 @@ def MakeSchVectorSetNode(vec, idx, val):
 
 
 def IsSchVectorSetNode(node):
-  return LangOf(node) == SCH_LANG and TypeOf(node) == VECTOR_SET_NODE_T
+  return StructureOf(node) is _SCH_VECTOR_SET_STRUCT
 
 
 def MakeSchInternalCollectNode(bytes):
   assert isinstance(bytes, int)
-  node = _MakeSchExprNode(INTERNAL_COLLECT_NODE_T)
+  node = NewAstNode(_SCH_COLLECT_STRUCT)
   SetProperty(node, COLLECT_P_BYTES, bytes)
   SetNodeStaticType(node, StaticTypes.VOID)
   return node
 
 
 def IsSchInternalCollectNode(node):
-  return LangOf(node) == SCH_LANG and TypeOf(node) == INTERNAL_COLLECT_NODE_T
+  return StructureOf(node) is _SCH_COLLECT_STRUCT
 
 
 def MakeSchInternalAllocateNode(len, static_type):
   assert isinstance(len, int)
-  node = _MakeSchExprNode(INTERNAL_ALLOCATE_NODE_T)
+  node = NewAstNode(_SCH_ALLOCATE_STRUCT)
   SetProperty(node, ALLOCATE_P_LEN, len)
   SetNodeStaticType(node, static_type)
   return node
 
 
 def IsSchInternalAllocateNode(node):
-  return LangOf(node) == SCH_LANG and TypeOf(node) == INTERNAL_ALLOCATE_NODE_T
+  return StructureOf(node) is _SCH_ALLOCATE_STRUCT
 
 
 def MakeSchInternalGlobalValueNode(name):
-  node = _MakeSchExprNode(INTERNAL_GLOBAL_VALUE_NODE_T)
+  node = NewAstNode(_SCH_GLOBAL_VALUE_STRUCT)
   SetProperty(node, GLOBAL_VALUE_P_NAME, name)
   SetNodeStaticType(node, StaticTypes.INT)
   return node
 
 
 def IsSchInternalGlobalValueNode(node):
-  return LangOf(node) == SCH_LANG and TypeOf(
-      node) == INTERNAL_GLOBAL_VALUE_NODE_T
+  return StructureOf(node) is _SCH_GLOBAL_VALUE_STRUCT
 
 
 def SchRtmFns():
@@ -348,6 +365,26 @@ def IsSchCmpOp(op):
 
 
 class SchAstVisitorBase(object):
+  __metaclass__ = AstVisitorMeta
+
+  _VISIT_METHODS = (
+      (_SCH_PROGRAM_STRUCT, 'VisitProgram'),
+      (_SCH_APPLY_STRUCT, 'VisitApply'),
+      (_SCH_LET_STRUCT, 'VisitLet'),
+      (_SCH_IF_STRUCT, 'VisitIf'),
+      (_SCH_VECTOR_INIT_STRUCT, 'VisitVectorInit'),
+      (_SCH_VECTOR_REF_STRUCT, 'VisitVectorRef'),
+      (_SCH_VECTOR_SET_STRUCT, 'VisitVectorSet'),
+      (_SCH_INT_STRUCT, 'VisitInt'),
+      (_SCH_VAR_STRUCT, 'VisitVar'),
+      (_SCH_BOOL_STRUCT, 'VisitBool'),
+      (_SCH_VOID_STRUCT, 'VisitVoid'),
+      (_SCH_COLLECT_STRUCT, 'VisitInternalCollect'),
+      (_SCH_ALLOCATE_STRUCT, 'VisitInternalAllocate'),
+      (_SCH_GLOBAL_VALUE_STRUCT, 'VisitInternalGlobalValue'),
+      (_SCH_FUNC_DEFINE_STRUCT, 'VisitFuncDefine'),
+      (_SCH_LAMBDA_STRUCT, 'VisitLambda'),
+  )
 
   def Visit(self, node):
     '''Do NOT override
@@ -379,44 +416,13 @@ class SchAstVisitorBase(object):
   def _Visit(self, node):
     '''Do NOT override
     '''
-    assert LangOf(node) == SCH_LANG, LangOf(node)
-    ndtype = TypeOf(node)
-    result = None
+    if IsAstVisitorDebug():
+      assert LangOf(node) == SCH_LANG, LangOf(node)
+    visit_fn = self._visit_table.get(StructureOf(node))
+    if visit_fn is None:
+      raise RuntimeError("Unknown Scheme node type={}".format(TypeOf(node)))
     self._PreVisitNode(node)
-    if ndtype == PROGRAM_NODE_T:
-      result = self.VisitProgram(node)
-    elif ndtype == APPLY_NODE_T:
-      result = self.VisitApply(node)
-    elif ndtype == SCH_LET_NODE_T:
-      result = self.VisitLet(node)
-    elif ndtype == IF_NODE_T:
-      result = self.VisitIf(node)
-    elif ndtype == VECTOR_INIT_NODE_T:
-      result = self.VisitVectorInit(node)
-    elif ndtype == VECTOR_REF_NODE_T:
-      result = self.VisitVectorRef(node)
-    elif ndtype == VECTOR_SET_NODE_T:
-      result = self.VisitVectorSet(node)
-    elif ndtype == INT_NODE_T:
-      result = self.VisitInt(node)
-    elif ndtype == VAR_NODE_T:
-      result = self.VisitVar(node)
-    elif ndtype == BOOL_NODE_T:
-      result = self.VisitBool(node)
-    elif ndtype == VOID_NODE_T:
-      result = self.VisitVoid(node)
-    elif ndtype == INTERNAL_COLLECT_NODE_T:
-      result = self.VisitInternalCollect(node)
-    elif ndtype == INTERNAL_ALLOCATE_NODE_T:
-      result = self.VisitInternalAllocate(node)
-    elif ndtype == INTERNAL_GLOBAL_VALUE_NODE_T:
-      result = self.VisitInternalGlobalValue(node)
-    elif ndtype == SCH_FUNC_DEFINE_NODE_T:
-      result = self.VisitFuncDefine(node)
-    elif ndtype == SCH_LAMBDA_NODE_T:
-      result = self.VisitLambda(node)
-    else:
-      raise RuntimeError("Unknown Scheme node type={}".format(ndtype))
+    result = visit_fn(self, node)
     self._PostVisitNode(node, result)
     return result
 
@@ -28,24 +28,39 @@ _X86_SI_RET_P_ARG = 'ret_arg'
 _X86_P_FORMATTER = 'formatter'
 _X86_PROGRAM_P_STACK_SZ = 'stack_sz'
 _X86_PROGRAM_P_ROOTSTACK_SZ = 'rootstack_sz'
+_X86_PROGRAM_P_CALLEE_SAVED = 'callee_saved_regs'
 _X86_PROGRAM_P_INSTR_LIST = 'instr_list'
 _X86_PROGRAM_P_LIVE = 'live_afters'
+_X86_PROGRAM_P_LIVE_VAR_NAMES = 'live_var_names'
+_X86_PROGRAM_P_REWRITE_COUNTS = 'rewrite_counts'
+_X86_PROGRAM_P_NUM_SPILLED = 'num_spilled_vars'
 _X86_INSTR_P_INSTR = 'instr'
 _X86_INSTR_P_OPERAND_LIST = 'operand_list'
 _X86_P_REG = 'reg'
 _X86_DEREF_P_OFFSET = 'offset'
 _X86_LABEL_P_LABEL = 'label'
 
-_NODE_TC = TypeChain(NODE_T, None)
-_ARG_TC = TypeChain(ARG_NODE_T, _NODE_TC)
+_NODE_TC = MakeTypeChain(NODE_T, None)
+_ARG_TC = MakeTypeChain(ARG_NODE_T, _NODE_TC)
 
 
-def _MakeX86Node(type, parent_tc):
-    return MakeAstNode(type, parent_tc, X86_LANG)
+def _X86Structure(type, parent_tc):
+    return MakeAstNodeStructure(type, parent_tc, X86_LANG)
 
 
-def _MakeX86ArgNode(type):
-    return _MakeX86Node(type, _ARG_TC)
+_X86_PROGRAM_STRUCT = _X86Structure(PROGRAM_NODE_T, _NODE_TC)
+_X86_INSTR_STRUCT = _X86Structure(X86_INSTR_NODE_T, _NODE_TC)
+_X86_INT_STRUCT = _X86Structure(INT_NODE_T, _ARG_TC)
+_X86_REG_STRUCT = _X86Structure(X86_REG_NODE_T, _ARG_TC)
+_X86_BYTE_REG_STRUCT = _X86Structure(X86_BYTE_REG_NODE_T, _ARG_TC)
+_X86_DEREF_STRUCT = _X86Structure(X86_DEREF_NODE_T, _ARG_TC)
+_X86_VAR_STRUCT = _X86Structure(VAR_NODE_T, _ARG_TC)
+_X86_GLOBAL_VALUE_STRUCT = _X86Structure(INTERNAL_GLOBAL_VALUE_NODE_T, _ARG_TC)
+_X86_LABEL_DEF_STRUCT = _X86Structure(X86_LABEL_DEF_NODE_T, _NODE_TC)
+_X86_LABEL_REF_STRUCT = _X86Structure(X86_LABEL_REF_NODE_T, _ARG_TC)
+_X86_TMP_IF_STRUCT = _X86Structure(X86_TMP_IF_NODE_T, _NODE_TC)
+_X86_CALLC_STRUCT = _X86Structure(X86_CALLC_NODE_T, _NODE_TC)
+_X86_SI_RET_STRUCT = _X86Structure(X86_SI_RET_NODE_T, _NODE_TC)
 
 
 def IsX86Node(node):
@@ -53,18 +68,25 @@ def IsX86Node(node):
 
 
 def MakeX86ProgramNode(var_list, instr_list):
-    node = _MakeX86Node(PROGRAM_NODE_T, _NODE_TC)
+    node = NewAstNode(_X86_PROGRAM_STRUCT)
     # stack_sz = stack_sz if stack_sz < 0 else RoundupStackSize(stack_sz)
     SetProperty(node, _X86_PROGRAM_P_STACK_SZ, -1)
     SetProperty(node, _X86_PROGRAM_P_ROOTSTACK_SZ, -1)
+    SetProperty(node, _X86_PROGRAM_P_CALLEE_SAVED, [])
     SetProperty(node, P_VAR_LIST, var_list)
     SetProperty(node, _X86_PROGRAM_P_INSTR_LIST, instr_list)
-    SetProperty(node, _X86_PROGRAM_P_LIVE, [])
+    # not computed yet, see X86ProgramHasLiveAfters()
+    SetProperty(node, _X86_PROGRAM_P_LIVE, None)
+    SetProperty(node, _X86_PROGRAM_P_LIVE_VAR_NAMES, None)
+    # only set by the Peephole pass
+    SetProperty(node, _X86_PROGRAM_P_REWRITE_COUNTS, None)
+    # only set by the AllocateRegisterOrStack pass
+    SetProperty(node, _X86_PROGRAM_P_NUM_SPILLED, None)
     return node
 
 
 def IsX86ProgramNode(node):
-    return IsX86Node(node) and TypeOf(node) == PROGRAM_NODE_T
+    return StructureOf(node) is _X86_PROGRAM_STRUCT
 
 
 def _RoundupStackSize(stack_sz):
@@ -93,6 +115,20 @@ def SetX86ProgramRootstackSize(node, rootstack_sz):
     SetProperty(node, _X86_PROGRAM_P_ROOTSTACK_SZ, rootstack_sz)
 
 
+def GetX86ProgramCalleeSavedRegs(node):
+    assert IsX86ProgramNode(node)
+    return GetProperty(node, _X86_PROGRAM_P_CALLEE_SAVED)
+
+
+def SetX86ProgramCalleeSavedRegs(node, regs):
+    '''
+    regs: a list of the callee save registers used by the program, which
+          must be saved in the prologue and restored in the epilogue.
+    '''
+    assert IsX86ProgramNode(node)
+    SetProperty(node, _X86_PROGRAM_P_CALLEE_SAVED, regs)
+
+
 def GetX86ProgramInstrList(node):
     assert IsX86ProgramNode(node)
     return GetProperty(node, _X86_PROGRAM_P_INSTR_LIST)
@@ -101,6 +137,20 @@ def GetX86ProgramInstrList(node):
 def SetX86ProgramInstrList(node, instr_list):
     assert IsX86ProgramNode(node)
     SetProperty(node, _X86_PROGRAM_P_INSTR_LIST, instr_list)
+    # the live afters belong to the old instructions
+    SetProperty(node, _X86_PROGRAM_P_LIVE, None)
+    SetProperty(node, _X86_PROGRAM_P_LIVE_VAR_NAMES, None)
+
+
+def X86ProgramHasLiveAfters(node):
+    '''
+    Returns True if the live afters are computed for the current instruction
+    list of |node|.
+    '''
+    assert IsX86ProgramNode(node)
+    live_afters = GetProperty(node, _X86_PROGRAM_P_LIVE)
+    return live_afters is not None and \
+        len(live_afters) == len(GetX86ProgramInstrList(node))
 
 
 def GetX86ProgramLiveAfters(node):
@@ -113,15 +163,56 @@ def SetX86ProgramLiveAfters(node, live_afters):
     SetProperty(node, _X86_PROGRAM_P_LIVE, live_afters)
 
 
+def GetX86ProgramLiveVarNames(node):
+    assert IsX86ProgramNode(node)
+    return GetProperty(node, _X86_PROGRAM_P_LIVE_VAR_NAMES)
+
+
+def SetX86ProgramLiveVarNames(node, var_names):
+    '''
+    var_names: a list of the variable names. A live after set is an int,
+               whose bit i is set if var_names[i] is live.
+    '''
+    assert IsX86ProgramNode(node)
+    SetProperty(node, _X86_PROGRAM_P_LIVE_VAR_NAMES, var_names)
+
+
+def GetX86ProgramRewriteCounts(node):
+    assert IsX86ProgramNode(node)
+    return GetProperty(node, _X86_PROGRAM_P_REWRITE_COUNTS)
+
+
+def SetX86ProgramRewriteCounts(node, rewrite_counts):
+    '''
+    rewrite_counts: a dict of peephole rule name => the number of rewrites.
+    '''
+    assert IsX86ProgramNode(node)
+    SetProperty(node, _X86_PROGRAM_P_REWRITE_COUNTS, rewrite_counts)
+
+
+def GetX86ProgramNumSpilledVars(node):
+    assert IsX86ProgramNode(node)
+    return GetProperty(node, _X86_PROGRAM_P_NUM_SPILLED)
+
+
+def SetX86ProgramNumSpilledVars(node, num_spilled_vars):
+    '''
+    num_spilled_vars: the number of variables allocated on the stack or the
+                      rootstack rather than in a register.
+    '''
+    assert IsX86ProgramNode(node)
+    SetProperty(node, _X86_PROGRAM_P_NUM_SPILLED, num_spilled_vars)
+
+
 def MakeX86InstrNode(instr, *operands):
-    node = _MakeX86Node(X86_INSTR_NODE_T, _NODE_TC)
+    node = NewAstNode(_X86_INSTR_STRUCT)
     SetProperty(node, _X86_INSTR_P_INSTR, instr)
     SetProperty(node, _X86_INSTR_P_OPERAND_LIST, [o for o in operands])
     return node
 
 
 def IsX86InstrNode(node):
-    return IsX86Node(node) and TypeOf(node) == X86_INSTR_NODE_T
+    return StructureOf(node) is _X86_INSTR_STRUCT
 
 
 def GetX86Instr(node):
@@ -149,23 +240,24 @@ def GetX86InstrArity(node):
 
 
 def MakeX86IntNode(x):
-    node = _MakeX86ArgNode(INT_NODE_T)
+    node = NewAstNode(_X86_INT_STRUCT)
     SetProperty(node, INT_P_X, x)
     return node
 
 
 def IsX86IntNode(node):
-    return IsX86Node(node) and TypeOf(node) == INT_NODE_T
+    return StructureOf(node) is _X86_INT_STRUCT
 
 
 def MakeX86RegNode(reg):
-    node = _MakeX86ArgNode(X86_REG_NODE_T)
+    node = NewAstNode(_X86_REG_STRUCT)
     SetProperty(node, _X86_P_REG, reg)
     return node
 
 
 def IsX86RegNode(node):
-    return IsX86Node(node) and TypeOf(node) in {X86_REG_NODE_T, X86_BYTE_REG_NODE_T}
+    structure = StructureOf(node)
+    return structure is _X86_REG_STRUCT or structure is _X86_BYTE_REG_STRUCT
 
 
 def GetX86Reg(node):
@@ -181,69 +273,69 @@ def SetX86Reg(node, reg):
 
 
 def MakeX86ByteRegNode(reg):
-    node = _MakeX86ArgNode(X86_BYTE_REG_NODE_T)
+    node = NewAstNode(_X86_BYTE_REG_STRUCT)
     SetProperty(node, _X86_P_REG, reg)
     return node
 
 
 def IsX86ByteRegNode(node):
-    return IsX86Node(node) and TypeOf(node) == X86_BYTE_REG_NODE_T
+    return StructureOf(node) is _X86_BYTE_REG_STRUCT
 
 
 def MakeX86DerefNode(reg, offset):
-    node = _MakeX86ArgNode(X86_DEREF_NODE_T)
+    node = NewAstNode(_X86_DEREF_STRUCT)
     SetProperty(node, _X86_P_REG, reg)
     SetProperty(node, _X86_DEREF_P_OFFSET, offset)
     return node
 
 
 def IsX86DerefNode(node):
-    return IsX86Node(node) and TypeOf(node) == X86_DEREF_NODE_T
+    return StructureOf(node) is _X86_DEREF_STRUCT
 
 
 def GetX86DerefOffset(node):
-    assert LangOf(node) == X86_LANG and TypeOf(node) == X86_DEREF_NODE_T
+    assert StructureOf(node) is _X86_DEREF_STRUCT
     return GetProperty(node, _X86_DEREF_P_OFFSET)
 
 
 def SetX86DerefOffset(node, offset):
-    assert LangOf(node) == X86_LANG and TypeOf(node) == X86_DEREF_NODE_T
+    assert StructureOf(node) is _X86_DEREF_STRUCT
     SetProperty(node, _X86_DEREF_P_OFFSET, offset)
 
 
 def MakeX86VarNode(var):
-    node = _MakeX86ArgNode(VAR_NODE_T)
+    node = NewAstNode(_X86_VAR_STRUCT)
     SetProperty(node, NODE_P_VAR, var)
     return node
 
 
 def IsX86VarNode(node):
-    return IsX86Node(node) and TypeOf(node) == VAR_NODE_T
+    return StructureOf(node) is _X86_VAR_STRUCT
 
 
 def MakeX86GlobalValueNode(name):
-    node = _MakeX86ArgNode(INTERNAL_GLOBAL_VALUE_NODE_T)
+    node = NewAstNode(_X86_GLOBAL_VALUE_STRUCT)
     SetProperty(node, GLOBAL_VALUE_P_NAME, name)
     SetNodeStaticType(node, StaticTypes.INT)
     return node
 
 
 def IsX86GlobalValueNode(node):
-    return IsX86Node(node) and TypeOf(node) == INTERNAL_GLOBAL_VALUE_NODE_T
+    return StructureOf(node) is _X86_GLOBAL_VALUE_STRUCT
 
 
 def MakeX86LabelDefNode(label):
-    node = _MakeX86Node(X86_LABEL_DEF_NODE_T, _NODE_TC)
+    node = NewAstNode(_X86_LABEL_DEF_STRUCT)
     SetProperty(node, _X86_LABEL_P_LABEL, label)
     return node
 
 
 def IsX86LabelDefNode(node):
-    return LangOf(node) == X86_LANG and TypeOf(node) == X86_LABEL_DEF_NODE_T
+    return StructureOf(node) is _X86_LABEL_DEF_STRUCT
 
 
 def MakeX86LabelRefNode(label):
-    node = _MakeX86ArgNode(X86_LABEL_REF_NODE_T)
+    node = NewAstNode(_X86_LABEL_REF_STRUCT)
     SetProperty(node, _X86_LABEL_P_LABEL, label)
     return node
 
@@ -267,7 +359,7 @@ _X86_TMP_IF_P_ELSE_LA = 'else_la'
 
 
 def MakeX86TmpIfNode(then, els):
-    node = _MakeX86Node(X86_TMP_IF_NODE_T, _NODE_TC)
+    node = NewAstNode(_X86_TMP_IF_STRUCT)
     SetProperty(node, _X86_TMP_IF_P_THEN, then)
     SetProperty(node, _X86_TMP_IF_P_ELSE, els)
     SetProperty(node, _X86_TMP_IF_P_THEN_LA, None)
@@ -276,7 +368,7 @@ def MakeX86TmpIfNode(then, els):
 
 
 def IsX86TmpIfNode(node):
-    return LangOf(node) == X86_LANG and TypeOf(node) == X86_TMP_IF_NODE_T
+    return StructureOf(node) is _X86_TMP_IF_STRUCT
 
 
 def GetX86TmpIfThen(node):
@@ -325,13 +417,13 @@ def SetX86TmpIfElseLiveAfter(node, else_la):
 
 def MakeX86CallCNode(logue):
     assert logue in {X86_CALLC_PROLOGUE, X86_CALLC_EPILOGUE}
-    node = _MakeX86Node(X86_CALLC_NODE_T, _NODE_TC)
+    node = NewAstNode(_X86_CALLC_STRUCT)
     SetProperty(node, _X86_CALLC_P_LOGUE, logue)
     return node
 
 
 def IsX86CallCNode(node):
-    return IsX86Node(node) and TypeOf(node) == X86_CALLC_NODE_T
+    return StructureOf(node) is _X86_CALLC_STRUCT
 
 
 def GetX86CallCLogue(node):
@@ -341,14 +433,14 @@ def GetX86CallCLogue(node):
 
 def MakeX86SiRetNode(from_func, ret_arg):
     assert ParentOf(ret_arg).type == ARG_NODE_T
-    node = _MakeX86Node(X86_SI_RET_NODE_T, _NODE_TC)
+    node = NewAstNode(_X86_SI_RET_STRUCT)
     SetProperty(node, _X86_SI_RET_P_FROM_FUNC, from_func)
     SetProperty(node, _X86_SI_RET_P_ARG, ret_arg)
     return node
 
 
 def IsX86SiRetNode(node):
-    return IsX86Node(node) and TypeOf(node) == X86_SI_RET_NODE_T
+    return StructureOf(node) is _X86_SI_RET_STRUCT
 
 
 def GetX86SiRetFromFunc(node):
@@ -395,6 +487,23 @@ def DecodeCcFromInstr(instr):
 
 
 class X86AstVisitorBase(object):
+    __metaclass__ = AstVisitorMeta
+
+    _VISIT_METHODS = (
+        (_X86_PROGRAM_STRUCT, 'VisitProgram'),
+        (_X86_INSTR_STRUCT, 'VisitInstr'),
+        (_X86_INT_STRUCT, 'VisitInt'),
+        (_X86_VAR_STRUCT, 'VisitVar'),
+        (_X86_REG_STRUCT, 'VisitReg'),
+        (_X86_BYTE_REG_STRUCT, 'VisitByteReg'),
+        (_X86_DEREF_STRUCT, 'VisitDeref'),
+        (_X86_GLOBAL_VALUE_STRUCT, 'VisitGlobalValue'),
+        (_X86_LABEL_REF_STRUCT, 'VisitLabelRef'),
+        (_X86_LABEL_DEF_STRUCT, 'VisitLabelDef'),
+        (_X86_CALLC_STRUCT, 'VisitCallC'),
+        (_X86_SI_RET_STRUCT, 'VisitSiRet'),
+        (_X86_TMP_IF_STRUCT, 'VisitTmpIf'),
+    )
 
     def __init__(self):
         self._allow_tmp_if = False
@@ -417,40 +526,17 @@ class X86AstVisitorBase(object):
         pass
 
     def _Visit(self, node):
-        assert LangOf(node) == X86_LANG, \
-            'lang={}, type={}, node={}'.format(
-                LangOf(node), TypeOf(node), str(node))
-        ndtype = TypeOf(node)
-        result = None
+        if IsAstVisitorDebug():
+            assert LangOf(node) == X86_LANG, \
+                'lang={}, type={}, node={}'.format(
+                    LangOf(node), TypeOf(node), str(node))
+        structure = StructureOf(node)
+        visit_fn = self._visit_table.get(structure)
+        if visit_fn is None or (structure is _X86_TMP_IF_STRUCT and
+                                not self._allow_tmp_if):
+            raise RuntimeError("Unknown X86 node type={}".format(TypeOf(node)))
         self._PreVisitNode(node)
-        if ndtype == PROGRAM_NODE_T:
-            result = self.VisitProgram(node)
-        elif ndtype == X86_INSTR_NODE_T:
-            result = self.VisitInstr(node)
-        elif ndtype == INT_NODE_T:
-            result = self.VisitInt(node)
-        elif ndtype == VAR_NODE_T:
-            result = self.VisitVar(node)
-        elif ndtype == X86_REG_NODE_T:
-            result = self.VisitReg(node)
-        elif ndtype == X86_BYTE_REG_NODE_T:
-            result = self.VisitByteReg(node)
-        elif ndtype == X86_DEREF_NODE_T:
-            result = self.VisitDeref(node)
-        elif ndtype == INTERNAL_GLOBAL_VALUE_NODE_T:
-            result = self.VisitGlobalValue(node)
-        elif ndtype == X86_LABEL_REF_NODE_T:
-            result = self.VisitLabelRef(node)
-        elif ndtype == X86_LABEL_DEF_NODE_T:
-            result = self.VisitLabelDef(node)
-        elif ndtype == X86_CALLC_NODE_T:
-            result = self.VisitCallC(node)
-        elif ndtype == X86_SI_RET_NODE_T:
-            result = self.VisitSiRet(node)
-        elif ndtype == X86_TMP_IF_NODE_T and self._allow_tmp_if:
-            result = self.VisitTmpIf(node)
-        else:
-            raise RuntimeError("Unknown X86 node type={}".format(ndtype))
+        result = visit_fn(self, node)
         self._PostVisitNode(node, result)
         return result
 
@@ -601,6 +687,8 @@ class X86InternalFormatter(object):
 
     def __init__(self, include_live_afters=False):
         self.include_live_afters = include_live_afters
+        # set by FormatProgram, to decode the live after bitsets
+        self._live_var_names = None
 
     def AddArg(self, t, arg, builder):
         if t == X86_DEREF_NODE_T:
@@ -636,6 +724,7 @@ class X86InternalFormatter(object):
         builder.NewLine()
         instr_list = GetX86ProgramInstrList(node)
         live_afters = GetX86ProgramLiveAfters(node)
+        self._live_var_names = GetX86ProgramLiveVarNames(node)
         self.FormatInstrList(instr_list, live_afters, builder, src_code_gen)
 
     def FormatInstrList(self, instr_list, live_afters, builder, src_code_gen):
@@ -649,9 +738,12 @@ class X86InternalFormatter(object):
             for i, instr in enumerate(instr_list):
                 builder.NewLine()
                 src_code_gen(instr, builder)
-                if live_afters is not None and self.include_live_afters and i < len_live_afters:
+                if live_afters is not None and self.include_live_afters and \
+                        self._live_var_names is not None and i < len_live_afters:
                     la = live_afters[i]
-                    la_str = ', '.join(la)
+                    la_str = ', '.join(name for v, name in
+                                       enumerate(self._live_var_names)
+                                       if (la >> v) & 1)
                     builder.Append(' # live_after: ( { %s } )' % la_str)
         builder.NewLine()
         builder.Append(')')
@@ -0,0 +1,173 @@
+'''Compilation cache
+A content-addressed, size-bounded on-disk cache of the compiled assembly
+code. An entry is keyed by the source code, the compiler version (a digest
+of the compiler's own source files) and the compiling options, hence a cache
+hit is always the same output a fresh compilation would produce.
+'''
+import hashlib
+import os
+import time
+
+ASM_EXT = 's'
+IR_DUMP_EXT = 'ir'
+X86_DUMP_EXT = 'x86'
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'schemepar')
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# a temporary file older than this is left by a writer that crashed
+STALE_TMP_SECONDS = 60
+_TMP_EXT = 'tmp'
+
+_compiler_version = None
+
+
+def CompilerVersion():
+    '''Returns a digest of all the compiler source files.
+    '''
+    global _compiler_version
+    if _compiler_version is None:
+        digest = hashlib.sha1()
+        root = os.path.dirname(os.path.abspath(__file__))
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                # the generated PLY tables are not part of the version
+                if not name.endswith('.py') or \
+                        name.startswith(('parsetab', 'lextab')):
+                    continue
+                path = os.path.join(dirpath, name)
+                digest.update(os.path.relpath(path, root))
+                with open(path, 'rb') as rf:
+                    digest.update(rf.read())
+        _compiler_version = digest.hexdigest()
+    return _compiler_version
+
+
+class CompileCache(object):
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        self._cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self._max_bytes = max_bytes
+        if not os.path.isdir(self._cache_dir):
+            os.makedirs(self._cache_dir)
+        # A running count of the bytes in the cache, so that only a write
+        # going over |max_bytes| scans the directory. Other processes could
+        # share the directory, hence it is only exact after an eviction.
+        self._total_bytes = sum(size for _, size in self._Entries().values())
+
+    def Key(self, source, options):
+        '''
+        source: the Scheme source code
+        options: a dict of the compiling options that affect the output
+        '''
+        digest = hashlib.sha1()
+        digest.update(CompilerVersion())
+        for k in sorted(options.keys()):
+            digest.update('\n{}={}'.format(k, options[k]))
+        digest.update('\n')
+        digest.update(source)
+        return digest.hexdigest()
+
+    def _Path(self, key, ext):
+        return os.path.join(self._cache_dir, '{}.{}'.format(key, ext))
+
+    def Get(self, key, dump_exts=()):
+        '''
+        Returns the cached assembly code of |key|, or None on a miss.
+        dump_exts: optional, the dumps the caller needs. An entry without
+                   any of them is a miss as well.
+        '''
+        path = self._Path(key, ASM_EXT)
+        try:
+            with open(path, 'r') as rf:
+                asm = rf.read()
+        except IOError:
+            return None
+        if not all(os.path.isfile(self._Path(key, ext)) for ext in dump_exts):
+            return None
+        # the modification time orders the entries for LRU eviction
+        os.utime(path, None)
+        return asm
+
+    def GetDump(self, key, ext):
+        try:
+            with open(self._Path(key, ext), 'r') as rf:
+                return rf.read()
+        except IOError:
+            return None
+
+    def Put(self, key, asm, dumps=None):
+        '''
+        dumps: optional, a dict that maps from IR_DUMP_EXT/X86_DUMP_EXT to
+               the source code of the intermediate AST.
+        '''
+        # The assembly is written last, so that a reader never sees an entry
+        # without its dumps.
+        for ext, dump in (dumps or {}).iteritems():
+            self._Write(self._Path(key, ext), dump)
+        self._Write(self._Path(key, ASM_EXT), asm)
+        if self._total_bytes > self._max_bytes:
+            self._Evict()
+
+    def _Write(self, path, content):
+        tmp_path = '{}.{}.{}'.format(path, os.getpid(), _TMP_EXT)
+        with open(tmp_path, 'w') as wf:
+            wf.write(content)
+        try:
+            # the entry is overwritten
+            self._total_bytes -= os.path.getsize(path)
+        except OSError:
+            pass
+        os.rename(tmp_path, path)
+        self._total_bytes += len(content)
+
+    def _Entries(self):
+        '''
+        Returns a dict of key => (mtime, size) of all the entries. The
+        temporary files are not a part of them.
+        '''
+        entries = {}
+        for name in os.listdir(self._cache_dir):
+            if name.endswith('.' + _TMP_EXT):
+                continue
+            path = os.path.join(self._cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            key = name.split('.')[0]
+            mtime, size = entries.get(key, (0, 0))
+            # an entry is as recent as its assembly file
+            if name.endswith('.' + ASM_EXT):
+                mtime = st.st_mtime
+            entries[key] = (mtime, size + st.st_size)
+        return entries
+
+    def _RemoveStaleTmpFiles(self):
+        # the temporary file of a live writer is renamed within seconds
+        expire = time.time() - STALE_TMP_SECONDS
+        for name in os.listdir(self._cache_dir):
+            if not name.endswith('.' + _TMP_EXT):
+                continue
+            path = os.path.join(self._cache_dir, name)
+            try:
+                if os.path.getmtime(path) < expire:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _Evict(self):
+        self._RemoveStaleTmpFiles()
+        entries = self._Entries()
+        total = sum(size for _, size in entries.values())
+        for key, (_, size) in sorted(entries.items(), key=lambda e: e[1][0]):
+            if total <= self._max_bytes:
+                break
+            for ext in (ASM_EXT, IR_DUMP_EXT, X86_DUMP_EXT):
+                try:
+                    os.remove(self._Path(key, ext))
+                except OSError:
+                    pass
+            total -= size
+        self._total_bytes = total
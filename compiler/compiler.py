@@ -1,12 +1,15 @@
 from __future__ import print_function
 
-from copy import deepcopy
+from array import array
+from contextlib import contextmanager
+import heapq
 from ast.scoped_env import ScopedEnv, ScopedEnvNode
 from ast.base import *
 from ast.sch_ast import *
 from ast.ir_ast import *
 from ast.x86_ast import *
 import x86_const as x86c
+from pass_manager import PassManager
 from utils import *
 
 
@@ -19,14 +22,223 @@ based on static information. i.e. duplicate variable definition in
 the *SAME* scope, type matching. We leave that for later excercises.
 '''
 
+'''Partial-Evaluation pass
+This pass folds the arithmetic, the comparisons and the logical operations on
+constants, picks the branch of an if on a constant condition, and propagates
+the let variables bound to a constant. The expressions that are not folded
+are kept in their evaluation order, so every `read` is still executed. An
+integer result is only folded if it fits in a 32-bit immediate.
+
+- Scheme version: R2
+'''
+
+
+class _PartialEvalScopedEnvNode(ScopedEnvNode):
+
+    def __init__(self):
+        super(_PartialEvalScopedEnvNode, self).__init__()
+        # maps a variable name to its constant value, or None if the variable
+        # is not a constant. The latter still shadows the outer variables.
+        self._local_kv = {}
+
+    def Contains(self, key):
+        return key in self._local_kv
+
+    def Get(self, key):
+        return self._local_kv[key]
+
+    def Add(self, key, value):
+        assert key not in self._local_kv
+        self._local_kv[key] = value
+
+
+def _WrapInt64(x):
+    # the runtime integers are 64-bit two's complement
+    x &= (1 << 64) - 1
+    return x - (1 << 64) if x >> 63 else x
+
+
+def _FitsInImm32(x):
+    # an X86 instruction only encodes a signed 32-bit immediate
+    return -2**31 <= x < 2**31
+
+
+def _IsSchConstNode(node):
+    return IsSchIntNode(node) or IsSchBoolNode(node)
+
+
+def _SchConstValue(node):
+    if IsSchIntNode(node):
+        return GetIntX(node)
+    return GetNodeBool(node) == '#t'
+
+
+def _MakeSchConstNode(value):
+    # bool is a subclass of int, hence it is checked first
+    if isinstance(value, bool):
+        node = MakeSchBoolNode('#t' if value else '#f')
+        SetNodeStaticType(node, StaticTypes.BOOL)
+    else:
+        node = MakeSchIntNode(_WrapInt64(value))
+        SetNodeStaticType(node, StaticTypes.INT)
+    return node
+
+
+_SCH_CMP_FNS = {
+    'eq?': lambda lhs, rhs: lhs == rhs,
+    '<': lambda lhs, rhs: lhs < rhs,
+    '<=': lambda lhs, rhs: lhs <= rhs,
+    '>': lambda lhs, rhs: lhs > rhs,
+    '>=': lambda lhs, rhs: lhs >= rhs,
+}
+
+
+class _PartialEvalVisitor(SchAstVisitorBase):
+
+    def __init__(self):
+        super(_PartialEvalVisitor, self).__init__()
+
+    def _BeginVisit(self):
+
+        class Factory(object):
+
+            def Build(self):
+                return _PartialEvalScopedEnvNode()
+
+        self._env = ScopedEnv(Factory())
+
+    def VisitProgram(self, node):
+        SetSchProgram(node, self._Visit(GetSchProgram(node)))
+        return node
+
+    def VisitApply(self, node):
+        method = GetNodeMethod(node)
+        if IsSchRtmFn(method):
+            return node
+        expr_list = [self._Visit(expr) for expr in GetSchApplyExprList(node)]
+        SetSchApplyExprList(node, expr_list)
+        if IsBinLogicalOp(method):
+            return self._FoldBinLogicalOp(node, method, *expr_list)
+        if not all(_IsSchConstNode(expr) for expr in expr_list):
+            if method == '+':
+                return self._FoldAddZero(node, *expr_list)
+            return node
+
+        values = [_SchConstValue(expr) for expr in expr_list]
+        if method in {'+', '-'}:
+            if method == '+':
+                value = _WrapInt64(values[0] + values[1])
+            else:
+                value = _WrapInt64(-values[0])
+            # a larger constant is left to be computed at runtime
+            if not _FitsInImm32(value):
+                return node
+            return _MakeSchConstNode(value)
+        elif method == 'not':
+            return _MakeSchConstNode(not values[0])
+        elif IsSchCmpOp(method):
+            return _MakeSchConstNode(_SCH_CMP_FNS[method](*values))
+        return node
+
+    def _FoldAddZero(self, node, lhs, rhs):
+        if _IsSchConstNode(lhs) and _SchConstValue(lhs) == 0:
+            return rhs
+        if _IsSchConstNode(rhs) and _SchConstValue(rhs) == 0:
+            return lhs
+        return node
+
+    def _FoldBinLogicalOp(self, node, method, lhs, rhs):
+        # |rhs| is only evaluated if |lhs| does not decide the result
+        short_circuit = method == 'or'
+        if _IsSchConstNode(lhs):
+            if _SchConstValue(lhs) == short_circuit:
+                return lhs
+            return rhs
+        # |lhs| must be evaluated anyway. If |rhs| is the constant that does
+        # not decide the result, the result is |lhs|.
+        if _IsSchConstNode(rhs) and _SchConstValue(rhs) != short_circuit:
+            return lhs
+        return node
+
+    def VisitLet(self, node):
+        var_list = [(var, self._Visit(var_init))
+                    for var, var_init in GetNodeVarList(node)]
+        with self._env.Scope():
+            new_var_list = []
+            for var, var_init in var_list:
+                if _IsSchConstNode(var_init):
+                    # every use of |var| is replaced, hence it is dropped
+                    self._env.Add(GetNodeVar(var), _SchConstValue(var_init))
+                else:
+                    self._env.Add(GetNodeVar(var), None)
+                    new_var_list.append((var, var_init))
+            let_body = self._Visit(GetSchLetBody(node))
+        if not new_var_list:
+            return let_body
+        SetNodeVarList(node, new_var_list)
+        SetSchLetBody(node, let_body)
+        return node
+
+    def VisitIf(self, node):
+        cond = self._Visit(GetIfCond(node))
+        if _IsSchConstNode(cond):
+            if _SchConstValue(cond):
+                return self._Visit(GetIfThen(node))
+            return self._Visit(GetIfElse(node))
+        SetIfCond(node, cond)
+        SetIfThen(node, self._Visit(GetIfThen(node)))
+        SetIfElse(node, self._Visit(GetIfElse(node)))
+        return node
+
+    def VisitVectorInit(self, node):
+        SetNodeArgList(node, [self._Visit(arg)
+                              for arg in GetNodeArgList(node)])
+        return node
+
+    def VisitVectorRef(self, node):
+        SetVectorNodeVec(node, self._Visit(GetVectorNodeVec(node)))
+        return node
+
+    def VisitVectorSet(self, node):
+        SetVectorNodeVec(node, self._Visit(GetVectorNodeVec(node)))
+        SetVectorSetVal(node, self._Visit(GetVectorSetVal(node)))
+        return node
+
+    def VisitInt(self, node):
+        return node
+
+    def VisitVar(self, node):
+        value = self._env.Get(GetNodeVar(node))
+        if value is None:
+            return node
+        return _MakeSchConstNode(value)
+
+    def VisitBool(self, node):
+        return node
+
+    def VisitVoid(self, node):
+        return node
+
+
+def PartialEval(ast):
+    '''
+    Folds the constant expressions of |ast|.
+    |ast|: An SchNode. In production this should be an SchProgramNode. It
+            must be analyzed, so that the static types are known.
+    '''
+    visitor = _PartialEvalVisitor()
+    return visitor.Visit(ast)
+
+
 '''Expose-Allocation pass
 '''
 
 
 class _ExposeAllocationVisitor(SchAstVisitorBase):
 
-    def __init__(self):
+    def __init__(self, gensym):
         super(_ExposeAllocationVisitor, self).__init__()
+        self._gensym = gensym
 
     def VisitProgram(self, node):
         SetSchProgram(node, self._Visit(GetSchProgram(node)))
@@ -52,20 +264,11 @@ class _ExposeAllocationVisitor(SchAstVisitorBase):
         SetIfElse(node, self._Visit(GetIfElse(node)))
         return node
 
-    def _FindUniqueVarNamePrefix(self, arg_list):
-        max_varlen = 3  # the minimum length of the prefix is 3
-        for arg in arg_list:
-            if IsSchVarNode(arg):
-                max_varlen = max(max_varlen, len(GetNodeVar(arg)))
-        return GenerateRandomAlphaString(max_varlen) + '_'
-
     def VisitVectorInit(self, node):
         arg_list = GetNodeArgList(node)
-        tmp_prefix, counter = self._FindUniqueVarNamePrefix(arg_list), 0
         let_var_list = []
         for arg in arg_list:
-            tmp_var = MakeSchVarNode(tmp_prefix + str(counter))
-            counter += 1
+            tmp_var = MakeSchVarNode(self._gensym.New('vec_elem'))
             SetNodeStaticType(tmp_var, GetNodeStaticType(arg))
             let_var_list.append((tmp_var, self._Visit(arg)))
         #  (if
@@ -102,35 +305,35 @@ class _ExposeAllocationVisitor(SchAstVisitorBase):
         translated = MakeSchIfNode(cmp_node, void_node, collect_node)
         SetNodeStaticType(translated, StaticTypes.VOID)
 
-        tmp_var = MakeSchVarNode(tmp_prefix + 'try_collect')
+        tmp_var = MakeSchVarNode(self._gensym.New('try_collect'))
         SetNodeStaticType(tmp_var, StaticTypes.VOID)
         let_var_list.append((tmp_var, translated))
 
         # (allocate len vec_static_type)
-        vec_var_node = MakeSchVarNode(tmp_prefix + 'new_vector')
+        vec_var_node = MakeSchVarNode(self._gensym.New('new_vector'))
         SetNodeStaticType(vec_var_node, vec_static_type)
 
         allocate_node = MakeSchInternalAllocateNode(
             vec_len, vec_static_type)
-        let_var_list.append((deepcopy(vec_var_node), allocate_node))
+        let_var_list.append((CloneAstNode(vec_var_node), allocate_node))
 
         inner_let_var_list = []
         for i in xrange(vec_len):
             # A new copy of the node must be created! Otherwise
-            # they will interfere in Uniquify pass.
+            # they will interfere in Uniquify pass. Var nodes are leaves,
+            # so a shallow clone is enough.
 
             # (vector-set! vec_var_node i x_i)
             arg_i = let_var_list[i][0]
             vec_set_node = MakeSchVectorSetNode(
-                deepcopy(vec_var_node), i, deepcopy(arg_i))
+                CloneAstNode(vec_var_node), i, CloneAstNode(arg_i))
             SetNodeStaticType(vec_set_node, StaticTypes.VOID)
 
-            tmp_var = MakeSchVarNode('{}unused_{}'.format(tmp_prefix, counter))
+            tmp_var = MakeSchVarNode(self._gensym.New('unused'))
             SetNodeStaticType(tmp_var, StaticTypes.VOID)
-            counter += 1
             inner_let_var_list.append((tmp_var, vec_set_node))
         inner_let_node = MakeSchLetNode(
-            inner_let_var_list, deepcopy(vec_var_node))
+            inner_let_var_list, CloneAstNode(vec_var_node))
         SetNodeStaticType(inner_let_node, vec_static_type)
 
         let_node = MakeSchLetNode(let_var_list, inner_let_node)
@@ -174,13 +377,14 @@ class _ExposeAllocationVisitor(SchAstVisitorBase):
             'GlobalValue is unexpected in Expose-Allocation pass.')
 
 
-def ExposeAllocation(ast):
+def ExposeAllocation(ast, gensym=None):
     '''
     Make variable names globally unique.
     |ast|: An SchNode. In production this should be an SchProgramNode. The
             correctness should already be verified in the analysis pass.
+    |gensym|: optional, the Gensym naming the temporaries.
     '''
-    visitor = _ExposeAllocationVisitor()
+    visitor = _ExposeAllocationVisitor(gensym or Gensym())
     return visitor.Visit(ast)
 
 ''' Uniquify pass
@@ -396,38 +600,53 @@ class _LowLvPassVarBuilder(object):
 
 class _SchToIrVarBuilder(_LowLvPassVarBuilder):
 
-    def __init__(self):
+    def __init__(self, gensym):
         super(_SchToIrVarBuilder, self).__init__()
-        self._next_tmp = 0
+        self._gensym = gensym
 
     def _CreateVar(self, var):
         return MakeIrVarNode(var)
 
     def AllocateTmpVar(self):
-        tmp_var = 'tmp_{}'.format(self._next_tmp)
-        self._next_tmp += 1
-        return self.AddVar(tmp_var)
+        return self.AddVar(self._gensym.New('tmp'))
 
 
 class _FlattenVisitor(SchAstVisitorBase):
 
-    def __init__(self):
+    def __init__(self, gensym):
         super(_FlattenVisitor, self).__init__()
+        self._gensym = gensym
 
     def _BeginVisit(self):
-        self._builder = _SchToIrVarBuilder()
+        self._builder = _SchToIrVarBuilder(self._gensym)
+        # Every visit method appends the IR statements it generates to
+        # |_stmt_list| and returns only the IR arg holding its result, so that
+        # each statement is appended exactly once.
+        self._stmt_list = []
 
     def _EndVisit(self, node, visit_result):
-        assert IsIrProgramNode(visit_result[0])
-        return visit_result[0]
+        assert IsIrProgramNode(visit_result)
+        return visit_result
+
+    def _Emit(self, stmt):
+        self._stmt_list.append(stmt)
+
+    @contextmanager
+    def _EmitInto(self, stmt_list):
+        outer_stmt_list = self._stmt_list
+        self._stmt_list = stmt_list
+        try:
+            yield
+        finally:
+            self._stmt_list = outer_stmt_list
 
     def VisitProgram(self, node):
-        ir_expr, stmt_list = self._Visit(GetSchProgram(node))
+        ir_expr = self._Visit(GetSchProgram(node))
         assert IsIrArgNode(ir_expr)
-        stmt_list.append(MakeIrReturnNode(ir_expr))
-        ir_node = MakeIrProgramNode(self._builder.var_list, stmt_list)
+        self._Emit(MakeIrReturnNode(ir_expr))
+        ir_node = MakeIrProgramNode(self._builder.var_list, self._stmt_list)
         SetNodeStaticType(ir_node, GetNodeStaticType(ir_expr))
-        return ir_node, stmt_list
+        return ir_node
 
     def _VisitBinLogicalOp(self, node):
         method = GetNodeMethod(node)
@@ -460,12 +679,11 @@ class _FlattenVisitor(SchAstVisitorBase):
         if IsBinLogicalOp(method):
             return self._VisitBinLogicalOp(node)
 
-        ir_arg_list, stmt_list = [], []
+        ir_arg_list = []
         for expr in GetSchApplyExprList(node):
-            ir_expr, expr_stmt_list = self._Visit(expr)
+            ir_expr = self._Visit(expr)
             assert IsIrArgNode(ir_expr)
             assert NodeHasStaticType(ir_expr)
-            stmt_list += expr_stmt_list
             ir_arg_list.append(ir_expr)
         ir_apply = None
         if IsSchCmpOp(method):
@@ -478,39 +696,34 @@ class _FlattenVisitor(SchAstVisitorBase):
 
         tmp_var = self._builder.AllocateTmpVar()
         SetNodeStaticType(tmp_var, static_type)
-        stmt_list.append(MakeIrAssignNode(tmp_var, ir_apply))
+        self._Emit(MakeIrAssignNode(tmp_var, ir_apply))
 
-        return tmp_var, stmt_list
+        return tmp_var
 
     def VisitLet(self, node):
         ir_var_init = []
-        stmt_list = []
         for var, var_init in GetNodeVarList(node):
-            ir_init, init_stmt_list = self._Visit(var_init)
+            ir_init = self._Visit(var_init)
             assert IsIrArgNode(ir_init), ir_init
             assert GetNodeStaticType(ir_init) == GetNodeStaticType(var)
             # Cannot add assign stmt yet, cache it in |ir_var_init|
             ir_var_init.append(
                 (GetNodeVar(var), GetNodeStaticType(var), ir_init))
-            stmt_list += init_stmt_list
         for var_name, var_static_type, ir_init in ir_var_init:
             ir_var = self._builder.AddVar(var_name)
             SetNodeStaticType(ir_var, var_static_type)
-            stmt_list.append(MakeIrAssignNode(ir_var, ir_init))
-        ir_body, body_stmt_list = self._Visit(GetSchLetBody(node))
+            self._Emit(MakeIrAssignNode(ir_var, ir_init))
+        ir_body = self._Visit(GetSchLetBody(node))
         assert IsIrArgNode(ir_body)
         assert GetNodeStaticType(ir_body) == GetNodeStaticType(node)
-        stmt_list += body_stmt_list
-        return ir_body, stmt_list
+        return ir_body
 
     def VisitIf(self, node):
-        stmt_list = []
         # cond
-        ir_cond, cond_stmt_list = self._Visit(GetIfCond(node))
+        ir_cond = self._Visit(GetIfCond(node))
         assert IsIrArgNode(ir_cond)
-        stmt_list += cond_stmt_list
         # if_cond_tmp = self._builder.AllocateTmpVar()
-        # stmt_list.append(MakeIrAssignNode(
+        # self._Emit(MakeIrAssignNode(
         #     if_cond_tmp, MakeIrCmpNode('eq?', MakeIrBoolNode('#t'), ir_cond)))
 
         def MakeIrBoolWithStatitType(b):
@@ -524,32 +737,32 @@ class _FlattenVisitor(SchAstVisitorBase):
         if_var = self._builder.AllocateTmpVar()
         if_static_type = GetNodeStaticType(node)
         SetNodeStaticType(if_var, if_static_type)
-        ir_then, then_stmt_list = self._Visit(GetIfThen(node))
-        assert GetNodeStaticType(ir_then) == if_static_type
-        then_stmt_list.append(MakeIrAssignNode(if_var, ir_then))
-        then_stmt_list = tuple(then_stmt_list)
+        then_stmt_list = []
+        with self._EmitInto(then_stmt_list):
+            ir_then = self._Visit(GetIfThen(node))
+            assert GetNodeStaticType(ir_then) == if_static_type
+            self._Emit(MakeIrAssignNode(if_var, ir_then))
         # else branch
-        ir_else, else_stmt_list = self._Visit(GetIfElse(node))
-        assert GetNodeStaticType(ir_else) == if_static_type
-        else_stmt_list.append(MakeIrAssignNode(if_var, ir_else))
-        else_stmt_list = tuple(else_stmt_list)
-
-        ir_if = MakeIrIfNode(ir_cond, then_stmt_list, else_stmt_list)
+        else_stmt_list = []
+        with self._EmitInto(else_stmt_list):
+            ir_else = self._Visit(GetIfElse(node))
+            assert GetNodeStaticType(ir_else) == if_static_type
+            self._Emit(MakeIrAssignNode(if_var, ir_else))
+
+        ir_if = MakeIrIfNode(ir_cond, tuple(then_stmt_list),
+                             tuple(else_stmt_list))
         SetNodeStaticType(ir_if, if_static_type)
-        stmt_list.append(ir_if)
-        return if_var, stmt_list
+        self._Emit(ir_if)
+        return if_var
 
     def VisitVectorInit(self, node):
         raise CompilingError("vector-init is unexpected in Flatten pass.")
 
     def VisitVectorRef(self, node):
-        stmt_list = []
-
         sch_vec = GetVectorNodeVec(node)
-        ir_vec, tmp_stmt_list = self._Visit(sch_vec)
+        ir_vec = self._Visit(sch_vec)
         vec_static_type = GetNodeStaticType(sch_vec)
         # assert GetNodeStaticType(ir_vec) == vec_static_type
-        stmt_list += tmp_stmt_list
 
         idx = GetVectorNodeIndex(node)
         static_type = GetVectorStaticTypeAt(vec_static_type, idx)
@@ -559,38 +772,34 @@ class _FlattenVisitor(SchAstVisitorBase):
         SetNodeStaticType(ir_vec_ref, static_type)
         tmp_var = self._builder.AllocateTmpVar()
         SetNodeStaticType(tmp_var, static_type)
-        stmt_list.append(MakeIrAssignNode(tmp_var, ir_vec_ref))
+        self._Emit(MakeIrAssignNode(tmp_var, ir_vec_ref))
 
-        return tmp_var, stmt_list
+        return tmp_var
 
     def VisitVectorSet(self, node):
-        stmt_list = []
-
         sch_vec = GetVectorNodeVec(node)
-        ir_vec, tmp_stmt_list = self._Visit(sch_vec)
+        ir_vec = self._Visit(sch_vec)
         vec_static_type = GetNodeStaticType(sch_vec)
-        stmt_list += tmp_stmt_list
 
         idx = GetVectorNodeIndex(node)
         static_type = GetVectorStaticTypeAt(vec_static_type, idx)
 
-        ir_val, tmp_stmt_list = self._Visit(GetVectorSetVal(node))
+        ir_val = self._Visit(GetVectorSetVal(node))
         assert IsIrArgNode(ir_val)
         assert GetNodeStaticType(ir_val) == static_type
-        stmt_list += tmp_stmt_list
 
         ir_vec_set = MakeIrVectorSetNode(ir_vec, idx, ir_val)
         SetNodeStaticType(ir_vec_set, StaticTypes.VOID)
         tmp_var = self._builder.AllocateTmpVar()
         SetNodeStaticType(tmp_var, StaticTypes.VOID)
-        stmt_list.append(MakeIrAssignNode(tmp_var, ir_vec_set))
+        self._Emit(MakeIrAssignNode(tmp_var, ir_vec_set))
 
-        return tmp_var, stmt_list
+        return tmp_var
 
     def VisitInt(self, node):
         ir_node = MakeIrIntNode(GetIntX(node))
         SetNodeStaticType(ir_node, StaticTypes.INT)
-        return ir_node, []
+        return ir_node
 
     def VisitVar(self, node):
         ir_node = self._builder.GetVar(GetNodeVar(node))
@@ -599,35 +808,35 @@ class _FlattenVisitor(SchAstVisitorBase):
             assert GetNodeStaticType(ir_node) == static_type
         else:
             SetNodeStaticType(ir_node, static_type)
-        return ir_node, []
+        return ir_node
 
     def VisitBool(self, node):
         ir_node = MakeIrBoolNode(GetNodeBool(node))
         SetNodeStaticType(ir_node, StaticTypes.BOOL)
-        return ir_node, []
+        return ir_node
 
     def VisitVoid(self, node):
         ir_void = MakeIrVoidNode()
         SetNodeStaticType(ir_void, StaticTypes.VOID)
-        return ir_void, []
+        return ir_void
         # tmp_var = self._builder.AllocateTmpVar()
         # SetNodeStaticType(tmp_var, StaticTypes.VOID)
-        # stmt_list = [MakeIrAssignNode(tmp_var, ir_void)]
-        # return tmp_var, stmt_list
+        # self._Emit(MakeIrAssignNode(tmp_var, ir_void))
+        # return tmp_var
 
     def VisitInternalCollect(self, node):
         # `collect` is a statement in IR
         ir_collect = MakeIrCollectNode(GetInternalCollectNodeBytes(node))
-        stmt_list = [ir_collect]
+        self._Emit(ir_collect)
 
         ir_void = MakeIrVoidNode()
         SetNodeStaticType(ir_void, StaticTypes.VOID)
-        return ir_void, stmt_list
+        return ir_void
         # tmp_var = self._builder.AllocateTmpVar()
         # SetNodeStaticType(tmp_var, StaticTypes.VOID)
-        # stmt_list.append(MakeIrAssignNode(tmp_var, ir_void))
+        # self._Emit(MakeIrAssignNode(tmp_var, ir_void))
 
-        # return tmp_var, stmt_list
+        # return tmp_var
 
     def VisitInternalAllocate(self, node):
         len, static_type = GetInternalAllocateNodeLen(
@@ -636,9 +845,9 @@ class _FlattenVisitor(SchAstVisitorBase):
 
         tmp_var = self._builder.AllocateTmpVar()
         SetNodeStaticType(tmp_var, static_type)
-        stmt_list = [MakeIrAssignNode(tmp_var, ir_allocate)]
+        self._Emit(MakeIrAssignNode(tmp_var, ir_allocate))
 
-        return tmp_var, stmt_list
+        return tmp_var
 
     def VisitInternalGlobalValue(self, node):
         ir_global_val = MakeIrGlobalValueNode(
@@ -646,22 +855,211 @@ class _FlattenVisitor(SchAstVisitorBase):
 
         tmp_var = self._builder.AllocateTmpVar()
         SetNodeStaticType(tmp_var, StaticTypes.INT)
-        stmt_list = [MakeIrAssignNode(tmp_var, ir_global_val)]
+        self._Emit(MakeIrAssignNode(tmp_var, ir_global_val))
 
-        return tmp_var, stmt_list
+        return tmp_var
 
 
-def Flatten(sch_ast):
+def Flatten(sch_ast, gensym=None):
     '''
     Flatten the Scheme ast to IR ast. This should run after Uniquify
     |sch_ast|: An SchNode. In production this should be an SchProgramNode.
+    |gensym|: optional, the Gensym naming the temporaries.
     Returns: An IrNode
     '''
-    visitor = _FlattenVisitor()
+    visitor = _FlattenVisitor(gensym or Gensym())
     return visitor.Visit(sch_ast)
     # return _Flatten(sch_ast, _FlattenBuilder())
 
 
+'''Propagate-Copies pass
+Flatten binds the result of every expression to a fresh temporary, and every
+let variable to the temporary of its initializer. This pass replaces the uses
+of a variable assigned once with an arg by that arg, then removes the
+assignments to the variables that are no longer used and have no side effect.
+This shrinks the variable list seen by the liveness analysis and the register
+allocation.
+
+- IR version: C1
+'''
+
+
+def _IrExprArgs(expr):
+    '''
+    Returns the list of the args read by |expr|.
+    '''
+    if IsIrArgNode(expr):
+        return [expr]
+    elif IsIrApplyNode(expr):
+        return GetNodeArgList(expr)
+    elif IsIrCmpNode(expr):
+        return [GetIrCmpLhs(expr), GetIrCmpRhs(expr)]
+    elif IsIrVectorRefNode(expr):
+        return [GetVectorNodeVec(expr)]
+    elif IsIrVectorSetNode(expr):
+        return [GetVectorNodeVec(expr), GetVectorSetVal(expr)]
+    return []
+
+
+def _MapIrExprArgs(expr, fn):
+    '''
+    Replaces every arg |a| read by |expr| with fn(a). Returns the new |expr|.
+    '''
+    if IsIrArgNode(expr):
+        return fn(expr)
+    elif IsIrApplyNode(expr):
+        SetNodeArgList(expr, [fn(arg) for arg in GetNodeArgList(expr)])
+    elif IsIrCmpNode(expr):
+        SetIrCmpLhs(expr, fn(GetIrCmpLhs(expr)))
+        SetIrCmpRhs(expr, fn(GetIrCmpRhs(expr)))
+    elif IsIrVectorRefNode(expr):
+        SetVectorNodeVec(expr, fn(GetVectorNodeVec(expr)))
+    elif IsIrVectorSetNode(expr):
+        SetVectorNodeVec(expr, fn(GetVectorNodeVec(expr)))
+        SetVectorSetVal(expr, fn(GetVectorSetVal(expr)))
+    return expr
+
+
+def _IsIrExprPure(expr):
+    # reading the input, allocating and setting a vector have side effects
+    if IsIrApplyNode(expr):
+        return GetNodeMethod(expr) not in SchRtmFns()
+    return not (IsIrAllocateNode(expr) or IsIrVectorSetNode(expr))
+
+
+def _CollectIrDefs(stmt_list, defs, next_index=0):
+    '''
+    Numbers the statements in execution order. For the IR has no loop, a
+    statement can only be executed after the ones with a smaller number.
+
+    defs: a dict, filled with var name => list of (index, assign stmt)
+    Returns the next unused index.
+    '''
+    for stmt in stmt_list:
+        index, next_index = next_index, next_index + 1
+        if IsIrAssignNode(stmt):
+            var_name = GetNodeVar(GetNodeVar(stmt))
+            defs.setdefault(var_name, []).append((index, stmt))
+        elif IsIrIfNode(stmt):
+            next_index = _CollectIrDefs(GetIfThen(stmt), defs, next_index)
+            next_index = _CollectIrDefs(GetIfElse(stmt), defs, next_index)
+    return next_index
+
+
+def _FindIrCopies(defs):
+    '''
+    Returns a dict of var name => the arg that can replace all its uses.
+    '''
+    copies = {}
+    for var_name, var_defs in defs.iteritems():
+        if len(var_defs) != 1:
+            continue
+        index, stmt = var_defs[0]
+        src = GetIrAssignExpr(stmt)
+        if not IsIrArgNode(src):
+            continue
+        if IsIrVarNode(src):
+            # |src| must not be reassigned after |var_name| is, so that it
+            # holds the same value at every use of |var_name|.
+            src_defs = defs[GetNodeVar(src)]
+            if max(src_index for src_index, _ in src_defs) > index:
+                continue
+        copies[var_name] = src
+    return copies
+
+
+def _PropagateIrCopies(stmt_list, copies):
+    def Resolve(arg):
+        while IsIrVarNode(arg) and GetNodeVar(arg) in copies:
+            arg = copies[GetNodeVar(arg)]
+        return arg
+
+    for stmt in stmt_list:
+        if IsIrAssignNode(stmt):
+            SetIrAssignExpr(stmt, _MapIrExprArgs(GetIrAssignExpr(stmt), Resolve))
+        elif IsIrReturnNode(stmt):
+            SetIrReturnArg(stmt, Resolve(GetIrReturnArg(stmt)))
+        elif IsIrIfNode(stmt):
+            _MapIrExprArgs(GetIfCond(stmt), Resolve)
+            _PropagateIrCopies(GetIfThen(stmt), copies)
+            _PropagateIrCopies(GetIfElse(stmt), copies)
+
+
+def _CountIrUses(stmt_list, uses):
+    def Count(expr):
+        for arg in _IrExprArgs(expr):
+            if IsIrVarNode(arg):
+                var_name = GetNodeVar(arg)
+                uses[var_name] = uses.get(var_name, 0) + 1
+
+    for stmt in stmt_list:
+        if IsIrAssignNode(stmt):
+            Count(GetIrAssignExpr(stmt))
+        elif IsIrReturnNode(stmt):
+            Count(GetIrReturnArg(stmt))
+        elif IsIrIfNode(stmt):
+            Count(GetIfCond(stmt))
+            _CountIrUses(GetIfThen(stmt), uses)
+            _CountIrUses(GetIfElse(stmt), uses)
+
+
+def _RemoveDeadIrAssigns(stmt_list, uses):
+    '''
+    Returns the list of the statements of |stmt_list| that are kept.
+
+    The statements are walked backward, so all the uses of a variable are
+    already removed, if they are dead, by the time its assignment is reached.
+    '''
+    def Uncount(expr):
+        for arg in _IrExprArgs(expr):
+            if IsIrVarNode(arg):
+                uses[GetNodeVar(arg)] -= 1
+
+    new_stmt_list = []
+    for stmt in reversed(stmt_list):
+        if IsIrAssignNode(stmt):
+            expr = GetIrAssignExpr(stmt)
+            var_name = GetNodeVar(GetNodeVar(stmt))
+            if uses.get(var_name, 0) == 0 and _IsIrExprPure(expr):
+                Uncount(expr)
+                continue
+        elif IsIrIfNode(stmt):
+            then_stmt_list = _RemoveDeadIrAssigns(GetIfThen(stmt), uses)
+            else_stmt_list = _RemoveDeadIrAssigns(GetIfElse(stmt), uses)
+            if not (then_stmt_list or else_stmt_list):
+                Uncount(GetIfCond(stmt))
+                continue
+            SetIfThen(stmt, tuple(then_stmt_list))
+            SetIfElse(stmt, tuple(else_stmt_list))
+        new_stmt_list.append(stmt)
+    new_stmt_list.reverse()
+    return new_stmt_list
+
+
+def PropagateCopies(ir_ast):
+    '''
+    |ir_ast|: An IrProgramNode, produced by Flatten.
+    '''
+    assert IsIrProgramNode(ir_ast)
+    stmt_list = GetNodeStmtList(ir_ast)
+    defs = {}
+    _CollectIrDefs(stmt_list, defs)
+    _PropagateIrCopies(stmt_list, _FindIrCopies(defs))
+
+    uses = {}
+    _CountIrUses(stmt_list, uses)
+    stmt_list = _RemoveDeadIrAssigns(stmt_list, uses)
+    SetNodeStmtList(ir_ast, stmt_list)
+
+    # only the variables still assigned are kept
+    defs = {}
+    _CollectIrDefs(stmt_list, defs)
+    var_list = [var for var in GetNodeVarList(ir_ast)
+                if GetNodeVar(var) in defs]
+    SetNodeVarList(ir_ast, var_list)
+    return ir_ast
+
+
 '''Select-instruction pass
 '''
 
@@ -972,12 +1370,26 @@ def SelectInstruction(ir_ast, formatter=None):
 
 '''Uncover-Live pass
 This pass detects the live after set for all the X86 instructions
+
+A live after set is an int used as a bitset, whose bit i is set if the i-th
+variable of the program's variable list is live.
 '''
 
 
-def _AddVarNamesToSet(var_names, operand_list):
-    for op in filter(lambda o: TypeOf(o) == VAR_NODE_T, operand_list):
-        var_names.add(GetNodeVar(op))
+def _VarIdsOfProgram(x86_ast):
+    '''
+    Returns a dict of var name => its bit in the live after sets.
+    '''
+    return {GetNodeVar(var): i
+            for i, var in enumerate(GetNodeVarList(x86_ast))}
+
+
+def _VarBits(var_ids, operand_list):
+    bits = 0
+    for op in operand_list:
+        if IsX86VarNode(op):
+            bits |= 1 << var_ids[GetNodeVar(op)]
+    return bits
 
 
 # The following helper functions only deal with *variables*.
@@ -985,47 +1397,42 @@ def _AddVarNamesToSet(var_names, operand_list):
 # all the caller-save registers (rax, rdx, ...), these registers
 # will not be included in the result set.
 
+# Instructions that read *destination*, hence MOVE is not here.
+# TODO: think about whether PUSH should also be here.
+_X86_INSTRS_READ_DST = {x86c.ADD, x86c.CMP, x86c.NEG, x86c.SUB, x86c.XOR}
+_X86_INSTRS_WRITE_DST = {x86c.ADD, x86c.NEG, x86c.SUB,
+                         x86c.XOR, x86c.MOVE, x86c.MOVEZB}
 
-def _ReadVariableSet(node):
+
+def _ReadVariableBits(node, var_ids):
     if IsX86CallCNode(node):
-        return set()
-    result, arg_list = set(), []
+        return 0
     if IsX86SiRetNode(node):
-        arg_list.append(GetX86SiRetArg(node))
-    else:
-        operand_list = GetX86InstrOperandList(node)
-        arity = GetX86InstrArity(node)
-        arg_list.extend(operand_list[:(arity - 1)])
-        # Instructions that read *destination*, hence MOVE is not here.
-        # TODO: think about whether PUSH should also be here.
-        instrs_read_dst = {x86c.ADD, x86c.NEG, x86c.SUB, x86c.XOR}
-        if GetX86Instr(node) in instrs_read_dst:
-            # must pass in a list
-            arg_list.append(operand_list[-1])
-    _AddVarNamesToSet(result, arg_list)
-    return result
-
-
-def _WrittenVariableSet(node):
-    if IsX86SpecialInstrNode(node):
-        return set()
-
-    result = set()
+        return _VarBits(var_ids, [GetX86SiRetArg(node)])
     operand_list = GetX86InstrOperandList(node)
-    instrs_write = {x86c.ADD, x86c.NEG, x86c.SUB,
-                    x86c.XOR, x86c.MOVE, x86c.MOVEZB}
-    instr = GetX86Instr(node)
-    if instr in instrs_write:
+    if GetX86Instr(node) in _X86_INSTRS_READ_DST:
+        return _VarBits(var_ids, operand_list)
+    return _VarBits(var_ids, operand_list[:-1])
+
+
+def _WrittenVariableBits(node, var_ids):
+    if IsX86SpecialInstrNode(node):
+        return 0
+    if GetX86Instr(node) in _X86_INSTRS_WRITE_DST:
         # instruction only writes to dst
-        _AddVarNamesToSet(result, operand_list[-1:])
-    return result
+        return _VarBits(var_ids, GetX86InstrOperandList(node)[-1:])
+    return 0
 
 
-def _UncoverLive(instr_list, last_live_after=None, find_for_first=False):
+def _UncoverLive(instr_list, var_ids, last_live_after=0,
+                 find_for_first=False):
     num_instr = len(instr_list)
+    if num_instr == 0:
+        # i.e. a TmpIf branch emptied by PropagateCopies
+        return [], last_live_after
     begin_index = 0 if find_for_first else 1
-    live_afters = [set() for _ in xrange(num_instr)]
-    live_afters[-1] = last_live_after or set()
+    live_afters = [0] * num_instr
+    live_afters[-1] = last_live_after
     first_instr_lb = None
     for i in reversed(xrange(begin_index, num_instr)):
         instr = instr_list[i]
@@ -1036,15 +1443,16 @@ def _UncoverLive(instr_list, last_live_after=None, find_for_first=False):
         if IsX86TmpIfNode(instr):
             then_instr_list = GetX86TmpIfThen(instr)
             then_la_list, then_first_lb = _UncoverLive(
-                then_instr_list, la_i, True)
+                then_instr_list, var_ids, la_i, True)
             else_instr_list = GetX86TmpIfElse(instr)
             else_la_list, else_first_lb = _UncoverLive(
-                else_instr_list, la_i, True)
+                else_instr_list, var_ids, la_i, True)
             SetX86TmpIfThenLiveAfter(instr, then_la_list)
             SetX86TmpIfElseLiveAfter(instr, else_la_list)
             lb_i = then_first_lb | else_first_lb | la_i
         else:
-            lb_i = (la_i - _WrittenVariableSet(instr)) | _ReadVariableSet(instr)
+            lb_i = (la_i & ~_WrittenVariableBits(instr, var_ids)) | \
+                _ReadVariableBits(instr, var_ids)
         if i == 0:
             assert find_for_first
             first_instr_lb = lb_i
@@ -1054,48 +1462,90 @@ def _UncoverLive(instr_list, last_live_after=None, find_for_first=False):
 
 
 def UncoverLive(x86_ast):
+    '''
+    The live afters are kept on |x86_ast| until its instruction list is set
+    again, so this does nothing if they are already computed.
+    '''
     assert IsX86ProgramNode(x86_ast)
+    if X86ProgramHasLiveAfters(x86_ast):
+        return x86_ast
     instr_list = GetX86ProgramInstrList(x86_ast)
-    live_afters, _ = _UncoverLive(instr_list)
+    live_afters, _ = _UncoverLive(instr_list, _VarIdsOfProgram(x86_ast))
     SetX86ProgramLiveAfters(x86_ast, live_afters)
+    SetX86ProgramLiveVarNames(
+        x86_ast, [GetNodeVar(var) for var in GetNodeVarList(x86_ast)])
     return x86_ast
 
 
 ''' Build Interference Graph
+The variables are identified by their ids, as in the live after sets.
 '''
 
 
 class _InferenceGraph(object):
+    '''
+    An edge is a bit of a lower triangular matrix, so that testing it is O(1).
+    It is also appended to the adjacency arrays of both its ends, which are
+    used for the iteration. The saturation of a variable is the bitmask of
+    the registers it cannot use, see x86c.RegBit().
+    '''
 
-    def __init__(self):
-        self._ug = UGraph()
-        self._var_to_node = {}
-        self._var_saturation = {}
+    def __init__(self, var_list):
+        num_vars = len(var_list)
+        self._var_list = var_list
+        self._matrix = bytearray((num_vars * (num_vars - 1) // 2 + 7) // 8)
+        self._adj = [array('i') for _ in xrange(num_vars)]
+        self._saturation = [0] * num_vars
 
-    def AddVar(self, node):
-        assert IsX86VarNode(node)
-        var_name = GetNodeVar(node)
-        self._ug.AddVertex(var_name)
-        self._var_to_node[var_name] = node
-        self._var_saturation[var_name] = set()
+    @property
+    def num_vars(self):
+        return len(self._var_list)
+
+    def VarNode(self, u):
+        return self._var_list[u]
+
+    def _EdgeBit(self, u, v):
+        if u < v:
+            u, v = v, u
+        bit = u * (u - 1) // 2 + v
+        return bit >> 3, 1 << (bit & 7)
+
+    def AddInterference(self, u, v):
+        assert u != v
+        byte, mask = self._EdgeBit(u, v)
+        if self._matrix[byte] & mask:
+            return
+        self._matrix[byte] |= mask
+        self._adj[u].append(v)
+        self._adj[v].append(u)
 
-    def AddInterference(self, u_name, v_name):
-        self._ug.AddEdge(u_name, v_name)
+    def HasInterference(self, u, v):
+        if u == v:
+            return False
+        byte, mask = self._EdgeBit(u, v)
+        return bool(self._matrix[byte] & mask)
 
-    def Interfered(self, var_name):
-        return {a for a in self._ug.AdjacentVertices(var_name)}
+    def Interfered(self, u):
+        # not a copy, the caller must not modify it
+        return self._adj[u]
 
-    def LocRepr(self, loc):
-        assert IsX86RegNode(loc)
-        return GetX86Reg(loc)
+    def Saturation(self, u):
+        return self._saturation[u]
 
-    def AddSaturation(self, var_name, loc):
+    def AddSaturation(self, u, loc):
         if IsX86DerefNode(loc):
             return
-        self._var_saturation[var_name].add(self.LocRepr(loc))
+        self._saturation[u] |= x86c.RegBit(GetX86Reg(loc))
+
+    def AddSaturationMask(self, u, reg_mask):
+        self._saturation[u] |= reg_mask
+
+
+_CALLER_SAVE_REG_MASK = x86c.RegMask(x86c.CallerSaveRegs())
+_CALLEE_SAVE_REG_MASK = x86c.RegMask(x86c.CalleeSaveRegs())
 
 
-def _ExtendInferenceGraphByInstrList(ig, var_name_dict, instr_list, live_afters):
+def _ExtendInferenceGraphByInstrList(ig, var_ids, instr_list, live_afters):
     # precondition: all the variables should be added to |ig|
     assert len(instr_list) == len(live_afters)
     for i, instr in enumerate(instr_list):
@@ -1103,66 +1553,59 @@ def _ExtendInferenceGraphByInstrList(ig, var_name_dict, instr_list, live_afters)
             continue
         la_i = live_afters[i]
         if IsX86SiRetNode(instr):
-            for v_name in la_i:
-                ig.AddSaturation(v_name, MakeX86RegNode(x86c.RAX))
+            for v in IterBits(la_i):
+                ig.AddSaturationMask(v, x86c.RegBit(x86c.RAX))
         elif IsX86TmpIfNode(instr):
             then_instr_list = GetX86TmpIfThen(instr)
             then_la_list = GetX86TmpIfThenLiveAfter(instr)
             _ExtendInferenceGraphByInstrList(
-                ig, var_name_dict, then_instr_list, then_la_list)
+                ig, var_ids, then_instr_list, then_la_list)
             else_instr_list = GetX86TmpIfElse(instr)
             else_la_list = GetX86TmpIfElseLiveAfter(instr)
             _ExtendInferenceGraphByInstrList(
-                ig, var_name_dict, else_instr_list, else_la_list)
+                ig, var_ids, else_instr_list, else_la_list)
         else:
             method = GetX86Instr(instr)
             if method in {x86c.MOVE, x86c.MOVEZB}:
                 src, dst = GetX86InstrOperandList(instr)
 
                 if IsX86VarNode(dst):
-                    dst_name = GetNodeVar(dst)
-                    not_interfered = {dst_name}
+                    dst_id = var_ids[GetNodeVar(dst)]
+                    not_interfered = 1 << dst_id
                     if IsX86VarNode(src):
-                        not_interfered.add(GetNodeVar(src))
-                    for v_name in la_i:
-                        if v_name not in not_interfered:
-                            ig.AddInterference(dst_name, v_name)
+                        not_interfered |= 1 << var_ids[GetNodeVar(src)]
+                    for v in IterBits(la_i & ~not_interfered):
+                        ig.AddInterference(dst_id, v)
                 elif IsX86VarNode(src):
-                    src_name = GetNodeVar(src)
-                    ig.AddSaturation(src_name, dst)
+                    ig.AddSaturation(var_ids[GetNodeVar(src)], dst)
 
             elif method in {x86c.ADD, x86c.SUB, x86c.NEG, x86c.XOR}:
                 dst = GetX86InstrOperandList(instr)[-1]
                 if IsX86VarNode(dst):
-                    dst_name = GetNodeVar(dst)
-                    for v_name in la_i:
-                        if v_name != dst_name:
-                            ig.AddInterference(dst_name, v_name)
+                    dst_id = var_ids[GetNodeVar(dst)]
+                    for v in IterBits(la_i & ~(1 << dst_id)):
+                        ig.AddInterference(dst_id, v)
                 elif not IsX86GlobalValueNode(dst):
                     # |dst| could be global-val in implementing `allocate`
                     raise CompilingError('Unexpected dst!')
             elif method == x86c.CALL:
-                for v_name in la_i:
-                    for cs_reg in x86c.CallerSaveRegs():
-                        cs_reg = MakeX86RegNode(cs_reg)
-                        ig.AddSaturation(v_name, cs_reg)
+                for v in IterBits(la_i):
+                    ig.AddSaturationMask(v, _CALLER_SAVE_REG_MASK)
                     # TODO: do this only if the invoked method is 'collect'.
-                    static_type = GetNodeStaticType(var_name_dict[v_name])
+                    static_type = GetNodeStaticType(ig.VarNode(v))
                     if IsValidStaticTypeVector(static_type):
-                        for cs_reg in x86c.CalleeSaveRegs():  # x86c.FreeRegs()
-                            cs_reg = MakeX86RegNode(cs_reg)
-                            ig.AddSaturation(v_name, cs_reg)
+                        # x86c.FreeRegs()
+                        ig.AddSaturationMask(v, _CALLEE_SAVE_REG_MASK)
 
 
 def _BuildInterferenceGraph(x86_ast):
-    ig = _InferenceGraph()
-    var_name_dict = _ConvertVarListToVarNameDict(GetNodeVarList(x86_ast))
-    for var in var_name_dict.values():
-        ig.AddVar(var)
-
+    ig = _InferenceGraph(GetNodeVarList(x86_ast))
+    # reuses the live afters of the Uncover-Live pass
+    UncoverLive(x86_ast)
     instr_list = GetX86ProgramInstrList(x86_ast)
-    live_afters, _ = _UncoverLive(instr_list)
-    _ExtendInferenceGraphByInstrList(ig, var_name_dict, instr_list, live_afters)
+    live_afters = GetX86ProgramLiveAfters(x86_ast)
+    _ExtendInferenceGraphByInstrList(
+        ig, _VarIdsOfProgram(x86_ast), instr_list, live_afters)
     return ig
 
 
@@ -1170,28 +1613,25 @@ class _MoveRelatedGraph(object):
 
     def __init__(self):
         self._ug = UGraph()
-        self._var_to_node = {}
 
-    def AddVar(self, node):
-        assert IsX86VarNode(node)
-        var_name = GetNodeVar(node)
-        self._ug.AddVertex(var_name)
-        self._var_to_node[var_name] = node
+    def AddVar(self, u):
+        self._ug.AddVertex(u)
 
-    def AddMoveRelated(self, u_name, v_name):
-        self._ug.AddEdge(u_name, v_name)
+    def AddMoveRelated(self, u, v):
+        self._ug.AddEdge(u, v)
 
-    def MoveRelated(self, var_name):
-        return {m for m in self._ug.AdjacentVertices(var_name)}
+    def MoveRelated(self, u):
+        return self._ug.AdjacentVertices(u)
 
 
-def _BuildMoveRelatedGraph(x86_ast):
-    mrg = _MoveRelatedGraph()
-    for var in GetNodeVarList(x86_ast):
-        mrg.AddVar(var)
-    instr_list = GetX86ProgramInstrList(x86_ast)
+def _ExtendMoveRelatedGraphByInstrList(mrg, var_ids, instr_list):
     for instr in instr_list:
-        if TypeOf(instr) == X86_INSTR_NODE_T and \
+        if IsX86TmpIfNode(instr):
+            _ExtendMoveRelatedGraphByInstrList(
+                mrg, var_ids, GetX86TmpIfThen(instr))
+            _ExtendMoveRelatedGraphByInstrList(
+                mrg, var_ids, GetX86TmpIfElse(instr))
+        elif TypeOf(instr) == X86_INSTR_NODE_T and \
                 GetX86Instr(instr) in {x86c.MOVE, x86c.MOVEZB}:
             src, dst = GetX86InstrOperandList(instr)
             # |dst| is no longer guaranteed to be a Var. In collect, it could
@@ -1199,65 +1639,329 @@ def _BuildMoveRelatedGraph(x86_ast):
             # assert IsX86VarNode(dst)
             # it could be that |src| is an X86IntNode
             if IsX86VarNode(src) and IsX86VarNode(dst):
-                src_name, dst_name = GetNodeVar(src), GetNodeVar(dst)
-                mrg.AddMoveRelated(src_name, dst_name)
+                mrg.AddMoveRelated(var_ids[GetNodeVar(src)],
+                                   var_ids[GetNodeVar(dst)])
+
+
+def _BuildMoveRelatedGraph(x86_ast):
+    mrg = _MoveRelatedGraph()
+    var_ids = _VarIdsOfProgram(x86_ast)
+    for u in var_ids.itervalues():
+        mrg.AddVar(u)
+    _ExtendMoveRelatedGraphByInstrList(
+        mrg, var_ids, GetX86ProgramInstrList(x86_ast))
     return mrg
 
 
-def _AllocateRegisterOrStack(ig, mrg, var_name_dict, use_mr):
-    # a set the names of the variables not assigned a loc
-    unassigned_var_names = set(ig._var_to_node.keys())
-    # a mapping from var name to loc X86 node
+_FREE_REG_MASK = x86c.RegMask(x86c.FreeRegs())
+
+
+def _CoalesceMoves(ig, mrg, spill_costs, frozen_vars=frozenset()):
+    '''
+    Conservatively coalesces the move related variables that do not
+    interfere, so that their moves become `mov x, x` once allocated. The
+    variables in |frozen_vars| are not coalesced.
+
+    Two variables are coalesced if the result is as colorable as before:
+    either the merged variable has fewer than K neighbours of significant
+    degree (Briggs), or every neighbour of one of them already interferes
+    with the other or has an insignificant degree (George). K is the number
+    of the free registers, and the registers in the saturation of a
+    variable count as its neighbours. A vector is never coalesced with a
+    non-vector, because they are spilled to different stacks.
+
+    Returns a tuple of (the coalesced _InferenceGraph, _MoveRelatedGraph,
+    spill costs, a dict of var name => the var name it is coalesced into).
+    '''
+    num_regs = PopCount(_FREE_REG_MASK)
+    adj = [set(ig.Interfered(u)) for u in xrange(ig.num_vars)]
+    sat = [ig.Saturation(u) for u in xrange(ig.num_vars)]
+    is_vector = [IsValidStaticTypeVector(GetNodeStaticType(ig.VarNode(u)))
+                 for u in xrange(ig.num_vars)]
+    # the variable every variable is coalesced into, as a union-find
+    alias = range(ig.num_vars)
+
+    def Find(u):
+        while alias[u] != u:
+            alias[u] = alias[alias[u]]
+            u = alias[u]
+        return u
+
+    def Degree(u):
+        return len(adj[u]) + PopCount(sat[u] & _FREE_REG_MASK)
+
+    def Briggs(u, v):
+        merged_sat = (sat[u] | sat[v]) & _FREE_REG_MASK
+        num_significant = PopCount(merged_sat)
+        for t in adj[u] | adj[v]:
+            if Degree(t) >= num_regs:
+                num_significant += 1
+        return num_significant < num_regs
+
+    def George(u, v):
+        # whether |v| can be coalesced into |u|
+        if sat[v] & ~sat[u] & _FREE_REG_MASK:
+            return False
+        return all(t in adj[u] or Degree(t) < num_regs for t in adj[v])
+
+    # the hottest moves are coalesced first
+    moves = [(u, v) for u in xrange(ig.num_vars)
+             for v in mrg.MoveRelated(u) if u < v]
+    moves.sort(key=lambda m: -(spill_costs[m[0]] + spill_costs[m[1]]))
+    for u, v in moves:
+        u, v = Find(u), Find(v)
+        if u == v or v in adj[u] or is_vector[u] != is_vector[v]:
+            continue
+        if u in frozen_vars or v in frozen_vars:
+            continue
+        if George(v, u):
+            u, v = v, u
+        elif not (George(u, v) or Briggs(u, v)):
+            continue
+        # coalesces |v| into |u|
+        alias[v] = u
+        for t in adj[v]:
+            adj[t].discard(v)
+            adj[t].add(u)
+            adj[u].add(t)
+        adj[v] = set()
+        sat[u] |= sat[v]
+
+    reps = [u for u in xrange(ig.num_vars) if Find(u) == u]
+    rep_ids = {u: i for i, u in enumerate(reps)}
+    coalesced_ig = _InferenceGraph([ig.VarNode(u) for u in reps])
+    coalesced_mrg = _MoveRelatedGraph()
+    coalesced_spill_costs = [0.0] * len(reps)
+    for u in reps:
+        coalesced_mrg.AddVar(rep_ids[u])
+        coalesced_ig.AddSaturationMask(rep_ids[u], sat[u])
+        for t in adj[u]:
+            if u < t:
+                coalesced_ig.AddInterference(rep_ids[u], rep_ids[t])
+    for u, v in moves:
+        u, v = rep_ids[Find(u)], rep_ids[Find(v)]
+        if u != v:
+            coalesced_mrg.AddMoveRelated(u, v)
+    coalesced_into = {}
+    for u in xrange(ig.num_vars):
+        coalesced_spill_costs[rep_ids[Find(u)]] += spill_costs[u]
+        if Find(u) != u:
+            coalesced_into[GetNodeVar(ig.VarNode(u))] = \
+                GetNodeVar(ig.VarNode(Find(u)))
+    return coalesced_ig, coalesced_mrg, coalesced_spill_costs, coalesced_into
+
+
+class _DSaturQueue(object):
+    '''The unassigned variables of an _InferenceGraph, in DSatur order
+
+    Pop() returns the variable with the most registers in its saturation,
+    then with the most interfered variables, then with the smallest id.
+    There is a heap for every saturation degree. A variable whose
+    saturation grows is pushed again into the heap of its new degree, and
+    its old entry is skipped when popped. A saturation has at most one bit
+    per register, so a variable is pushed a bounded number of times.
+    '''
+
+    def __init__(self, ig):
+        self._ig = ig
+        self._sat_degree = [PopCount(ig.Saturation(u))
+                            for u in xrange(ig.num_vars)]
+        self._buckets = [[] for _ in xrange(x86c.NUM_REGS + 1)]
+        self._assigned = bytearray(ig.num_vars)
+        self._num_unassigned = ig.num_vars
+        for u in xrange(ig.num_vars):
+            self._Push(u)
+        for bucket in self._buckets:
+            heapq.heapify(bucket)
+
+    def __len__(self):
+        return self._num_unassigned
+
+    def _Push(self, u):
+        # heapq is a min-heap
+        self._buckets[self._sat_degree[u]].append(
+            (-len(self._ig.Interfered(u)), u))
+
+    def Update(self, u):
+        '''
+        Must be called after the saturation of |u| has changed.
+        '''
+        if self._assigned[u]:
+            return
+        sat_degree = PopCount(self._ig.Saturation(u))
+        if sat_degree != self._sat_degree[u]:
+            self._sat_degree[u] = sat_degree
+            heapq.heappush(self._buckets[sat_degree],
+                           (-len(self._ig.Interfered(u)), u))
+
+    def Pop(self):
+        for sat_degree in reversed(xrange(len(self._buckets))):
+            bucket = self._buckets[sat_degree]
+            while bucket:
+                _, u = heapq.heappop(bucket)
+                if not self._assigned[u] and \
+                        self._sat_degree[u] == sat_degree:
+                    self._assigned[u] = 1
+                    self._num_unassigned -= 1
+                    return u
+        raise IndexError('Pop from an empty _DSaturQueue')
+
+
+# how often a TmpIf branch is executed, relative to the TmpIf itself
+_BRANCH_FREQ = 0.5
+
+
+def _AddSpillCosts(spill_costs, var_ids, instr_list, freq):
+    '''
+    Adds |freq| to the spill cost of a variable for each use or def of it in
+    |instr_list|, which is executed |freq| times as often as the program. A
+    loop body would be weighted the same way, once there are loops.
+    '''
+    for instr in instr_list:
+        if IsX86CallCNode(instr):
+            continue
+        elif IsX86TmpIfNode(instr):
+            branch_freq = freq * _BRANCH_FREQ
+            _AddSpillCosts(spill_costs, var_ids, GetX86TmpIfThen(instr),
+                           branch_freq)
+            _AddSpillCosts(spill_costs, var_ids, GetX86TmpIfElse(instr),
+                           branch_freq)
+        else:
+            if IsX86SiRetNode(instr):
+                operand_list = [GetX86SiRetArg(instr)]
+            else:
+                operand_list = GetX86InstrOperandList(instr)
+            for op in operand_list:
+                if IsX86VarNode(op):
+                    spill_costs[var_ids[GetNodeVar(op)]] += freq
+
+
+def _SpillCosts(x86_ast):
+    '''
+    Returns a list of the spill cost of every variable, by id. It estimates
+    the number of memory accesses if the variable is on the stack.
+    '''
+    var_ids = _VarIdsOfProgram(x86_ast)
+    spill_costs = [0.0] * len(var_ids)
+    _AddSpillCosts(spill_costs, var_ids, GetX86ProgramInstrList(x86_ast), 1.0)
+    return spill_costs
+
+
+def _AssignSpillSlots(ig, spilled_vars, base_reg, var_assigned_loc):
+    '''
+    Colors |spilled_vars| onto the slots below |base_reg|. Two of them share
+    a slot unless they interfere. Fills |var_assigned_loc|, returns the
+    size of the slots.
+    '''
+    # a mapping from var id to slot index, only for |spilled_vars|
+    var_slot = {}
+    num_slots = 0
+    # color the variables of the highest degree first, like Welsh-Powell
+    for sv in sorted(spilled_vars,
+                     key=lambda sv: (-len(ig.Interfered(sv)), sv)):
+        used_slots = {var_slot[iv] for iv in ig.Interfered(sv)
+                      if iv in var_slot}
+        slot = 0
+        while slot in used_slots:
+            slot += 1
+        var_slot[sv] = slot
+        num_slots = max(num_slots, slot + 1)
+        var_assigned_loc[sv] = MakeX86DerefNode(
+            base_reg, -(slot + 1) * x86c.DWORD_SIZE)
+    return num_slots * x86c.DWORD_SIZE
+
+
+def _AllocateRegisterOrStack(ig, mrg, spill_costs, use_mr):
+    '''
+    Returns a tuple of (a dict of var name => loc X86 node, stack size,
+    rootstack size).
+    '''
+    # the variables not assigned a loc
+    unassigned_vars = _DSaturQueue(ig)
+    # a mapping from var id to loc X86 node
     var_assigned_loc = {}
+    # the registers a variable cannot use because of the instructions,
+    # rather than because of the registers of its interfered variables
+    fixed_sat = [ig.Saturation(u) for u in xrange(ig.num_vars)]
 
-    free_regs = {r for r in x86c.FreeRegs()}
-    stack_pos, rootstack_pos = 0, 0
-
-    def TopUnassignedVar():
-        curmax, chosen = -1, None
-        for uv in unassigned_var_names:
-            len_var_sat = len(ig._var_saturation[uv])
-            if len_var_sat > curmax:
-                curmax, chosen = len_var_sat, uv
-        return uv
-
-    def TryMoveRelatedRegister(uv, uv_sat, interfered):
-        move_related = mrg.MoveRelated(uv) - interfered
-        for mr in move_related:
-            if mr in var_assigned_loc:
+    free_regs = list(x86c.FreeRegs())
+    # the spilled variables, in the order they are spilled
+    stack_spilled_vars, rootstack_spilled_vars = [], []
+
+    def TryMoveRelatedRegister(uv, uv_sat):
+        for mr in mrg.MoveRelated(uv):
+            if mr in var_assigned_loc and not ig.HasInterference(uv, mr):
                 maybe_loc = var_assigned_loc[mr]
-                if IsX86RegNode(maybe_loc) and ig.LocRepr(maybe_loc) not in uv_sat:
+                if IsX86RegNode(maybe_loc) and \
+                        not (x86c.RegBit(GetX86Reg(maybe_loc)) & uv_sat):
                     return maybe_loc
         return None
 
-    def IsVarVector(var_name):
-        var = var_name_dict[var_name]
-        return IsValidStaticTypeVector(GetNodeStaticType(var))
-
-    while len(unassigned_var_names):
-        uv = TopUnassignedVar()
-        uv_sat = ig._var_saturation[uv]
-        interfered = ig.Interfered(uv)
-        loc = TryMoveRelatedRegister(
-            uv, uv_sat, interfered) if use_mr else None
+    def TryEvictRegister(uv):
+        '''
+        Finds the register whose interfered holders are cheaper to spill
+        than |uv|. Returns a tuple of (the register or None, the holders).
+        '''
+        holders = {r: [] for r in free_regs
+                   if not (x86c.RegBit(r) & fixed_sat[uv])}
+        for iv in ig.Interfered(uv):
+            iv_loc = var_assigned_loc.get(iv)
+            if iv_loc is not None and IsX86RegNode(iv_loc) and \
+                    GetX86Reg(iv_loc) in holders:
+                holders[GetX86Reg(iv_loc)].append(iv)
+        best_reg, best_cost = None, spill_costs[uv]
+        for r in free_regs:
+            if r not in holders:
+                continue
+            cost = sum(spill_costs[iv] for iv in holders[r])
+            if cost < best_cost:
+                best_reg, best_cost = r, cost
+        return best_reg, holders.get(best_reg, [])
+
+    def IsVarVector(uv):
+        return IsValidStaticTypeVector(GetNodeStaticType(ig.VarNode(uv)))
+
+    while len(unassigned_vars):
+        uv = unassigned_vars.Pop()
+        uv_sat = ig.Saturation(uv)
+        loc = TryMoveRelatedRegister(uv, uv_sat) if use_mr else None
+        spilled_vars = []
         if loc is None:
-            selectable_regs = list(free_regs - uv_sat)
+            selectable_regs = [r for r in free_regs
+                               if not (x86c.RegBit(r) & uv_sat)]
             if len(selectable_regs):
                 # select a register
-                reg_name = selectable_regs[0]
-                loc = MakeX86RegNode(reg_name)
-            elif IsVarVector(uv):
-                rootstack_pos -= x86c.DWORD_SIZE
-                loc = MakeX86DerefNode(x86c.R15, rootstack_pos)
+                loc = MakeX86RegNode(selectable_regs[0])
+            else:
+                reg_name, evicted_vars = TryEvictRegister(uv)
+                if reg_name is not None:
+                    # the evicted variables are spilled instead of |uv|
+                    loc = MakeX86RegNode(reg_name)
+                    spilled_vars = evicted_vars
+                else:
+                    spilled_vars = [uv]
+        if loc is not None:
+            var_assigned_loc[uv] = loc
+            # a stack location does not saturate the interfered variables
+            reg_bit = x86c.RegBit(GetX86Reg(loc))
+            for iv in ig.Interfered(uv):
+                if not ig.Saturation(iv) & reg_bit:
+                    ig.AddSaturationMask(iv, reg_bit)
+                    unassigned_vars.Update(iv)
+        for sv in spilled_vars:
+            # a spilled variable gets its slot after all are spilled
+            var_assigned_loc.pop(sv, None)
+            if IsVarVector(sv):
+                rootstack_spilled_vars.append(sv)
             else:
-                # select a stack position
-                stack_pos -= x86c.DWORD_SIZE
-                loc = MakeX86DerefNode(x86c.RBP, stack_pos)
-        var_assigned_loc[uv] = loc
-        for iv in interfered:
-            ig.AddSaturation(iv, loc)
-        unassigned_var_names.remove(uv)
-    stack_sz, rootstack_sz = -stack_pos, -rootstack_pos
+                stack_spilled_vars.append(sv)
+
+    stack_sz = _AssignSpillSlots(
+        ig, stack_spilled_vars, x86c.RBP, var_assigned_loc)
+    rootstack_sz = _AssignSpillSlots(
+        ig, rootstack_spilled_vars, x86c.R15, var_assigned_loc)
+    var_assigned_loc = {GetNodeVar(ig.VarNode(u)): loc
+                        for u, loc in var_assigned_loc.iteritems()}
     return var_assigned_loc, stack_sz, rootstack_sz
 
 
@@ -1318,26 +2022,27 @@ def _AssignAllocatedLocByInstrList(instr_list, var_assigned_loc_map):
     return instr_list
 
 
-def _RemoveSameMov(instr_list):
-    def AreSrcDstSame(src, dst):
-        stype, dtype = TypeOf(src), TypeOf(dst)
-        if stype != dtype:
-            return False
-        if stype not in {X86_REG_NODE_T, X86_DEREF_NODE_T}:
-            return False
+def _AreSameLocs(src, dst):
+    stype, dtype = TypeOf(src), TypeOf(dst)
+    if stype != dtype:
+        return False
+    if stype not in {X86_REG_NODE_T, X86_DEREF_NODE_T}:
+        return False
+
+    sreg, dreg = GetX86Reg(src), GetX86Reg(dst)
+    if sreg != dreg:
+        return False
+    if stype == X86_DEREF_NODE_T:
+        return GetX86DerefOffset(src) == GetX86DerefOffset(dst)
+    return True
 
-        sreg, dreg = GetX86Reg(src), GetX86Reg(dst)
-        if sreg != dreg:
-            return False
-        if stype == X86_DEREF_NODE_T:
-            return GetX86DerefOffset(src) == GetX86DerefOffset(dst)
-        return True
 
+def _RemoveSameMov(instr_list):
     new_instr_list = []
     for i, instr in enumerate(instr_list):
         if IsX86InstrNode(instr) and GetX86Instr(instr) in {x86c.MOVE, x86c.MOVEZB}:
             src, dst = GetX86InstrOperandList(instr)
-            if AreSrcDstSame(src, dst):
+            if _AreSameLocs(src, dst):
                 continue
         elif IsX86TmpIfNode(instr):
             then_instr_list = _RemoveSameMov(GetX86TmpIfThen(instr))
@@ -1348,18 +2053,65 @@ def _RemoveSameMov(instr_list):
     return new_instr_list
 
 
+# the times the coalescing is redone at most, see _AllocateCoalesced()
+_MAX_COALESCE_ROUNDS = 3
+
+
+def _AllocateCoalesced(ig, mrg, spill_costs):
+    '''
+    Allocates the variables of |ig| once they are coalesced. DSatur may
+    still spill a coalesced variable where its members alone would not be,
+    so the members of a spilled one are left out of the coalescing, which is
+    then redone. |ig| is left as is.
+
+    Returns the same as _AllocateRegisterOrStack(), for the variables of |ig|.
+    '''
+    var_ids = {GetNodeVar(ig.VarNode(u)): u for u in xrange(ig.num_vars)}
+    frozen_vars = set()
+    for _ in xrange(_MAX_COALESCE_ROUNDS):
+        coalesced_ig, coalesced_mrg, coalesced_spill_costs, coalesced_into = \
+            _CoalesceMoves(ig, mrg, spill_costs, frozen_vars)
+        allocation = _AllocateRegisterOrStack(
+            coalesced_ig, coalesced_mrg, coalesced_spill_costs, True)
+        var_assigned_loc_map = allocation[0]
+        num_frozen_vars = len(frozen_vars)
+        for var, into in coalesced_into.iteritems():
+            var_assigned_loc_map[var] = var_assigned_loc_map[into]
+            if IsX86DerefNode(var_assigned_loc_map[into]):
+                frozen_vars.add(var_ids[var])
+                frozen_vars.add(var_ids[into])
+        if len(frozen_vars) == num_frozen_vars:
+            break
+    return allocation
+
+
+def _NumSpilledVars(var_assigned_loc_map):
+    return sum(1 for loc in var_assigned_loc_map.itervalues()
+               if IsX86DerefNode(loc))
+
+
 def AllocateRegisterOrStack(x86_ast, use_mr=True, rm_same_mov=True):
     assert IsX86ProgramNode(x86_ast)
 
     ig = _BuildInterferenceGraph(x86_ast)
     mrg = _BuildMoveRelatedGraph(x86_ast)
-    var_name_dict = _ConvertVarListToVarNameDict(GetNodeVarList(x86_ast))
     # mrg = None
+    spill_costs = _SpillCosts(x86_ast)
     x86_ast = _ReplaceX86SiRets(x86_ast)
-
-    var_assigned_loc_map, stack_sz, rootstack_sz = _AllocateRegisterOrStack(
-        ig, mrg, var_name_dict, use_mr)
-    assert len(var_assigned_loc_map) == len(var_name_dict)
+    num_vars = ig.num_vars
+    allocation = None
+    if use_mr:
+        allocation = _AllocateCoalesced(ig, mrg, spill_costs)
+    if allocation is None or _NumSpilledVars(allocation[0]):
+        # the coalescing is kept only if it spills no more variables than
+        # the allocation with use_mr=False
+        plain_allocation = _AllocateRegisterOrStack(
+            ig, mrg, spill_costs, False)
+        if allocation is None or _NumSpilledVars(plain_allocation[0]) < \
+                _NumSpilledVars(allocation[0]):
+            allocation = plain_allocation
+    var_assigned_loc_map, stack_sz, rootstack_sz = allocation
+    assert len(var_assigned_loc_map) == num_vars
 
     instr_list = GetX86ProgramInstrList(x86_ast)
     instr_list = _AssignAllocatedLocByInstrList(
@@ -1372,6 +2124,11 @@ def AllocateRegisterOrStack(x86_ast, use_mr=True, rm_same_mov=True):
     # the stack size is computed at this time
     SetX86ProgramStackSize(x86_ast, stack_sz)
     SetX86ProgramRootstackSize(x86_ast, rootstack_sz)
+    SetX86ProgramNumSpilledVars(x86_ast, _NumSpilledVars(var_assigned_loc_map))
+    used_regs = {GetX86Reg(loc) for loc in var_assigned_loc_map.itervalues()
+                 if IsX86RegNode(loc)}
+    SetX86ProgramCalleeSavedRegs(
+        x86_ast, [r for r in x86c.CalleeSaveRegs() if r in used_regs])
 
     return x86_ast
 
@@ -1409,21 +2166,20 @@ _INTERNAL_LABEL_HEADER = '@@'
 
 class _IfLabelAllocator(object):
 
-    def __init__(self):
-        self._next_label = 0
+    def __init__(self, gensym):
+        self._gensym = gensym
 
     def Allocate(self):
-        idx = self._next_label
-        self._next_label += 1
+        idx = self._gensym.NextIndex()
         t = '{}IF_T_{}'.format(_INTERNAL_LABEL_HEADER, idx)
         f = '{}IF_F_{}'.format(_INTERNAL_LABEL_HEADER, idx)
         s = '{}IF_S_{}'.format(_INTERNAL_LABEL_HEADER, idx)
         return t, f, s
 
 
-def LowerTmpIf(x86_ast):
+def LowerTmpIf(x86_ast, gensym=None):
     assert IsX86ProgramNode(x86_ast)
-    if_label_allocator = _IfLabelAllocator()
+    if_label_allocator = _IfLabelAllocator(gensym or Gensym())
     instr_list = GetX86ProgramInstrList(x86_ast)
     instr_list = _LowerTmpIfByInstrList(instr_list, if_label_allocator)
     SetX86ProgramInstrList(x86_ast, instr_list)
@@ -1436,11 +2192,19 @@ are all memory references, or deref nodes.
 '''
 
 
+# a global value is a memory reference relative to %rip
+_X86_MEMORY_NODE_TYPES = {X86_DEREF_NODE_T, INTERNAL_GLOBAL_VALUE_NODE_T}
+
+
 def PatchInstruction(x86_ast):
     assert LangOf(x86_ast) == X86_LANG and TypeOf(x86_ast) == PROGRAM_NODE_T
     instr_list = GetX86ProgramInstrList(x86_ast)
     stack_sz = GetX86ProgramStackSize(x86_ast)
     rootstack_sz = GetX86ProgramRootstackSize(x86_ast)
+    callee_saved_regs = GetX86ProgramCalleeSavedRegs(x86_ast)
+    if len(callee_saved_regs) % 2:
+        # keeps %rsp aligned to 16 bytes at the calls
+        stack_sz += x86c.DWORD_SIZE
     heap_sz = 16384  # 16 MB
     # a instruction might be splitted into two, hence we need a new list.
     new_instr_list = []
@@ -1450,10 +2214,14 @@ def PatchInstruction(x86_ast):
             logue = GetX86CallCLogue(instr)
             if logue == X86_CALLC_PROLOGUE:
                 # pushq   %rbp
+                # pushq   %rbx  # the used callee save registers
                 # movq    %rsp, %rbp
                 # subq    $16, %rsp
                 instr = MakeX86InstrNode(x86c.PUSH, MakeX86RegNode(x86c.RBP))
                 new_instr_list.append(instr)
+                for reg in callee_saved_regs:
+                    instr = MakeX86InstrNode(x86c.PUSH, MakeX86RegNode(reg))
+                    new_instr_list.append(instr)
                 instr = MakeX86InstrNode(x86c.MOVE, MakeX86RegNode(
                     x86c.RSP), MakeX86RegNode(x86c.RBP))
                 new_instr_list.append(instr)
@@ -1493,12 +2261,16 @@ def PatchInstruction(x86_ast):
                     rootstack_sz), MakeX86RegNode(x86c.R15))
                 new_instr_list.append(instr)
                 # addq    $16, %rsp
+                # popq    %rbx
                 # popq    %rbp
                 # retq
                 if stack_sz > 0:
                     instr = MakeX86InstrNode(x86c.ADD, MakeX86IntNode(
                         stack_sz), MakeX86RegNode(x86c.RSP))
                     new_instr_list.append(instr)
+                for reg in reversed(callee_saved_regs):
+                    instr = MakeX86InstrNode(x86c.POP, MakeX86RegNode(reg))
+                    new_instr_list.append(instr)
                 instr = MakeX86InstrNode(x86c.POP, MakeX86RegNode(x86c.RBP))
                 new_instr_list.append(instr)
                 instr = MakeX86InstrNode(x86c.RET)
@@ -1515,8 +2287,21 @@ def PatchInstruction(x86_ast):
                 new_instr_list.append(new_instr)
                 has_appended = True
                 instr = new_instr  # this is only needed for the check below
-            if TypeOf(op1) == X86_DEREF_NODE_T and \
-                    TypeOf(op2) == X86_DEREF_NODE_T:
+            if method == x86c.MOVEZB and \
+                    TypeOf(op2) in _X86_MEMORY_NODE_TYPES:
+                # movzbq  %al, -8(%rbp)
+                # =>
+                # movzbq  %al, %rax
+                # movq    %rax, -8(%rbp)
+                tmp_ref = MakeX86RegNode(x86c.RAX)
+                new_instr = MakeX86InstrNode(x86c.MOVEZB, op1, tmp_ref)
+                new_instr_list.append(new_instr)
+                new_instr = MakeX86InstrNode(x86c.MOVE, tmp_ref, op2)
+                new_instr_list.append(new_instr)
+                has_appended = True
+                instr = new_instr  # this is only needed for the check below
+            elif TypeOf(op1) in _X86_MEMORY_NODE_TYPES and \
+                    TypeOf(op2) in _X86_MEMORY_NODE_TYPES:
                 tmp_ref = MakeX86RegNode(x86c.RAX)
                 new_instr = MakeX86InstrNode(x86c.MOVE, op1, tmp_ref)
                 new_instr_list.append(new_instr)
@@ -1533,6 +2318,407 @@ def PatchInstruction(x86_ast):
     return x86_ast
 
 
+'''Peephole pass
+Rewrites the short patterns of the final instructions into cheaper ones.
+A rule looks at a window of instructions, and could ask whether a register
+or the flags are dead after an instruction. The answer comes from the live
+sets of every instruction, computed once by a backward pass over the list.
+'''
+
+
+# a called function only reads the argument registers
+_CALL_ARG_REGS = {x86c.RDI, x86c.RSI, x86c.RDX, x86c.RCX, x86c.R8, x86c.R9}
+_X86_INSTRS_WRITE_FLAGS = {x86c.ADD, x86c.CMP, x86c.NEG, x86c.SUB, x86c.XOR}
+_X86_INSTRS_READ_FLAGS = {x86c.JMP_IF, x86c.SET}
+
+
+def _SplitCc(instr):
+    '''
+    Returns a tuple of (the instruction, its condition code or None).
+    '''
+    try:
+        instr, cc = DecodeCcFromInstr(instr)
+        return instr, cc
+    except ValueError:
+        return instr, None
+
+
+def _UsesReg(op, reg):
+    # a deref uses its base register
+    return TypeOf(op) in {X86_REG_NODE_T, X86_BYTE_REG_NODE_T,
+                          X86_DEREF_NODE_T} and GetX86Reg(op) == reg
+
+
+def _MayAlias(dst, op):
+    '''
+    Returns True if writing |dst| could change the value of |op|.
+    '''
+    if IsX86IntNode(op):
+        return False
+    if TypeOf(dst) in {X86_REG_NODE_T, X86_BYTE_REG_NODE_T}:
+        # %al is a part of %rax, and either could be the base of |op|
+        return _UsesReg(op, GetX86Reg(dst))
+    if TypeOf(op) in {X86_REG_NODE_T, X86_BYTE_REG_NODE_T}:
+        return False
+    if IsX86DerefNode(dst) and IsX86DerefNode(op) and \
+            GetX86Reg(dst) == GetX86Reg(op):
+        return GetX86DerefOffset(dst) == GetX86DerefOffset(op)
+    # two memory references with different bases
+    return True
+
+
+# A live set is an int. Every register has a bit for its low byte and
+# another one for the rest of it, so that `set<cc> %al` only kills the low
+# byte of %rax. The flags have one bit above those of the registers.
+
+
+def _RegLiveMask(reg):
+    bit = x86c.RegBit(reg)
+    return bit | (bit << x86c.NUM_REGS)
+
+
+def _RegsLiveMask(regs):
+    mask = x86c.RegMask(regs)
+    return mask | (mask << x86c.NUM_REGS)
+
+
+def _LowByteLiveMask(reg):
+    return x86c.RegBit(reg) << x86c.NUM_REGS
+
+
+_FLAGS_LIVE_MASK = 1 << (2 * x86c.NUM_REGS)
+_ALL_REGS_LIVE_MASK = _FLAGS_LIVE_MASK - 1
+_ALL_LIVE_MASK = _ALL_REGS_LIVE_MASK | _FLAGS_LIVE_MASK
+_CALL_ARG_LIVE_MASK = _RegsLiveMask(_CALL_ARG_REGS)
+_CALLER_SAVE_LIVE_MASK = _RegsLiveMask(x86c.CallerSaveRegs())
+
+
+def _ReadLiveMask(op):
+    '''
+    Returns the live set of the registers read through |op|.
+    '''
+    if IsX86ByteRegNode(op):
+        return _LowByteLiveMask(GetX86Reg(op))
+    if TypeOf(op) in {X86_REG_NODE_T, X86_DEREF_NODE_T}:
+        # a deref reads its base register
+        return _RegLiveMask(GetX86Reg(op))
+    return 0
+
+
+def _LiveBefore(method, operand_list, live_after):
+    '''
+    Returns the live set before an instruction, given the one after it. A
+    jump only reads the flags, its live set after is up to the caller.
+    '''
+    if method == x86c.CALL:
+        # the callee could write any caller save register and the flags
+        live_after &= ~(_CALLER_SAVE_LIVE_MASK | _FLAGS_LIVE_MASK)
+        return live_after | _CALL_ARG_LIVE_MASK
+    elif method == x86c.RET:
+        # %rax is the result, the others are restored for the caller
+        return _ALL_REGS_LIVE_MASK
+
+    kill, gen = 0, 0
+    if method in _X86_INSTRS_WRITE_FLAGS:
+        kill |= _FLAGS_LIVE_MASK
+    if method in _X86_INSTRS_READ_FLAGS:
+        gen |= _FLAGS_LIVE_MASK
+    read_ops = operand_list
+    if method == x86c.SET:
+        kill |= _LowByteLiveMask(GetX86Reg(operand_list[0]))
+        read_ops = []
+    elif method == x86c.POP or \
+            method in _X86_INSTRS_WRITE_DST and \
+            method not in _X86_INSTRS_READ_DST:
+        read_ops, dst = operand_list[:-1], operand_list[-1]
+        if TypeOf(dst) == X86_REG_NODE_T:
+            kill |= _RegLiveMask(GetX86Reg(dst))
+        else:
+            gen |= _ReadLiveMask(dst)
+    elif method == x86c.XOR and _AreSameLocs(*operand_list) and \
+            TypeOf(operand_list[0]) == X86_REG_NODE_T:
+        # xor r, r does not depend on r
+        kill |= _RegLiveMask(GetX86Reg(operand_list[0]))
+        read_ops = []
+    for op in read_ops:
+        gen |= _ReadLiveMask(op)
+    return (live_after & ~kill) | gen
+
+
+def _MakePeepholeEntry(instr, live_after=0):
+    '''
+    Returns a list of (instruction node, instruction, condition code, operand
+    list, live set after it), where the middle three are None for a label.
+    '''
+    if IsX86InstrNode(instr):
+        method, cc = _SplitCc(GetX86Instr(instr))
+        return [instr, method, cc, GetX86InstrOperandList(instr), live_after]
+    return [instr, None, None, None, live_after]
+
+
+def _ComputePeepholeLiveAfters(entries):
+    '''
+    Fills the live sets after every entry of |entries|. Everything is live
+    at the end of the list and at a label out of it.
+    '''
+    label_index = {GetX86Label(entry[0]): i
+                   for i, entry in enumerate(entries) if entry[1] is None}
+    has_backward_jump = False
+    for i, (_, method, _, operand_list, _) in enumerate(entries):
+        if method in {x86c.JMP, x86c.JMP_IF}:
+            label = GetX86Label(operand_list[0])
+            has_backward_jump |= label_index.get(label, len(entries)) <= i
+    # the live set before every entry, and at the end of the list
+    live_befores = [0] * len(entries) + [_ALL_LIVE_MASK]
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(xrange(len(entries))):
+            entry = entries[i]
+            method, operand_list = entry[1], entry[3]
+            if method in {x86c.JMP, x86c.JMP_IF}:
+                label = GetX86Label(operand_list[0])
+                live_after = live_befores[label_index[label]] \
+                    if label in label_index else _ALL_LIVE_MASK
+                if method == x86c.JMP_IF:
+                    live_after |= live_befores[i + 1]
+            elif method == x86c.RET:
+                live_after = 0
+            else:
+                live_after = live_befores[i + 1]
+            entry[4] = live_after
+            if method is not None:
+                live_after = _LiveBefore(method, operand_list, live_after)
+            if live_after != live_befores[i]:
+                live_befores[i] = live_after
+                changed = True
+        # the live sets only grow, and without a backward jump, every label
+        # is reached after its jumps
+        changed = changed and has_backward_jump
+
+
+class _PeepholeWindow(object):
+    '''The instructions a peephole rule sees, from the one being rewritten
+    '''
+
+    def __init__(self, pending):
+        # the entries not rewritten yet, in the reverse order
+        self._pending = pending
+
+    def _Entry(self, k):
+        # None if it is out of the list
+        i = len(self._pending) - 1 - k
+        if i >= 0:
+            return self._pending[i]
+        return None
+
+    def __getitem__(self, k):
+        entry = self._Entry(k)
+        return entry[0] if entry is not None else None
+
+    def Decode(self, k):
+        '''
+        Returns a tuple of (instruction, condition code, operand list) of the
+        k-th instruction, or a tuple of None if it is not an instruction.
+        '''
+        entry = self._Entry(k)
+        if entry is not None:
+            return entry[1], entry[2], entry[3]
+        return None, None, None
+
+    def IsRegDeadAfter(self, k, reg):
+        return not self._Entry(k)[4] & _RegLiveMask(reg)
+
+    def AreFlagsDeadAfter(self, k):
+        return not self._Entry(k)[4] & _FLAGS_LIVE_MASK
+
+
+# A rule returns None if it does not match the window, otherwise a tuple of
+# (the number of the instructions it replaces, the new instructions).
+
+
+def _PeepholeSelfMove(window):
+    # mov a, a  =>
+    method, _, operand_list = window.Decode(0)
+    if method == x86c.MOVE and _AreSameLocs(*operand_list):
+        return 1, []
+    return None
+
+
+def _PeepholeRedundantMove(window):
+    # mov a, b; mov b, a  =>  mov a, b
+    method0, _, operand_list0 = window.Decode(0)
+    method1, _, operand_list1 = window.Decode(1)
+    if method0 != x86c.MOVE or method1 != x86c.MOVE:
+        return None
+    src, dst = operand_list0
+    if _AreSameLocs(src, operand_list1[1]) and \
+            _AreSameLocs(dst, operand_list1[0]) and \
+            not _MayAlias(dst, src):
+        return 2, [window[0]]
+    return None
+
+
+def _PeepholeRedundantLoad(window):
+    # mov a, r; op b, c; mov a, r  =>  mov a, r; op b, c
+    method0, _, operand_list0 = window.Decode(0)
+    method1, _, operand_list1 = window.Decode(1)
+    method2, _, operand_list2 = window.Decode(2)
+    if method0 != x86c.MOVE or method2 != x86c.MOVE:
+        return None
+    src, dst = operand_list0
+    if not (TypeOf(dst) == X86_REG_NODE_T and
+            _AreSameLocs(dst, operand_list2[1])):
+        return None
+    if not (_AreSameLocs(src, operand_list2[0]) or
+            IsX86IntNode(src) and IsX86IntNode(operand_list2[0]) and
+            GetIntX(src) == GetIntX(operand_list2[0])):
+        return None
+    if _UsesReg(src, GetX86Reg(dst)):
+        return None
+    if method1 in {x86c.CMP, x86c.PUSH}:
+        written = None
+    elif method1 in _X86_INSTRS_WRITE_DST or method1 == x86c.SET:
+        written = operand_list1[-1]
+    else:
+        # i.e. a call, a jump
+        return None
+    if written is not None and \
+            (_MayAlias(written, dst) or _MayAlias(written, src)):
+        return None
+    return 3, [window[0], window[1]]
+
+
+def _PeepholeFoldCmpImm(window):
+    # mov $i, %rax; cmp a, %rax; set<cc> ...  =>  cmp $i, a; set<swapped cc>
+    method0, _, operand_list0 = window.Decode(0)
+    method1, _, operand_list1 = window.Decode(1)
+    method2, cc, operand_list2 = window.Decode(2)
+    if method0 != x86c.MOVE or method1 != x86c.CMP or \
+            method2 not in _X86_INSTRS_READ_FLAGS:
+        return None
+    imm, tmp_ref = operand_list0
+    lhs, rhs = operand_list1
+    if not (IsX86IntNode(imm) and -2**31 <= GetIntX(imm) < 2**31):
+        return None
+    if not (TypeOf(tmp_ref) == X86_REG_NODE_T and _AreSameLocs(tmp_ref, rhs)):
+        return None
+    if IsX86IntNode(lhs) or _UsesReg(lhs, GetX86Reg(tmp_ref)):
+        return None
+    if not (window.IsRegDeadAfter(1, GetX86Reg(tmp_ref)) and
+            window.AreFlagsDeadAfter(2)):
+        return None
+    return 3, [MakeX86InstrNode(x86c.CMP, imm, lhs),
+               MakeX86InstrNode(EncodeCcIntoInstr(method2, x86c.SwapCc(cc)),
+                                *operand_list2)]
+
+
+def _PeepholeAddZero(window):
+    # add $0, a  =>
+    method, _, operand_list = window.Decode(0)
+    if method in {x86c.ADD, x86c.SUB} and IsX86IntNode(operand_list[0]) and \
+            GetIntX(operand_list[0]) == 0 and window.AreFlagsDeadAfter(0):
+        return 1, []
+    return None
+
+
+def _PeepholeZeroByXor(window):
+    # mov $0, r  =>  xor r, r
+    method, _, operand_list = window.Decode(0)
+    if method != x86c.MOVE:
+        return None
+    src, dst = operand_list
+    if IsX86IntNode(src) and GetIntX(src) == 0 and \
+            TypeOf(dst) == X86_REG_NODE_T and window.AreFlagsDeadAfter(0):
+        return 1, [MakeX86InstrNode(x86c.XOR, dst, dst)]
+    return None
+
+
+def _PeepholeJumpToNext(window):
+    # jmp L; L:  =>  L:
+    method, _, operand_list = window.Decode(0)
+    if method not in {x86c.JMP, x86c.JMP_IF}:
+        return None
+    label = GetX86Label(operand_list[0])
+    k = 1
+    while window[k] is not None and IsX86LabelDefNode(window[k]):
+        if GetX86Label(window[k]) == label:
+            return 1, []
+        k += 1
+    return None
+
+
+# (name, rule), tried in this order at every position
+_PEEPHOLE_RULES = [
+    ('self-move', _PeepholeSelfMove),
+    ('redundant-move', _PeepholeRedundantMove),
+    ('redundant-load', _PeepholeRedundantLoad),
+    ('fold-cmp-imm', _PeepholeFoldCmpImm),
+    ('add-zero', _PeepholeAddZero),
+    ('zero-by-xor', _PeepholeZeroByXor),
+    ('jump-to-next', _PeepholeJumpToNext),
+]
+
+PEEPHOLE_RULE_NAMES = tuple(name for name, _ in _PEEPHOLE_RULES)
+
+
+def _PeepholeInstrList(instr_list, rules, rewrite_counts):
+    entries = [_MakePeepholeEntry(instr) for instr in instr_list]
+    _ComputePeepholeLiveAfters(entries)
+    pending = entries[::-1]
+    done = []
+    window = _PeepholeWindow(pending)
+    while pending:
+        for name, rule in rules:
+            rewrite = rule(window)
+            if rewrite is not None:
+                break
+        else:
+            done.append(pending.pop())
+            continue
+        num_replaced, new_instrs = rewrite
+        rewrite_counts[name] += 1
+        # A rewrite does not make anything live before it, so the live sets
+        # of the other entries still hold, if not as tight.
+        live_after = pending[-num_replaced][4]
+        del pending[-num_replaced:]
+        for instr in reversed(new_instrs):
+            entry = _MakePeepholeEntry(instr, live_after)
+            pending.append(entry)
+            live_after = _LiveBefore(entry[1], entry[3], live_after)
+        # a rewrite could expose another one, which starts at most two
+        # instructions before
+        num_instrs = 0
+        while done and num_instrs < 2:
+            entry = done.pop()
+            pending.append(entry)
+            if entry[1] is not None:
+                num_instrs += 1
+    return [entry[0] for entry in done]
+
+
+def Peephole(x86_ast, rules=None):
+    '''
+    rules: optional, the names of the rules to apply, see
+           PEEPHOLE_RULE_NAMES. All of them by default.
+    The number of the rewrites of every rule is stored into the program,
+    see GetX86ProgramRewriteCounts().
+    '''
+    assert IsX86ProgramNode(x86_ast)
+    if rules is None:
+        rules = PEEPHOLE_RULE_NAMES
+    for name in rules:
+        if name not in PEEPHOLE_RULE_NAMES:
+            raise ValueError('Unknown peephole rule={}'.format(name))
+    rules = [(name, rule) for name, rule in _PEEPHOLE_RULES if name in rules]
+    rewrite_counts = {name: 0 for name, _ in rules}
+    instr_list = _PeepholeInstrList(
+        GetX86ProgramInstrList(x86_ast), rules, rewrite_counts)
+    SetX86ProgramInstrList(x86_ast, instr_list)
+    SetX86ProgramRewriteCounts(x86_ast, rewrite_counts)
+    return x86_ast
+
+
 '''Generate X86 pass
 '''
 
@@ -1546,15 +2732,34 @@ Calls all the passes on the Scheme AST.
 '''
 
 
-def Compile(sch_ast):
-    sch_ast = ExposeAllocation(sch_ast)
-    sch_ast = Uniquify(sch_ast)
-    ir_ast = Flatten(sch_ast)
-    x86_ast = SelectInstruction(ir_ast)
-    x86_ast = UncoverLive(x86_ast)
-    x86_ast = AllocateRegisterOrStack(x86_ast)
-    x86_ast = LowerTmpIf(x86_ast)
-    x86_ast = PatchInstruction(x86_ast)
-    x86_ast = GenerateX86(x86_ast)
+def Compile(sch_ast, use_mr=True, rm_same_mov=True, dumps=None,
+            pass_manager=None, peephole_rules=None):
+    '''
+    dumps: optional, a dict. If provided, the source code of the IR AST and
+           of the final X86 AST are stored into it under 'ir' and 'x86'.
+    pass_manager: optional, a PassManager to run the passes with.
+    peephole_rules: optional, the names of the peephole rules to apply, all
+                    of them by default.
+    '''
+    pm = pass_manager or PassManager()
+    # shared by the passes, so that all the generated names are unique
+    gensym = Gensym()
+    sch_ast = pm.Run('PartialEval', PartialEval, sch_ast)
+    sch_ast = pm.Run('ExposeAllocation', ExposeAllocation, sch_ast, gensym)
+    sch_ast = pm.Run('Uniquify', Uniquify, sch_ast)
+    ir_ast = pm.Run('Flatten', Flatten, sch_ast, gensym)
+    ir_ast = pm.Run('PropagateCopies', PropagateCopies, ir_ast)
+    if dumps is not None:
+        dumps['ir'] = IrSourceCode(ir_ast)
+    x86_ast = pm.Run('SelectInstruction', SelectInstruction, ir_ast)
+    x86_ast = pm.Run('UncoverLive', UncoverLive, x86_ast)
+    x86_ast = pm.Run('AllocateRegisterOrStack', AllocateRegisterOrStack,
+                     x86_ast, use_mr, rm_same_mov)
+    x86_ast = pm.Run('LowerTmpIf', LowerTmpIf, x86_ast, gensym)
+    x86_ast = pm.Run('PatchInstruction', PatchInstruction, x86_ast)
+    x86_ast = pm.Run('Peephole', Peephole, x86_ast, peephole_rules)
+    if dumps is not None:
+        dumps['x86'] = X86SourceCode(x86_ast, X86InternalFormatter())
+    x86_ast = pm.Run('GenerateX86', GenerateX86, x86_ast)
 
     return x86_ast
@@ -0,0 +1,73 @@
+'''Compiler driver
+Runs the whole pipeline on a piece of Scheme source code. A Driver keeps its
+lexer and parser, hence it can be reused to compile any number of programs.
+'''
+from lexer import SchemeLexer
+from parser import SchemeParser
+import analyzer as anlz
+from compiler import Compile
+from pass_manager import PassManager
+from ast.x86_ast import MacX86Formatter
+from cache import IR_DUMP_EXT, X86_DUMP_EXT
+
+
+class Driver(object):
+
+    def __init__(self, cache=None, use_mr=True, rm_same_mov=True,
+                 keep_dumps=False, peephole_rules=None):
+        '''
+        cache: optional, a CompileCache
+        keep_dumps: if True, the IR/X86 dumps are stored in |cache| as well
+        peephole_rules: optional, the names of the peephole rules to apply,
+                        all of them by default.
+        '''
+        self._lexer = SchemeLexer()
+        self._parser = SchemeParser()
+        self._cache = cache
+        self._use_mr = use_mr
+        self._rm_same_mov = rm_same_mov
+        self._keep_dumps = keep_dumps
+        self._peephole_rules = peephole_rules
+
+    @property
+    def options(self):
+        '''The options that affect the generated code
+        '''
+        return {
+            'use_mr': self._use_mr,
+            'rm_same_mov': self._rm_same_mov,
+            'peephole_rules': self._peephole_rules,
+            'target': MacX86Formatter.__name__,
+        }
+
+    def Parse(self, source):
+        # PLY keeps the line number and the state of the previous input
+        self._lexer.lineno = 1
+        self._lexer.begin('INITIAL')
+        return self._parser.parse(source, lexer=self._lexer)
+
+    def Compile(self, source, pass_manager=None):
+        '''
+        Returns the X86 assembly code of |source|.
+        pass_manager: optional, a PassManager to run the passes with. No pass
+                      is run on a cache hit.
+        '''
+        key = None
+        if self._cache is not None:
+            key = self._cache.Key(source, self.options)
+            # an entry written without the dumps is a miss if they are kept
+            dump_exts = (IR_DUMP_EXT, X86_DUMP_EXT) if self._keep_dumps else ()
+            asm = self._cache.Get(key, dump_exts)
+            if asm is not None:
+                return asm
+
+        pm = pass_manager or PassManager()
+        ast = pm.Run('Parse', self.Parse, source)
+        pm.Run('Analyze', anlz.analyze, ast)
+        dumps = {} if self._keep_dumps else None
+        asm = Compile(ast, self._use_mr, self._rm_same_mov, dumps, pm,
+                      self._peephole_rules)
+
+        if key is not None:
+            self._cache.Put(key, asm, dumps)
+        return asm
@@ -1,8 +1,8 @@
 from __future__ import print_function
 
 import ply.lex as lex
-import re
 from ast.sch_ast import *
+from utils import PlyTableModuleName
 
 keywords = {
     'let': 'LET',
@@ -48,29 +48,13 @@ class LexingError(Exception):
 
 
 def LexPreprocess(source):
-  # Important to have the following whitespace
-  replace = {
-      # BIN_CMP
-      r'eq\?\s': '@eq  ',
-      r'<\s': '@lt  ',
-      r'<=\s': '@le  ',
-      r'>\s': '@gt  ',
-      r'>=\s': '@ge  ',
-      # BOOL
-      # \1: 't' or 'f'
-      # \2: extra captured token, needs to be put back
-      r'#([tf])(\s|\]|\))': r'#\1 \2',
-      # vector operations
-      r'vector\s': '@vector  ',
-      r'vector-ref\s': '@vector-ref  ',
-      r'vector-set!\s': '@vector-set  ',
-      # functions and lambdas
-      r'define\s': '@define  ',
-      r'lambda\s': '@lambda  ',
-  }
-
-  for pat, repl in replace.iteritems():
-    source = re.sub(pat, repl, source)
+  '''Kept for compatibility only.
+
+  The lexer used to require the keywords that cannot be matched as a VAR
+  (i.e. 'eq?', '<', 'vector-ref', '#t') to be rewritten into '@'-prefixed
+  forms first. SchemeLexer now recognizes them directly in its single scan
+  over the source, hence this returns |source| unchanged.
+  '''
   return source
 
 
@@ -88,45 +72,40 @@ def SchemeLexer():
     t.value = int(t.value)
     return t
 
+  # The keywords below are only valid when followed by a whitespace (or a
+  # closing paren for bools). They must be defined before t_VAR, as PLY tries
+  # the function rules in the order they are defined.
   def t_BOOL(t):
-    r'\#[tf]\s'  # valid bools are attached with a whitespace ' '
-    t.value = t.value.rstrip()
-    return t
-
-  def t_VAR(t):
-    r'[a-zA-Z_][a-zA-Z0-9_]*'
-    t.type = keywords.get(t.value, 'VAR')
+    r'\#[tf](?=\s|\]|\))'
     return t
 
   def t_CMP_OP(t):
-    r'@((eq)|([lg][et]))'
-    m = {'@eq': 'eq?', '@lt': '<', '@le': '<=', '@gt': '>', '@ge': '>='}
-    t.value = m[t.value]
+    r'(eq\?|<=|>=|<|>)(?=\s)'
     return t
 
   def t_VECTOR_INIT(t):
-    r'@vector\s'  # valid vector op are attached with a whitespace ' '
-    t.value = 'vector'
+    r'vector(?=\s)'
     return t
 
   def t_VECTOR_REF(t):
-    r'@vector-ref\s'  # valid vector op are attached with a whitespace ' '
-    t.value = 'vector-ref'
+    r'vector-ref(?=\s)'
     return t
 
   def t_VECTOR_SET(t):
-    r'@vector-set\s'  # valid vector op are attached with a whitespace ' '
-    t.value = 'vector-set!'
+    r'vector-set!(?=\s)'
     return t
 
   def t_DEFINE(t):
-    r'@define\s'  # valid define is attached with a whitespace
-    t.value = 'define'
+    r'define(?=\s)'
     return t
 
   def t_LAMBDA(t):
-    r'@lambda\s'  # valid lambda is attached with a whitespace
-    t.value = 'lambda'
+    r'lambda(?=\s)'
+    return t
+
+  def t_VAR(t):
+    r'[a-zA-Z_][a-zA-Z0-9_]*'
+    t.type = keywords.get(t.value, 'VAR')
     return t
 
   def t_LINE_COMMENT(t):
@@ -158,7 +137,10 @@ def SchemeLexer():
   def t_ANY_error(t):
     raise LexingError("Unknown token={}".format(t.value))
 
-  return lex.lex()
+  # The master regex is loaded from a pre-generated table module, which is
+  # (re)generated on the first run after any token rule changes.
+  lextab = PlyTableModuleName('lextab', locals(), 't_', tokens, states)
+  return lex.lex(optimize=1, lextab=lextab)
 
 if __name__ == '__main__':
   test_data = '''
@@ -180,7 +162,6 @@ if __name__ == '__main__':
         (eq? (and #t 2) (vector-set! bar (void) (vector-ref bar 1))))
     )
     '''
-  test_data = LexPreprocess(test_data)
   sc_lexer = SchemeLexer()
   sc_lexer.input(test_data)
   while True:
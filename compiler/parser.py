@@ -4,6 +4,7 @@ import ply.yacc as yacc
 import lexer
 from ast.sch_ast import *
 from ast.base import GetIntX
+from utils import PlyTableModuleName
 
 tokens = lexer.tokens
 
@@ -66,10 +67,18 @@ def SchemeParser():
       p[0] = p[0] + p[2]
 
   def p_var_bind_pair(p):
-    '''var_bind_pair : LBRACKET arg_var expr RBRACKET
-                     | LPAREN arg_var expr RPAREN'''
+    '''var_bind_pair : LBRACKET bind_var expr RBRACKET
+                     | LPAREN bind_var expr RPAREN'''
     p[0] = (p[2], p[3])
 
+  def p_bind_var(p):
+    # 'void' is only a keyword in (void), a let may still bind it as a name
+    '''bind_var : arg_var
+                | VOID'''
+    p[0] = p[1]
+    if p.slice[1].type == 'VOID':
+      p[0] = MakeSchVarNode(p[1])
+
   def p_expr_apply(p):
     'expr : LPAREN apply_inner RPAREN'
     p[0] = p[2]
@@ -165,6 +174,10 @@ def SchemeParser():
   def p_error(p):
     raise ParsingError('Error syntax, p={}'.format(p))
 
+  # The LALR tables are loaded from a pre-generated table module, which is
+  # (re)generated on the first run after any grammar rule changes.
+  tabmodule = PlyTableModuleName('parsetab', locals(), 'p_', tokens)
+
   class ParserImpl(object):
 
     def __init__(self, yacc):
@@ -174,7 +187,7 @@ def SchemeParser():
       ast = self._yacc.parse(input=source, lexer=lexer)
       return ast
 
-  return ParserImpl(yacc.yacc())
+  return ParserImpl(yacc.yacc(optimize=1, debug=False, tabmodule=tabmodule))
 
 if __name__ == '__main__':
   test_data = '''
@@ -194,8 +207,6 @@ if __name__ == '__main__':
   )
   (lambda (y z) (+ (id y) z))
   '''
-  test_data = lexer.LexPreprocess(test_data)
-
   lexer = lexer.SchemeLexer()
   parser = SchemeParser()
   ast = parser.parse(test_data, lexer=lexer)
@@ -0,0 +1,139 @@
+'''Pass manager
+Runs the compiling passes and lets hooks observe every one of them, i.e. to
+collect the time and the memory each pass costs.
+'''
+import resource
+import time
+
+from ast.base import *
+from ast.ir_ast import *
+from ast.x86_ast import *
+
+
+class PassHook(object):
+    '''Abstract class observing the passes run by a PassManager
+    '''
+
+    def BeginPass(self, name):
+        '''Optional to override
+        '''
+        pass
+
+    def EndPass(self, name, result):
+        '''Optional to override
+        '''
+        pass
+
+
+class PassManager(object):
+
+    def __init__(self, hooks=None):
+        self._hooks = list(hooks or [])
+
+    def AddHook(self, hook):
+        self._hooks.append(hook)
+
+    def Run(self, name, pass_fn, *args, **kwargs):
+        '''
+        Returns the result of |pass_fn|(*args, **kwargs).
+        '''
+        for hook in self._hooks:
+            hook.BeginPass(name)
+        result = pass_fn(*args, **kwargs)
+        for hook in reversed(self._hooks):
+            hook.EndPass(name, result)
+        return result
+
+
+def _CountIrStmts(stmt_list):
+    count = 0
+    for stmt in stmt_list:
+        count += 1
+        if IsIrIfNode(stmt):
+            count += _CountIrStmts(GetIfThen(stmt))
+            count += _CountIrStmts(GetIfElse(stmt))
+    return count
+
+
+def _CountX86Instrs(instr_list):
+    count = 0
+    for instr in instr_list:
+        if IsX86TmpIfNode(instr):
+            count += _CountX86Instrs(GetX86TmpIfThen(instr))
+            count += _CountX86Instrs(GetX86TmpIfElse(instr))
+        else:
+            count += 1
+    return count
+
+
+def ProgramSize(result):
+    '''
+    Returns a dict describing the size of the result of a pass.
+    '''
+    if not isinstance(result, AstNode):
+        return {}
+    if IsIrProgramNode(result):
+        return {'stmts': _CountIrStmts(GetNodeStmtList(result)),
+                'vars': len(GetNodeVarList(result))}
+    if IsX86ProgramNode(result):
+        return {'instrs': _CountX86Instrs(GetX86ProgramInstrList(result)),
+                'vars': len(GetNodeVarList(result))}
+    return {}
+
+
+def _PeakRss():
+    # KB on Linux, bytes on Mac OS X
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class PassStatsHook(PassHook):
+    '''Collects the elapsed time, the number of created AST nodes, the size
+    of the produced program and the peak RSS delta of every pass, as well as
+    the spilled variables of an allocated X86 program and the rewrites of the
+    Peephole pass.
+    '''
+
+    def __init__(self):
+        self.stats = []
+        self._begin = None
+
+    def BeginPass(self, name):
+        SetNodeCounting(True)
+        self._begin = (time.time(), NumNodesCreated(), _PeakRss())
+
+    def EndPass(self, name, result):
+        SetNodeCounting(False)
+        begin_time, begin_nodes, begin_rss = self._begin
+        stat = {
+            'name': name,
+            'time': time.time() - begin_time,
+            'nodes_created': NumNodesCreated() - begin_nodes,
+            'peak_rss_delta': _PeakRss() - begin_rss,
+        }
+        stat.update(ProgramSize(result))
+        if isinstance(result, AstNode) and IsX86ProgramNode(result):
+            if GetX86ProgramNumSpilledVars(result) is not None:
+                stat['spilled_vars'] = GetX86ProgramNumSpilledVars(result)
+            if GetX86ProgramRewriteCounts(result) is not None:
+                stat['rewrites'] = dict(GetX86ProgramRewriteCounts(result))
+        self.stats.append(stat)
+
+    def Report(self):
+        '''
+        Returns a human readable table of the stats.
+        '''
+        lines = ['{: <26}{: >10}{: >10}{: >12}  {}'.format(
+            'Pass', 'Time(s)', 'Nodes', 'PeakRSS+', 'Output')]
+        total = 0.0
+        for stat in self.stats:
+            total += stat['time']
+            size = ', '.join('{}={}'.format(k, stat[k]) for k in
+                             ('stmts', 'instrs', 'vars', 'spilled_vars')
+                             if k in stat)
+            lines.append('{: <26}{: >10.4f}{: >10}{: >12}  {}'.format(
+                stat['name'], stat['time'], stat['nodes_created'],
+                stat['peak_rss_delta'], size))
+            for rule, count in sorted(stat.get('rewrites', {}).iteritems()):
+                lines.append('  {: <24}{: >10}'.format(rule, count))
+        lines.append('{: <26}{: >10.4f}'.format('Total', total))
+        return '\n'.join(lines)
@@ -1,9 +1,67 @@
-import string
-import random
+import hashlib
 
 
-def GenerateRandomAlphaString(n):
-    return ''.join(random.choice(string.ascii_uppercase + string.ascii_lowercase) for _ in range(n))
+GENSYM_SEP = '.'
+
+
+class Gensym(object):
+    '''Generates the names of the temporaries created by the compiler
+
+    A name is a prefix, then GENSYM_SEP, then a counter shared by all the
+    prefixes. GENSYM_SEP cannot appear in a Scheme identifier, so a generated
+    name never collides with a user variable (before or after Uniquify), nor
+    with another generated name. The counter starts from 0 for every
+    compilation, so the generated code is deterministic.
+    '''
+
+    def __init__(self):
+        self._next = 0
+
+    def NextIndex(self):
+        index = self._next
+        self._next += 1
+        return index
+
+    def New(self, prefix):
+        return '{}{}{}'.format(prefix, GENSYM_SEP, self.NextIndex())
+
+
+def PlyTableModuleName(basename, ldict, prefix, *extra):
+    '''
+    Returns the name of the PLY table module for the rules in |ldict|.
+
+    The name is versioned by a digest of the rules (names starting with
+    |prefix|) and |extra|, so that tables generated for an older grammar are
+    never loaded in optimized mode.
+    '''
+    rules = [(k, v) for k, v in ldict.items() if k.startswith(prefix)]
+    # PLY orders function rules by their definition order, while string rules
+    # are not ordered by PLY at all.
+    funcs = sorted([(v.__code__.co_firstlineno, k, v.__doc__)
+                    for k, v in rules if callable(v)])
+    strs = sorted([(k, v) for k, v in rules if not callable(v)])
+    digest = hashlib.md5()
+    for _, name, doc in funcs:
+        digest.update('{}:{}\n'.format(name, doc))
+    for name, val in strs:
+        digest.update('{}={}\n'.format(name, val))
+    for e in extra:
+        digest.update('{}\n'.format(e))
+    return '{}_{}'.format(basename, digest.hexdigest()[:12])
+
+
+def IterBits(bits):
+    '''
+    Yields the index of every bit set in the int |bits|, from the lowest.
+    '''
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+def PopCount(bits):
+    return bin(bits).count('1')
 
 
 class UGraph(object):
@@ -29,6 +29,14 @@ _CMP_OP_TO_CC = {'eq?': 'e', '<': 'l', '<=': 'le', '>': 'g', '>=': 'ge'}
 def CmpOpToCc(cmp_op):
     return _CMP_OP_TO_CC[cmp_op]
 
+# the same condition after the two operands of cmp are swapped
+_SWAPPED_CC = {CC_EQ: CC_EQ, CC_LT: CC_GT, CC_LE: CC_GE, CC_GT: CC_LT,
+               CC_GE: CC_LE}
+
+
+def SwapCc(cc):
+    return _SWAPPED_CC[cc]
+
 '''X86 Registers (64-bit)
 '''
 RAX = 'rax'
@@ -49,6 +57,26 @@ RSP = 'rsp'
 RBP = 'rbp'
 
 
+# every register has a bit, so that a set of registers is an int
+_REG_BITS = {r: 1 << i for i, r in enumerate(
+    [RAX, RBX, RCX, RDX, RSI, RDI, R8, R9, R10, R11, R12, R13, R14, R15,
+     RSP, RBP])}
+
+
+NUM_REGS = len(_REG_BITS)
+
+
+def RegBit(reg):
+    return _REG_BITS[reg]
+
+
+def RegMask(regs):
+    mask = 0
+    for r in regs:
+        mask |= _REG_BITS[r]
+    return mask
+
+
 def CallerSaveRegs():
     # rax rdx rcx rsi rdi r8 r9 r10 r11
     for r in [RAX, RCX, RDX, RSI, RDI, R8, R9, R10, R11]:
@@ -61,9 +89,12 @@ def CalleeSaveRegs():
 
 
 def FreeRegs():
-    # All the caller save registers
+    # The caller save registers first, because a callee save register costs
+    # a push/pop in the prologue/epilogue.
     # rax is excluded due to how Patch Instruction is implemented
-    for r in [RDX, RCX, RSI, RDI, R8, R9, R10, R11]:
+    # r11 is excluded because vector-ref|set dereference the vector with it
+    # r15 is the rootstack pointer
+    for r in [RDX, RCX, RSI, RDI, R8, R9, R10, RBX, R12, R13, R14]:
         yield r
 
 
@@ -0,0 +1,17 @@
+'''Pre-generates the PLY lexer and LALR parser tables under compiler/.
+
+Run this once after checking out the repository, or as part of the build, so
+that no compiler invocation pays for the grammar analysis. The tables are
+versioned by the grammar rules, hence a stale table is simply never loaded.
+'''
+from compiler.lexer import SchemeLexer
+from compiler.parser import SchemeParser
+
+
+def main():
+    SchemeLexer()
+    SchemeParser()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,83 @@
 from __future__ import print_function
 
+import argparse
+import json
 import sys
 
-from compiler.lexer import LexPreprocess, SchemeLexer
-from compiler.parser import SchemeParser
-import compiler.analyzer as anlz
-from compiler.compiler import *
+from compiler.ast.base import AstNode, LangOf, SetAstVisitorDebug
+from compiler.ast.sch_ast import SCH_LANG, SchSourceCode
+from compiler.ast.ir_ast import IR_LANG, IrSourceCode
+from compiler.ast.x86_ast import X86_LANG, X86InternalFormatter, X86SourceCode
+from compiler.compiler import PEEPHOLE_RULE_NAMES
+from compiler.driver import Driver
+from compiler.pass_manager import PassHook, PassManager, PassStatsHook
+
+
+def PrintSourceCode(header, code):
+    print(header)
+    print(code)
+    print('---\n')
+
+
+class _PrintPassHook(PassHook):
+    '''Prints the source code produced by every pass
+    '''
+
+    _HEADERS = {
+        'PartialEval': 'Scheme Partial-Evaluation',
+        'ExposeAllocation': 'Scheme Expose-Allocation',
+        'Uniquify': 'Scheme Uniquify',
+        'Flatten': 'IR source code',
+        'PropagateCopies': 'IR (Propagate Copies)',
+        'SelectInstruction': 'X86 (Select Instruction)',
+        'UncoverLive': 'X86 (Uncover Live)',
+        'AllocateRegisterOrStack': 'X86 (Allocate Register or Stack)',
+        'LowerTmpIf': 'X86 (Lower TmpIf)',
+        'PatchInstruction': 'X86 (Patch Instructions)',
+        'Peephole': 'X86 (Peephole)',
+        'GenerateX86': 'X86 (Assembly)',
+    }
+
+    def __init__(self):
+        self._x86_formatter = X86InternalFormatter()
+
+    def EndPass(self, name, result):
+        if name not in self._HEADERS:
+            return
+        header = self._HEADERS[name]
+        if not isinstance(result, AstNode):
+            PrintSourceCode(header, result)
+        elif LangOf(result) == SCH_LANG:
+            PrintSourceCode(header, SchSourceCode(result))
+        elif LangOf(result) == IR_LANG:
+            PrintSourceCode(header, IrSourceCode(result))
+        elif LangOf(result) == X86_LANG:
+            self._x86_formatter.include_live_afters = name == 'UncoverLive'
+            PrintSourceCode(header,
+                            X86SourceCode(result, self._x86_formatter))
 
 
 def main():
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('input_filename', nargs='?', default=None)
+    arg_parser.add_argument('--time-passes', action='store_true',
+                            help='print the time and memory of every pass '
+                            'to stderr')
+    arg_parser.add_argument('--pass-stats', default=None, metavar='FILE',
+                            help='write the stats of every pass as JSON to '
+                            'this file')
+    arg_parser.add_argument('--debug-visitors', action='store_true',
+                            help='check every node visited by the passes')
+    arg_parser.add_argument('--peephole-rules', default=None, metavar='RULES',
+                            help='the comma separated peephole rules to '
+                            'apply, all of them by default: {}'.format(
+                                ','.join(PEEPHOLE_RULE_NAMES)))
+    args = arg_parser.parse_args()
+    peephole_rules = None
+    if args.peephole_rules is not None:
+        peephole_rules = [r for r in args.peephole_rules.split(',') if r]
+    SetAstVisitorDebug(args.debug_visitors)
+
     # test_data = '''
     # (let ([foo 42] [bar (vector 1 2 3)])
     #     (+
@@ -47,65 +116,27 @@ def main():
     # test_data = '''
     # (vector-ref (vector-ref (vector (vector 42)) 0) 0)
     # '''
-    input_filename = None
-    if len(sys.argv) > 1:
-        input_filename = sys.argv[1]
+    input_filename = args.input_filename
+    if input_filename is not None:
         lines = []
         with open(input_filename, 'r') as rf:
             for line in rf:
                 lines.append(line)
         test_data = ''.join(lines)
 
-    def PrintSourceCode(header, code):
-        print(header)
-        print(code)
-        print('---\n')
-
     PrintSourceCode('Source code', test_data)
 
-    test_data = LexPreprocess(test_data)
-
-    lexer = SchemeLexer()
-    parser = SchemeParser()
-    ast = parser.parse(test_data, lexer=lexer)
+    stats_hook = PassStatsHook()
+    pm = PassManager([_PrintPassHook(), stats_hook])
+    driver = Driver(peephole_rules=peephole_rules)
+    x86_src_code = driver.Compile(test_data, pass_manager=pm)
 
-    anlz.analyze(ast)
-
-    sch_ast = ExposeAllocation(ast)
-    PrintSourceCode('Scheme Expose-Allocation',
-                    SchSourceCode(sch_ast))
-
-    sch_ast = Uniquify(ast)
-    PrintSourceCode('Scheme Uniquify', SchSourceCode(sch_ast))
-
-    ir_ast = Flatten(sch_ast)
-    PrintSourceCode('IR source code', IrSourceCode(ir_ast))
-
-    x86_formatter = X86InternalFormatter()
-    x86_ast = SelectInstruction(ir_ast)
-    PrintSourceCode('X86 (Select Instruction)',
-                    X86SourceCode(x86_ast, x86_formatter))
-
-    x86_ast = UncoverLive(x86_ast)
-    x86_formatter.include_live_afters = True
-    PrintSourceCode('X86 (Uncover Live)',
-                    X86SourceCode(x86_ast, x86_formatter))
-
-    x86_ast = AllocateRegisterOrStack(x86_ast)
-    x86_formatter.include_live_afters = False
-    PrintSourceCode('X86 (Allocate Register or Stack)',
-                    X86SourceCode(x86_ast, x86_formatter))
-
-    x86_ast = LowerTmpIf(x86_ast)
-    PrintSourceCode('X86 (Lower TmpIf)',
-                    X86SourceCode(x86_ast, x86_formatter))
-
-    x86_ast = PatchInstruction(x86_ast)
-    PrintSourceCode('X86 (Patch Instructions)',
-                    X86SourceCode(x86_ast, x86_formatter))
-
-    x86_src_code = GenerateX86(x86_ast)
-    PrintSourceCode('X86 (Assembly)', x86_src_code)
+    if args.time_passes:
+        print(stats_hook.Report(), file=sys.stderr)
+    if args.pass_stats is not None:
+        with open(args.pass_stats, 'w') as wf:
+            json.dump(stats_hook.stats, wf, indent=2, sort_keys=True)
+            wf.write('\n')
 
     if input_filename is not None:
         import os
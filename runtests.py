@@ -1,12 +1,33 @@
+'''Test runner
+Compiles and runs every test case of the selected grammar levels in a pool
+of worker processes, and compares the output with the one of Racket. The
+Racket output is cached by the hash of the test source and input, so that
+`racket` only runs for new or changed tests.
+
+    python runtests.py            # r1 and r2
+    python runtests.py -j 8 r1 r3
+'''
+import argparse
+import hashlib
+import multiprocessing as mp
 import os
 import subprocess as sp
 import sys
 import shutil as shu
+import tempfile
+
+from compile_server import WriteAssembly
+from compiler.analyzer import AnalyzeError
+from compiler.driver import Driver
+import gentables
 
 DEFAULT_TESTS_DIR = 'tests'
-SCH_COMPILER = 'integrated.py'
+DEFAULT_LEVELS = ['r1', 'r2', 'r3']
+ORACLE_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'schemepar_oracle')
 RUNTIME_SRC_PATHs = [
     os.path.join('runtime', 'runtime.c'),
+    os.path.join('runtime', 'gc.c'),
 ]
 
 OKGREEN = '\033[92m'
@@ -32,88 +53,191 @@ def GetShellCmd(cmds):
 def ExecCommand(cmd_list):
     cmd = GetShellCmd(cmd_list)
     # print '    exec: {}'.format(cmd)
-    out = sp.check_output(cmd, shell=True)
+    out = sp.check_output(cmd, shell=True, stderr=sp.STDOUT)
     return out
 
 
-def RunTestCase(test_path, input_path):
+class TestCase(object):
+
+    def __init__(self, test_path):
+        self.name = os.path.basename(test_path)
+        self.test_path = test_path
+        self.input_path = ChangeExt(test_path, 'in')
+        if not os.path.isfile(self.input_path):
+            self.input_path = None
+        # the test is expected to be rejected by the type checker
+        self.expect_tyerr = os.path.isfile(ChangeExt(test_path, 'tyerr'))
+
+
+def CollectTestCases(test_dir, levels):
+    '''
+    levels: a list of grammar levels, i.e. 'r1'. A test case named
+            'r1_2.rkt' or 'r1a_2.rkt' belongs to level 'r1'.
+    '''
+    test_cases = []
+    for name in sorted(os.listdir(test_dir)):
+        test_path = os.path.join(test_dir, name)
+        if not (os.path.isfile(test_path) and name.endswith('.rkt')):
+            continue
+        if any(name.startswith(lv) for lv in levels):
+            test_cases.append(TestCase(test_path))
+    return test_cases
+
+
+class OracleCache(object):
+    '''Caches the Racket output of the test cases
+    '''
+
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _Path(self, test_case):
+        digest = hashlib.sha1()
+        for path in (test_case.test_path, test_case.input_path):
+            digest.update('\0')
+            if path is not None:
+                with open(path, 'r') as rf:
+                    digest.update(rf.read())
+        return os.path.join(self._cache_dir, digest.hexdigest())
+
+    def Get(self, test_case, work_dir):
+        path = self._Path(test_case)
+        if os.path.isfile(path):
+            with open(path, 'r') as rf:
+                return rf.read()
+        expected_out = _RunRacket(test_case, work_dir)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as wf:
+            wf.write(expected_out)
+        os.rename(tmp_path, path)
+        return expected_out
+
+
+def _RunRacket(test_case, work_dir):
+    # add '#lang racket' header to test scheme code
+    tmp_test_path = os.path.join(work_dir, test_case.name + '.tmp')
+    with open(test_case.test_path, 'r') as rf, open(tmp_test_path, 'w') as wf:
+        wf.write('#lang racket\n\n')
+        for l in rf:
+            wf.write(l)
+
+    cmd_list = ['racket', tmp_test_path]
+    if test_case.input_path is not None:
+        cmd_list.extend(['<', test_case.input_path])
+    return ExecCommand(cmd_list).strip()
+
+
+# the states of the current worker process
+_driver = None
+_oracle_cache = None
+_runtime_objs = None
+
+
+def _InitWorker(oracle_cache_dir, runtime_objs):
+    global _driver, _oracle_cache, _runtime_objs
+    _driver = Driver()
+    _oracle_cache = OracleCache(oracle_cache_dir)
+    _runtime_objs = runtime_objs
+
+
+def RunTestCase(test_case):
+    '''
+    Returns a tuple of (test_case, passed, message).
+    '''
+    work_dir = tempfile.mkdtemp(prefix='schemepar_test_')
     try:
-        # add '#lang racket' header to test scheme code
-        tmp_test_path = test_path + '.tmp'
-        with open(test_path, 'r') as rf, open(tmp_test_path, 'w') as wf:
-            wf.write('#lang racket\n\n')
-            for l in rf:
-                wf.write(l)
+        # compile to assembly
+        with open(test_case.test_path, 'r') as rf:
+            source = rf.read()
+        try:
+            asm = _driver.Compile(source)
+        except Exception as e:
+            if test_case.expect_tyerr and isinstance(e, AnalyzeError):
+                return test_case, True, None
+            error = '{}: {}'.format(type(e).__name__, e)
+            return test_case, False, 'compile error: \n{}'.format(error)
+        if test_case.expect_tyerr:
+            return test_case, False, 'expected a type error'
 
         # expected output
-        cmd_list = ['racket', tmp_test_path]
-        if input_path is not None:
-            cmd_list.extend(['<', input_path])
-        expected_out = ExecCommand(cmd_list)
-        expected_out = expected_out.strip()
-
-        # compiler output
-
-        # compile to assembly
-        out_bin = DropExt(test_path)
-        cmd_list = ['python', SCH_COMPILER, test_path]
-        ExecCommand(cmd_list)
+        expected_out = _oracle_cache.Get(test_case, work_dir)
 
         # link runtime and produce binary
-        asm_path = ChangeExt(test_path, 's')
-        cmd_list = ['gcc', '-o', out_bin, asm_path] + RUNTIME_SRC_PATHs
+        asm_path = os.path.join(work_dir, ChangeExt(test_case.name, 's'))
+        WriteAssembly(asm_path, asm)
+        out_bin = DropExt(asm_path)
+        cmd_list = ['gcc', '-o', out_bin, asm_path] + _runtime_objs
         ExecCommand(cmd_list)
 
         # call binary
+        cmd_list = [out_bin]
+        if test_case.input_path is not None:
+            cmd_list.extend(['<', test_case.input_path])
+        compiler_out = ExecCommand(cmd_list).strip()
 
-        cmd_list = ['./{}'.format(out_bin)]
-        if input_path is not None:
-            cmd_list.extend(['<', input_path])
-        compiler_out = ExecCommand(cmd_list)
-        compiler_out = compiler_out.strip()
-
-        test_name = os.path.basename(test_path)
         if expected_out == compiler_out:
-            print 'Test={} {}OK{}'.format(test_name, OKGREEN, ENDC)
-            return True
-        else:
-            print 'Test={} {}Failed{}'.format(test_name, FAIL, ENDC)
-            print 'expeted: \n{}'.format(expected_out)
-            print 'got: \n{}'.format(compiler_out)
-            return False
+            return test_case, True, None
+        return test_case, False, 'expeted: \n{}\ngot: \n{}'.format(
+            expected_out, compiler_out)
+    except sp.CalledProcessError as e:
+        return test_case, False, '`{}` failed: \n{}'.format(e.cmd, e.output)
     finally:
-        os.remove(tmp_test_path)
+        shu.rmtree(work_dir)
+
+
+def BuildRuntime(build_dir):
+    '''
+    Compiles the runtime once, returns the list of the object files.
+    '''
+    objs = []
+    for src_path in RUNTIME_SRC_PATHs:
+        obj = os.path.join(build_dir, ChangeExt(os.path.basename(src_path), 'o'))
+        ExecCommand(['gcc', '-c', '-o', obj, src_path])
+        objs.append(obj)
+    return objs
 
 
 def RunTests():
-    test_dir = DEFAULT_TESTS_DIR
-    tmp_test_dir = os.path.join(test_dir, 'tmp')
-
-    # create tmp test directory
-    if os.path.isdir(tmp_test_dir):
-        shu.rmtree(tmp_test_dir)
-    os.makedirs(tmp_test_dir)
-
-    for test_prefix in ['r1', 'r2']:
-        for name in os.listdir(test_dir):
-            test_path = os.path.join(test_dir, name)
-            if os.path.isfile(test_path) and name.startswith(test_prefix) and name.endswith('.rkt'):
-                shu.copy(test_path, tmp_test_dir)
-                tmp_test_path = os.path.join(tmp_test_dir, name)
-
-                input_path = ChangeExt(test_path, 'in')
-                tmp_input_path = None
-                if os.path.isfile(input_path):
-                    shu.copy(input_path, tmp_test_dir)
-                    tmp_input_path = ChangeExt(tmp_test_path, 'in')
+    arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    arg_parser.add_argument('levels', nargs='*', default=DEFAULT_LEVELS,
+                            help='the grammar levels to test, i.e. r1 r2')
+    arg_parser.add_argument('-j', '--jobs', type=int,
+                            default=mp.cpu_count())
+    arg_parser.add_argument('--test-dir', default=DEFAULT_TESTS_DIR)
+    arg_parser.add_argument('--oracle-cache-dir', default=ORACLE_CACHE_DIR)
+    args = arg_parser.parse_args()
+
+    test_cases = CollectTestCases(args.test_dir, args.levels)
+    # generate the PLY tables once, rather than racing in every worker
+    gentables.main()
+
+    build_dir = tempfile.mkdtemp(prefix='schemepar_runtime_')
+    failed = []
+    try:
+        runtime_objs = BuildRuntime(build_dir)
+        pool = mp.Pool(args.jobs, _InitWorker,
+                       (args.oracle_cache_dir, runtime_objs))
+        try:
+            for test_case, passed, message in pool.imap(RunTestCase, test_cases):
+                if passed:
+                    print 'Test={} {}OK{}'.format(test_case.name, OKGREEN, ENDC)
                 else:
-                    input_path = None
+                    print 'Test={} {}Failed{}'.format(test_case.name, FAIL, ENDC)
+                    print message
+                    failed.append(test_case.name)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shu.rmtree(build_dir)
 
-                result = RunTestCase(tmp_test_path, tmp_input_path)
-                if not result:
-                    break
-                # break
-    shu.rmtree(tmp_test_dir)
+    print '\n{} passed, {} failed'.format(
+        len(test_cases) - len(failed), len(failed))
+    for name in failed:
+        print '  {}{}{}'.format(FAIL, name, ENDC)
+    return 1 if failed else 0
 
 if __name__ == '__main__':
-    RunTests()
+    sys.exit(RunTests())